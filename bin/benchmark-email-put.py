@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+"""Time gratipay.email.Queue.put as the history in email_messages grows.
+
+Every user-initiated put counts the recipient's pending messages to decide
+whether to throttle them. That count should cost the same however many
+messages we've sent before, so we grow the table in steps and time a batch of
+puts at each size.
+
+Usage:
+
+    [gratipay] $ ./env/bin/honcho run -e defaults.env,local.env python bin/benchmark-email-put.py [SIZES]
+
+where SIZES is a comma-separated list of row counts (default
+10000,100000,1000000,5000000).
+
+**This empties email_messages.** Point it at a scratch database.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import time
+
+from gratipay.application import Application
+from gratipay.exceptions import Throttled
+
+
+SIZES = [int(n) for n in (sys.argv[1] if len(sys.argv) > 1 else '10000,100000,1000000,5000000').split(',')]
+NPUTS = 200
+
+app = Application()
+db = app.db
+queue = app.email_queue
+
+db.run("TRUNCATE email_messages")
+alice = db.one("""
+    INSERT INTO participants (username, username_lower, claimed_time, email_address)
+         VALUES ('email-benchmark', 'email-benchmark', now(), 'benchmark@example.com')
+    ON CONFLICT (username) DO UPDATE SET email_address = excluded.email_address
+      RETURNING participants.*::participants
+""")
+
+print("{:>10} {:>12}".format('rows', 'put'))
+nrows = 0
+for size in SIZES:
+    # Sent messages, half of them to alice and half to bare email addresses,
+    # which is the worst case for a count that has to scan them.
+    db.run("""
+        INSERT INTO email_messages
+                    (participant, email_address, spt_name, context, user_initiated, result, ctime)
+             SELECT CASE WHEN i %% 2 = 0 THEN %(alice)s END
+                  , CASE WHEN i %% 2 = 1 THEN 'benchmark@example.com' END
+                  , 'base', '\\x017b7d'::bytea, true, '', now() - '1 day'::interval
+               FROM generate_series(%(start)s, %(stop)s) i
+    """, dict(alice=alice.id, start=nrows, stop=size - 1))
+    nrows = size
+    db.run("ANALYZE email_messages")
+
+    elapsed = 0
+    for i in range(NPUTS):
+        to, email = (alice, None) if i % 2 == 0 else (None, 'benchmark@example.com')
+        start = time.time()
+        try:
+            queue.put(to, 'base', email=email)
+        except Throttled:
+            pass
+        elapsed += time.time() - start
+        db.run("UPDATE email_messages SET result='' WHERE result IS NULL")
+    print("{:>10} {:>10.2f}ms".format(nrows, elapsed / NPUTS * 1000))
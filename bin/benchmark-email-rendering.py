@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+"""Time how long it takes to render each of our email templates.
+
+We compare rendering with the layout composed in at startup (what
+gratipay.email.Queue.render does) against rendering the layout and the body
+separately and pasting one into the other, the way we used to.
+
+Usage:
+
+    [gratipay] $ ./env/bin/honcho run -e defaults.env,local.env python bin/benchmark-email-rendering.py [N]
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+import timeit
+
+from gratipay import email, wireup
+from gratipay.utils import find_files, i18n
+
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+env = wireup.env()
+tell_sentry = wireup.make_sentry_teller(env)
+queue = email.Queue(env, None, tell_sentry, root)
+locale = i18n.match_lang(i18n.parse_accept_lang('en'))
+
+templates_dir = os.path.join(root, 'emails')
+base = email.compile_email_spt(os.path.join(templates_dir, 'base.spt'))
+
+
+def render_naively(spt, context):
+    context = dict(context)
+    i18n.add_helpers_to_context(tell_sentry, context, locale)
+    context_html = dict(context)
+    i18n.add_helpers_to_context(tell_sentry, context_html, locale)
+    context_html['escape'] = email.htmlescape
+    def render(t, context):
+        b = base[t].render(context).strip()
+        return b.replace('$body', spt[t].render(context).strip())
+    return ( spt['subject'].render(context).strip()
+           , render('text/plain', context)
+           , render('text/html', context_html)
+            )
+
+
+print("{:<40} {:>12} {:>12}".format('template', 'naive', 'composed'))
+i = len(templates_dir) + 1
+for fpath in sorted(find_files(templates_dir, '*.spt')):
+    spt_name = fpath[i:-4]
+    spt = email.compile_email_spt(fpath)
+    context = dict(include_unsubscribe=True)
+    try:
+        queue.render(spt_name, context, locale)
+    except Exception as e:
+        # Some templates need a context we don't fake here.
+        print("{:<40} skipped ({})".format(spt_name, e.__class__.__name__))
+        continue
+    naive = timeit.timeit(lambda: render_naively(spt, context), number=N)
+    composed = timeit.timeit(lambda: queue.render(spt_name, context, locale), number=N)
+    print("{:<40} {:>10.1f}us {:>10.1f}us".format(spt_name, naive / N * 1e6, composed / N * 1e6))
@@ -0,0 +1,113 @@
+BEGIN;
+    ALTER TABLE paydays ADD COLUMN checkpoints jsonb NOT NULL DEFAULT '{}'::jsonb;
+END;
+
+BEGIN;
+    CREATE TABLE payday_metrics
+    ( payday                int             NOT NULL REFERENCES paydays
+    , stage                 text            NOT NULL
+    , ts                    timestamptz     NOT NULL DEFAULT now()
+    , seconds               numeric(12,3)   NOT NULL
+    , nrows                 bigint
+    , nbraintree_calls      int             NOT NULL DEFAULT 0
+    , nbraintree_retries    int             NOT NULL DEFAULT 0
+    , UNIQUE (payday, stage)
+     );
+END;
+
+BEGIN;
+    CREATE TABLE payday_facts
+    ( payday            int                 NOT NULL REFERENCES paydays
+    , participant_id    bigint              NOT NULL REFERENCES participants
+    , team_id           bigint              NOT NULL REFERENCES teams
+    , amount            numeric(35,2)       NOT NULL
+    , direction         payment_direction   NOT NULL
+    , is_due            boolean             NOT NULL DEFAULT false
+     );
+    CREATE INDEX ON payday_facts (payday);
+END;
+
+BEGIN;
+    -- Filled in by Package.upsert and friends; see Package.fingerprint.
+    ALTER TABLE packages ADD COLUMN fingerprint text;
+END;
+
+BEGIN;
+    -- Queue.put throttles on these; they only cover pending user-initiated
+    -- messages, so they stay small however long the history gets.
+    CREATE INDEX email_messages_throttle_participant_idx
+              ON email_messages (participant)
+           WHERE user_initiated AND result IS NULL;
+    CREATE INDEX email_messages_throttle_email_address_idx
+              ON email_messages (email_address)
+           WHERE user_initiated AND result IS NULL;
+
+    -- Queue.flush claims pending messages oldest first.
+    CREATE INDEX email_messages_pending_idx ON email_messages (ctime) WHERE result IS NULL;
+END;
+
+BEGIN;
+    -- The shared QueryCache backend; see PostgresBackend. It's only a cache,
+    -- so skip the WAL and lose it in a crash.
+    CREATE UNLOGGED TABLE query_cache
+    ( key       text        PRIMARY KEY
+    , value     bytea       NOT NULL
+    , tables    text[]      NOT NULL DEFAULT '{}'
+    , ts        timestamptz NOT NULL DEFAULT now()
+     );
+
+    -- Drop shared results that depend on the changed table, and tell every
+    -- process to drop its own (see QueryCache.listen).
+    CREATE FUNCTION invalidate_query_cache() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM query_cache WHERE TG_TABLE_NAME = ANY(tables);
+            PERFORM pg_notify('query_cache', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    -- Payday updates its own row all the time (checkpoints, stage); only
+    -- changes to the columns our cached queries read count.
+    CREATE TRIGGER invalidate_query_cache
+        AFTER INSERT OR UPDATE OF ts_start, ts_end, volume, nusers, nteams OR DELETE OR TRUNCATE
+           ON paydays
+        FOR EACH STATEMENT EXECUTE PROCEDURE invalidate_query_cache();
+    CREATE TRIGGER invalidate_query_cache
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON teams
+        FOR EACH STATEMENT EXECUTE PROCEDURE invalidate_query_cache();
+END;
+
+BEGIN;
+    -- Queue.flush claims a batch here, and commits, before sending it; see
+    -- its docstring.
+    ALTER TABLE email_messages ADD COLUMN claimed timestamptz;
+END;
+
+BEGIN;
+    -- Tell every process to forget a cached session when it changes hands or
+    -- its participant's standing changes (see SessionCache and QueryCache.listen).
+    CREATE FUNCTION notify_session_cache() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('session_cache', NEW.id::text);
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER notify_session_cache
+        AFTER UPDATE OF session_token, session_expires, is_suspicious, is_closed, is_admin, username
+           ON participants
+        FOR EACH ROW
+         WHEN (    OLD.session_token IS DISTINCT FROM NEW.session_token
+                OR OLD.session_expires IS DISTINCT FROM NEW.session_expires
+                OR OLD.is_suspicious IS DISTINCT FROM NEW.is_suspicious
+                OR OLD.is_closed IS DISTINCT FROM NEW.is_closed
+                OR OLD.is_admin IS DISTINCT FROM NEW.is_admin
+                OR OLD.username IS DISTINCT FROM NEW.username
+               )
+        EXECUTE PROCEDURE notify_session_cache();
+END;
+
+BEGIN;
+    -- The set-based payday engine's working tables are temporary now.
+    DROP TABLE IF EXISTS payday_funding, payday_take_payments, payday_draws;
+END;
@@ -9,6 +9,7 @@ from .models import GratipayDB
 from .card_charger import CardCharger
 from .payday_runner import PaydayRunner
 from .project_review_process import ProjectReviewProcess
+from .utils.query_cache import BACKENDS, LRUQueryCache, QueryCache
 from .website import Website
 
 
@@ -30,12 +31,25 @@ class Application(object):
         env = self.env = wireup.env()
         db = self.db = GratipayDB(self, url=env.database_url, maxconn=env.database_maxconn)
         tell_sentry = self.tell_sentry = wireup.make_sentry_teller(env)
+        backend = BACKENDS[env.query_cache_backend](db)
+        if env.query_cache_maxsize:
+            self.query_cache = LRUQueryCache( db
+                                            , threshold=env.query_cache_threshold
+                                            , maxsize=env.query_cache_maxsize
+                                            , maxbytes=env.query_cache_maxbytes
+                                            , grace=env.query_cache_grace
+                                            , negative_threshold=env.query_cache_negative_threshold
+                                            , backend=backend
+                                             )
+        else:
+            self.query_cache = QueryCache(db, threshold=env.query_cache_threshold, backend=backend)
 
         website.init_more(env, db, tell_sentry) # TODO Fold this into Website.__init__
 
         wireup.crypto(env)
         wireup.base_url(website, env)
         wireup.secure_cookies(env)
+        wireup.session_cache(env)
         wireup.billing(env)
         wireup.username_restrictions(website)
         wireup.load_i18n(website.project_root, tell_sentry)
@@ -58,6 +72,7 @@ class Application(object):
         cron(env.check_npm_sync_every, lambda: sync_npm.check(db))
         cron(env.email_queue_flush_every, self.email_queue.flush, True)
         cron(env.email_queue_log_metrics_every, self.email_queue.log_metrics)
+        cron(env.query_cache_log_metrics_every, self.query_cache.log_metrics)
 
 
     def add_event(self, c, type, payload):
@@ -1,2 +1,22 @@
 """Gratipay billing module.
 """
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import braintree
+import requests
+
+from gratipay.utils.executor import Executor
+
+
+#: Errors worth retrying a Braintree call for. A connection can drop after
+#: Braintree has acted on a request, so we only retry calls that are safe to
+#: repeat (voids, searches, settling an existing transaction). Creating a
+#: transaction goes through ``braintree_executor.call_once``.
+BRAINTREE_TRANSIENT_ERRORS = ( braintree.exceptions.DownForMaintenanceError
+                             , braintree.exceptions.http.ConnectionError
+                             , requests.exceptions.ConnectionError
+                              )
+
+#: All of our Braintree API calls go through this executor. It is configured
+#: from the environment in :py:func:`gratipay.wireup.billing`.
+braintree_executor = Executor('braintree', transient=BRAINTREE_TRANSIENT_ERRORS)
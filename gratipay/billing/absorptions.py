@@ -0,0 +1,99 @@
+"""Move money out of archived accounts, to the accounts that absorbed them.
+
+When one participant takes over another's last account elsewhere, the other
+participant is archived (renamed to a random username) and absorbed, and the
+absorption is recorded in the ``absorptions`` table. Money can still land in
+an archived account afterwards, for example when payday pays out a take that
+was computed before the take-over. And the absorbing account may itself be
+absorbed later on, so absorptions form chains::
+
+    archived_as=alice1  absorbed_by=bob1
+    archived_as=bob1    absorbed_by=carl
+
+(``absorbed_by`` follows renames, so when ``bob`` is archived as ``bob1`` the
+first row is updated to match.) We follow each chain to its end in one
+recursive query, and move the whole balance there directly.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import namedtuple
+
+
+Chain = namedtuple('Chain', 'source target path amount')
+
+
+TAKE_OVER_BALANCES = """
+
+    WITH RECURSIVE chains AS (
+
+        -- Start from each archived account that has money in it ...
+
+        SELECT a.archived_as AS source
+             , a.absorbed_by AS target
+             , ARRAY[a.archived_as, a.absorbed_by] AS path
+             , p.balance AS amount
+          FROM absorptions a
+          JOIN participants p ON p.username = a.archived_as
+         WHERE p.balance > 0
+
+         UNION ALL
+
+        -- ... and follow it through any accounts that absorbed it since.
+
+        SELECT c.source, a.absorbed_by, c.path || a.absorbed_by, c.amount
+          FROM chains c
+          JOIN absorptions a ON a.archived_as = c.target
+         WHERE NOT a.absorbed_by = ANY(c.path)
+
+    ), settled AS (
+
+        SELECT c.*
+          FROM chains c
+         WHERE NOT EXISTS (SELECT 1 FROM absorptions a WHERE a.archived_as = c.target)
+           AND (%(absorbed_by)s IS NULL OR c.target = %(absorbed_by)s)
+
+    ), debited AS (
+
+        UPDATE participants p
+           SET balance = (balance - s.amount)
+          FROM settled s
+         WHERE p.username = s.source
+
+    ), credited AS (
+
+        UPDATE participants p
+           SET balance = (balance + x.amount)
+          FROM ( SELECT target, sum(amount) AS amount
+                   FROM settled
+               GROUP BY target
+               ) x
+         WHERE p.username = x.target
+
+    ), transferred AS (
+
+        INSERT INTO transfers (tipper, tippee, amount, context)
+             SELECT source, target, amount, 'take-over'
+               FROM settled
+
+    )
+    SELECT source, target, path, amount
+      FROM settled
+  ORDER BY source
+
+"""
+
+
+def take_over_balances(cursor, absorbed_by=None):
+    """Move the balances of archived accounts to the ends of their absorption chains.
+
+    :param cursor: a :py:class:`~postgres.cursors.SimpleCursorBase`; the
+        caller owns the transaction
+    :param unicode absorbed_by: only settle chains that end at this username
+
+    :returns: a list of :py:class:`Chain` records, one per archived account
+        we took money out of, with the ``path`` of usernames the money
+        followed
+
+    """
+    return [Chain(*c) for c in cursor.all(TAKE_OVER_BALANCES, dict(absorbed_by=absorbed_by))]
@@ -9,8 +9,10 @@ import braintree
 
 from aspen import log
 from aspen.utils import typecheck
+from gratipay.billing import braintree_executor
 from gratipay.exceptions import NegativeBalance, NotWhitelisted
 from gratipay.models.exchange_route import ExchangeRoute
+from gratipay.models.participant.summary import ParticipantSummary
 
 
 # Balanced has a $0.50 minimum. We go even higher to avoid onerous
@@ -76,7 +78,7 @@ def create_card_hold(db, participant, amount):
     error = ""
     ref = None
     try:
-        result = braintree.Transaction.sale({
+        result = braintree_executor.call_once(braintree.Transaction.sale, {
             'amount': str(cents/100.0),
             'customer_id': route.participant.braintree_customer_id,
             'payment_method_token': route.address,
@@ -128,7 +130,10 @@ def capture_card_hold(db, participant, amount, hold):
 
     error = ''
     try:
-        result = braintree.Transaction.submit_for_settlement(ref, str(cents/100.00))
+        result = braintree_executor.call( braintree.Transaction.submit_for_settlement
+                                        , ref
+                                        , str(cents/100.00)
+                                         )
         assert result.is_success
         if result.transaction.status != 'submitted_for_settlement':
             error = result.transaction.status
@@ -146,7 +151,7 @@ def capture_card_hold(db, participant, amount, hold):
 def cancel_card_hold(hold):
     """Cancel the previously created hold on the participant's credit card.
     """
-    result = braintree.Transaction.void(hold.id)
+    result = braintree_executor.call(braintree.Transaction.void, hold.id)
     assert result.is_success
 
     amount = hold.amount
@@ -184,7 +189,7 @@ def _prep_hit(unrounded):
 
 def get_ready_payout_routes_by_network(db, network):
     hack = db.all("""
-        SELECT p.*::participants, r.*::exchange_routes
+        SELECT p.id, r.*::exchange_routes
           FROM participants p
           JOIN current_exchange_routes r ON p.id = r.participant
          WHERE p.balance > 0
@@ -223,9 +228,11 @@ def get_ready_payout_routes_by_network(db, network):
     """, (network,))
 
     # Work around lack of proper nesting in postgres.orm.
+    ids = [participant_id for participant_id, route in hack]
+    participants = {p.id: p for p in ParticipantSummary.load(db, ids, 'payout')}
     out = []
-    for participant, route in hack:
-        route.__dict__['participant'] = participant
+    for participant_id, route in hack:
+        route.__dict__['participant'] = participants[participant_id]
         out.append(route)
 
     return out
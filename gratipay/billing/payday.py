@@ -4,32 +4,89 @@ Exchanges (moving money between Gratipay and the outside world) and transfers
 (moving money amongst Gratipay users) happen within an isolated event called
 payday. This event has duration (it's not punctiliar).
 
-Payday is designed to be crash-resistant. Everything that can be rolled back
-happens inside a single DB transaction. Exchanges cannot be rolled back, so they
-immediately affect the participant's balance.
+Payday is designed to be crash-resistant. Payin is split into steps, each of
+which happens inside a single DB transaction that also checkpoints it, so a
+crashed payday resumes after the last completed step. Exchanges cannot be
+rolled back, so they immediately affect the participant's balance.
 
 """
-from __future__ import unicode_literals
+from __future__ import print_function, unicode_literals
 
+import json
 import os
-import itertools
+import time
+from contextlib import contextmanager
 
 import braintree
 
 import aspen.utils
 from aspen import log
+from gratipay.billing import braintree_executor
+from gratipay.billing.absorptions import take_over_balances
 from gratipay.billing.exchanges import (
     cancel_card_hold, capture_card_hold, create_card_hold, upcharge, MINIMUM_CHARGE,
 )
+from gratipay.billing.simulation import SELECT_TAKES, Simulation
 from gratipay.exceptions import NegativeBalance
 from gratipay.models import check_db
-from gratipay.utils.threaded_map import threaded_map
 
 
 with open(os.path.join(os.path.dirname(__file__), '../../sql/payday.sql')) as f:
     PAYDAY = f.read()
 
 
+#: The ways we know how to move money around inside the payday transaction.
+#: The ``trigger`` engine fires the triggers defined in ``sql/payday.sql`` once
+#: per row; the ``set-based`` engine drops those triggers and computes the same
+#: results with a handful of statements over whole tables.
+ENGINES = ('trigger', 'set-based')
+
+DROP_PAYDAY_TRIGGERS = """
+    DROP TRIGGER process_payment_instruction ON payday_payment_instructions;
+    DROP TRIGGER process_take ON payday_takes;
+    DROP TRIGGER process_draw ON payday_teams;
+"""
+
+
+#: The steps of :py:meth:`Payday.payin`, in order. Each one is checkpointed in
+#: the ``paydays`` row when it commits.
+PAYIN_STEPS = ( 'prepared', 'holds_created', 'instructions_processed', 'takes_processed'
+              , 'holds_settled', 'balances_updated'
+               )
+
+
+#: How many card holds :py:meth:`Payday.fetch_card_holds` fetches per call
+#: (Braintree's own page size for search results).
+CARD_HOLDS_PAGE_SIZE = 50
+
+
+def _search_transaction_ids(*query):
+    """Return the ids of the Braintree transactions that match ``query``.
+
+    This is one API call; Braintree only loads the transactions themselves
+    when we iterate over the results (see :py:func:`_fetch_transactions`).
+
+    """
+    results = braintree.Transaction.search(*query)
+    try:
+        return list(results.ids)
+    except AttributeError:  # our version of the SDK keeps them to itself
+        return list(results._ResourceCollection__ids)
+
+
+def _fetch_transactions(ids, *query):
+    """Return the Braintree transactions with the given ids that still match
+    ``query``, as a list.
+    """
+    results = braintree.Transaction.search(braintree.TransactionSearch.ids.in_list(ids), *query)
+    return list(results.items)
+
+
+#: Everything :py:meth:`Payday.measure` records in ``payday_metrics``, in the
+#: order payday runs it.
+MEASURED_STAGES = PAYIN_STEPS + ('take_over_balances', 'update_stats', 'notify_participants')
+
+
 class NoPayday(Exception):
     __str__ = lambda self: "No payday found where one was expected."
 
@@ -46,24 +103,35 @@ class Payday(object):
 
         run
             payin
-                prepare
-                create_card_holds
-                process_payment_instructions
-                process_takes
+                prepare                         # prepared
+                create_card_holds               # holds_created
+                process_payment_instructions    # instructions_processed
+                process_takes                   # takes_processed
                 process_remainder
-                settle_card_holds
-                update_balances
+                settle_card_holds               # holds_settled
+                update_balances                 # balances_updated
                 take_over_balances
             update_stats
             end
 
+    The money moving parts of payin (process_payment_instructions,
+    process_takes, and process_remainder) are implemented by one of the
+    :py:data:`ENGINES`, chosen per run. The comments above name the
+    :py:data:`PAYIN_STEPS`, which are checkpointed as they complete.
+
     """
 
+    engine = 'trigger'
 
-    def __init__(self, runner):
+
+    def __init__(self, runner, engine=None):
         self.runner = runner
         self.app = runner.app
         self.db = runner.app.db
+        if engine is not None:
+            if engine not in ENGINES:
+                raise ValueError("Unknown payday engine: {}.".format(engine))
+            self.engine = engine
 
 
     def run(self):
@@ -78,16 +146,19 @@ class Payday(object):
 
         _start = aspen.utils.utcnow()
         log("Greetings, program! It's PAYDAY!!!!")
+        log("Using the {} engine.".format(self.engine))
 
         if self.stage < 1:
             self.payin()
             self.mark_stage_done()
         if self.stage < 2:
-            self.update_stats()
+            with self.measure('update_stats'):
+                self.update_stats()
             self.mark_stage_done()
 
         self.end()
-        self.notify_participants()
+        with self.measure('notify_participants') as metrics:
+            metrics['nrows'] = self.notify_participants()
 
         _end = aspen.utils.utcnow()
         _delta = _end - _start
@@ -98,53 +169,224 @@ class Payday(object):
     def payin(self):
         """The first stage of payday where we charge credit cards and transfer
         money internally between participants.
+
+        Payin is broken into the :py:data:`PAYIN_STEPS`. Each step runs in its
+        own transaction, which also records the step (and how long it took) in
+        the ``checkpoints`` column of the ``paydays`` row. The ``payday_*``
+        tables are regular tables, so if we crash we pick up after the last
+        step that committed, instead of starting over from :py:meth:`prepare`.
+
         """
-        with self.db.get_cursor() as cursor:
+        self.checkpoints = self.db.one( "SELECT checkpoints FROM paydays WHERE id=%s"
+                                      , (self.id,)
+                                      , default=NoPayday
+                                       )
+        if self.checkpoints:
+            log("Resuming payin after {}.".format(', '.join(
+                step for step in PAYIN_STEPS if step in self.checkpoints
+            )))
+            engine = self.checkpoints.get('prepared', {}).get('engine')
+            if engine and engine != self.engine:
+                log("Switching to the {} engine, which prepared the DB.".format(engine))
+                self.engine = engine
+
+        # Each step returns the number of rows it worked on, for measure.
+        holds = [None]
+        def prepare(cursor):
             self.prepare(cursor)
-            holds = self.create_card_holds(cursor)
+            return cursor.one("SELECT count(*) FROM payday_payment_instructions")
+        def create_card_holds(cursor):
+            holds[0] = self.create_card_holds(cursor)
+            return len(holds[0])
+        def process_payment_instructions(cursor):
             self.process_payment_instructions(cursor)
+            return cursor.one("SELECT count(*) FROM payday_payments")
+        def process_takes(cursor):
             self.process_takes(cursor, self.ts_start)
             self.process_remainder(cursor)
-            _payments_for_debugging = cursor.all("""
-                SELECT * FROM payments WHERE "timestamp" > %s
-            """, (self.ts_start,))
-            try:
-                self.settle_card_holds(cursor, holds)
-                self.update_balances(cursor)
-                check_db(cursor)
-            except:
-                # Dump payments for debugging
-                import csv
-                from time import time
-                with open('%s_payments.csv' % time(), 'wb') as f:
-                    csv.writer(f).writerows(_payments_for_debugging)
-                raise
-        self.take_over_balances()
+            return cursor.one("""
+                SELECT count(*) FROM payday_payments WHERE direction='to-participant'
+            """)
+        def settle_card_holds(cursor):
+            if holds[0] is None:
+                holds[0] = self.refetch_card_holds(cursor)
+            nholds = len(holds[0])
+            self.settle_card_holds(cursor, holds[0])
+            return nholds
+        def update_balances(cursor):
+            nparticipants = self.update_balances(cursor)
+            self.record_facts(cursor)
+            check_db(cursor)
+            return nparticipants
+
+        self.checkpoint('prepared', prepare, engine=self.engine)
+        self.checkpoint('holds_created', create_card_holds)
+        self.checkpoint('instructions_processed', process_payment_instructions)
+        self.checkpoint('takes_processed', process_takes)
+        _payments_for_debugging = self.db.all("""
+            SELECT * FROM payments WHERE "timestamp" > %s
+        """, (self.ts_start,))
+        try:
+            self.checkpoint('holds_settled', settle_card_holds)
+            self.checkpoint('balances_updated', update_balances)
+        except:
+            # Dump payments for debugging
+            import csv
+            with open('%s_payments.csv' % time.time(), 'wb') as f:
+                csv.writer(f).writerows(_payments_for_debugging)
+            raise
+        with self.measure('take_over_balances') as metrics:
+            metrics['nrows'] = self.take_over_balances()
+
+
+    def checkpoint(self, step, func, **extra):
+        """Run ``func(cursor)`` and record ``step`` as done, in one transaction.
+
+        If ``step`` is already recorded in :py:attr:`checkpoints` we skip it.
+        Any ``extra`` keyword arguments are stored alongside the timing.
 
+        """
+        if step in self.checkpoints:
+            return
+        start = time.time()
+        with self.measure(step) as metrics:
+            with self.db.get_cursor() as cursor:
+                metrics['nrows'] = func(cursor)
+                extra['seconds'] = round(time.time() - start, 3)
+                cursor.run("""
+                    UPDATE paydays
+                       SET checkpoints = checkpoints || jsonb_build_object(%s, %s::jsonb)
+                     WHERE id = %s
+                """, (step, json.dumps(extra), self.id))
+        self.checkpoints[step] = extra
+        log("Checkpoint: {} ({:.1f}s).".format(step, extra['seconds']))
+
+
+    @contextmanager
+    def measure(self, stage):
+        """Measure a stage of payday, and record it in ``payday_metrics``.
+
+        The block gets a :py:class:`dict` in which to store ``nrows``, the
+        number of rows it worked on. We count the Braintree calls and retries
+        made during the block ourselves. If the block raises, nothing is
+        recorded. We also print the metrics as ``measure#`` and ``count#``
+        lines if ``LOG_METRICS`` is on.
 
-    @staticmethod
-    def prepare(cursor):
+        """
+        metrics = {'nrows': None}
+        ncalls, nretries = braintree_executor.ncalls, braintree_executor.nretries
+        start = time.time()
+        yield metrics
+        metrics['seconds'] = time.time() - start
+        metrics['nbraintree_calls'] = max(braintree_executor.ncalls - ncalls, 0)
+        metrics['nbraintree_retries'] = max(braintree_executor.nretries - nretries, 0)
+        self.db.run("""
+            INSERT INTO payday_metrics
+                        (payday, stage, seconds, nrows, nbraintree_calls, nbraintree_retries)
+                 VALUES (%(payday)s, %(stage)s, %(seconds)s, %(nrows)s, %(nbraintree_calls)s
+                       , %(nbraintree_retries)s)
+            ON CONFLICT (payday, stage) DO UPDATE
+                    SET ts = now()
+                      , seconds = excluded.seconds
+                      , nrows = excluded.nrows
+                      , nbraintree_calls = excluded.nbraintree_calls
+                      , nbraintree_retries = excluded.nbraintree_retries
+        """, dict(metrics, payday=self.id, stage=stage))
+        if self.app.env.log_metrics:
+            prefix = 'payday_' + stage
+            print("measure#{}={}ms".format(prefix, metrics['seconds'] * 1000))
+            for name in ('nrows', 'nbraintree_calls', 'nbraintree_retries'):
+                if metrics[name] is not None:
+                    print("count#{}_{}={}".format(prefix, name[1:], metrics[name]))
+
+
+    def refetch_card_holds(self, cursor):
+        """Fetch the card holds that a previous run of payin created.
+        """
+        participant_ids = set(cursor.all("""
+            SELECT id FROM payday_participants WHERE card_hold_ok
+        """))
+        if not participant_ids:
+            return {}
+        return self.fetch_card_holds(participant_ids)
+
+
+    def prepare(self, cursor):
         """Prepare the DB: we need temporary tables with indexes and triggers.
         """
         cursor.run(PAYDAY)
+        if self.engine == 'set-based':
+            cursor.run(DROP_PAYDAY_TRIGGERS)
         log('Prepared the DB.')
 
 
+    def simulate(self, cursor):
+        """Work out what payin would do, without doing it.
+
+        :param cursor: a cursor whose transaction the caller will roll back
+        :returns: a report :py:class:`dict` from :py:meth:`Simulation.report`
+
+        We build the ``payday_*`` tables as usual, load them into memory once,
+        and run the rest of payin in Python. Braintree is not contacted.
+
+        """
+        self.prepare(cursor)
+        report = Simulation.load(cursor, self.ts_start).run()
+        log("Dry run: {npayments} payments from {nusers} participants to {nteams} teams, "
+            "totaling ${volume}.".format(**report))
+        log("Dry run: {nholds} card holds totaling ${hold_total}, {ncaptures} captures "
+            "totaling ${capture_total}.".format(**report))
+        log("Dry run: {} new or increased dues totaling ${}.".format( len(report['dues'])
+                                                                    , sum(report['dues'].values())
+                                                                     ))
+        log("Dry run: {} balances would change.".format(len(report['deltas'])))
+        for username in report['negative_balances']:
+            log("Dry run: NegativeBalance for {}!".format(username))
+        return report
+
+
     @staticmethod
     def fetch_card_holds(participant_ids):
+        """Return a dict of existing card holds, keyed by participant id.
+
+        We search Braintree for the ids of the holds, and then fetch the holds
+        a page at a time, each page through the executor. We index the holds
+        we want as we go, and cancel the ones we don't want on the executor's
+        threads while we're still fetching later pages. If we find more than
+        one hold for a participant we keep the biggest.
+
+        """
         log('Fetching card holds.')
+        authorized = braintree.TransactionSearch.status == 'authorized'
+        ids = braintree_executor.call(_search_transaction_ids, authorized)
         holds = {}
-        existing_holds = braintree.Transaction.search(
-            braintree.TransactionSearch.status == 'authorized'
-        )
-        for hold in existing_holds.items:
-            log_amount = hold.amount
-            p_id = int(hold.custom_fields['participant_id'])
-            if p_id in participant_ids:
-                log('Reusing a ${:.2f} hold for {}.'.format(log_amount, p_id))
-                holds[p_id] = hold
-            else:
-                cancel_card_hold(hold)
+        canceled = []
+        def cancel(hold):
+            cancel_card_hold(hold)
+            canceled.append(hold.id)  # list.append is atomic
+        cancellations = braintree_executor.batch(cancel)
+        try:
+            with cancellations:
+                for i in range(0, len(ids), CARD_HOLDS_PAGE_SIZE):
+                    page = braintree_executor.call( _fetch_transactions
+                                                  , ids[i:i+CARD_HOLDS_PAGE_SIZE]
+                                                  , authorized
+                                                   )
+                    for hold in page:
+                        p_id = int(hold.custom_fields['participant_id'])
+                        if p_id not in participant_ids:
+                            cancellations.put(hold)
+                            continue
+                        if p_id in holds:
+                            if holds[p_id].amount >= hold.amount:
+                                cancellations.put(hold)
+                                continue
+                            cancellations.put(holds[p_id])
+                        log('Reusing a ${:.2f} hold for {}.'.format(hold.amount, p_id))
+                        holds[p_id] = hold
+        finally:
+            log('Found {} card holds to reuse, canceled {} of {}.'.format(
+                len(holds), len(canceled), cancellations.nput))
         return holds
 
 
@@ -187,7 +429,8 @@ class Payday(object):
                     return 1
                 else:
                     holds[p.id] = hold
-        threaded_map(f, participants)
+        braintree_executor.map(f, participants)
+        braintree_executor.log_stats()
 
         # Update the values of card_hold_ok in our temporary table
         if not holds:
@@ -201,54 +444,238 @@ class Payday(object):
         return holds
 
 
-    @staticmethod
-    def process_payment_instructions(cursor):
+    def process_payment_instructions(self, cursor):
         """Trigger the process_payment_instructions function for each row in
         payday_payment_instructions.
         """
         log("Processing payment instructions.")
-        cursor.run("UPDATE payday_payment_instructions SET is_funded=true;")
+        if self.engine == 'set-based':
+            self._fund_payment_instructions(cursor)
+        else:
+            cursor.run("UPDATE payday_payment_instructions SET is_funded=true;")
 
 
-    @staticmethod
-    def process_takes(cursor, ts_start):
+    def process_takes(self, cursor, ts_start):
         log("Processing takes.")
-        cursor.run("""
+        cursor.run("UPDATE payday_teams SET available_today = LEAST(available, balance)")
+        cursor.run("INSERT INTO payday_takes " + SELECT_TAKES, dict(ts_start=ts_start))
+        if self.engine == 'set-based':
+            self._pay_takes(cursor)
 
-        UPDATE payday_teams SET available_today = LEAST(available, balance);
-
-        INSERT INTO payday_takes
-             SELECT team_id, participant_id, amount
-               FROM ( SELECT DISTINCT ON (team_id, participant_id)
-                             team_id, participant_id, amount, ctime
-                        FROM takes
-                       WHERE mtime < %(ts_start)s
-                    ORDER BY team_id, participant_id, mtime DESC
-                    ) t
-              WHERE t.amount > 0
-                AND t.team_id IN (SELECT id FROM payday_teams)
-                AND t.participant_id IN (SELECT id FROM payday_participants)
-                AND ( SELECT ppd.id
-                        FROM payday_payments_done ppd
-                        JOIN participants ON participants.id = t.participant_id
-                        JOIN teams ON teams.id = t.team_id
-                       WHERE participants.username = ppd.participant
-                         AND teams.slug = ppd.team
-                         AND direction = 'to-participant'
-                    ) IS NULL
-           ORDER BY t.team_id, t.amount ASC;
-
-        """, dict(ts_start=ts_start))
 
-
-    @staticmethod
-    def process_remainder(cursor):
+    def process_remainder(self, cursor):
         """Send whatever remains after processing takes to the team owner.
         """
         log("Processing remainder.")
+        if self.engine == 'set-based':
+            self._pay_remainders(cursor)
+        else:
+            cursor.run("UPDATE payday_teams SET is_drained=true;")
+
+
+    # Set-based engine
+    # ================
+    # These mirror the pay, park, and process_* functions in sql/payday.sql,
+    # but work on all rows at once. Within each participant, payment
+    # instructions are funded in the same order the trigger engine uses, so
+    # that a participant without a card hold pays for as many instructions as
+    # their balance covers, skipping the ones it doesn't.
+    # Their working tables only live as long as the step's transaction, so
+    # nobody's funding data outlasts payday.
+
+    def _fund_payment_instructions(self, cursor):
+        cursor.run("""
+
+        DROP TABLE IF EXISTS payday_funding;
+        CREATE TEMP TABLE payday_funding ON COMMIT DROP AS
+            SELECT id, ord, participant_id, team_id, (amount + due) AS amount
+                 , row_number() OVER (PARTITION BY participant_id ORDER BY ord) AS rank
+                 , NULL::boolean AS is_funded
+              FROM payday_payment_instructions;
+
+        CREATE UNIQUE INDEX ON payday_funding (id);
+        CREATE UNIQUE INDEX ON payday_funding (participant_id, rank);
+
+        WITH RECURSIVE funding AS (
+
+            -- The first instruction is checked against the starting balance ...
+
+            SELECT f.id, f.participant_id, f.rank, p.card_hold_ok
+                 , (f.amount <= p.new_balance OR p.card_hold_ok) AS is_funded
+                 , CASE WHEN (f.amount <= p.new_balance OR p.card_hold_ok)
+                        THEN p.new_balance - f.amount
+                        ELSE p.new_balance
+                    END::numeric AS balance_after
+              FROM payday_funding f
+              JOIN payday_participants p ON p.id = f.participant_id
+             WHERE f.rank = 1
+
+             UNION ALL
+
+            -- ... and each one after that against what's left.
+
+            SELECT f.id, f.participant_id, f.rank, prev.card_hold_ok
+                 , (f.amount <= prev.balance_after OR prev.card_hold_ok)
+                 , CASE WHEN (f.amount <= prev.balance_after OR prev.card_hold_ok)
+                        THEN prev.balance_after - f.amount
+                        ELSE prev.balance_after
+                    END::numeric
+              FROM funding prev
+              JOIN payday_funding f ON f.participant_id = prev.participant_id
+                                   AND f.rank = prev.rank + 1
+
+        )
+        UPDATE payday_funding f
+           SET is_funded = COALESCE(funding.is_funded, false)
+          FROM funding
+         WHERE f.id = funding.id;
+
+        UPDATE payday_payment_instructions i
+           SET is_funded = true
+          FROM payday_funding f
+         WHERE f.id = i.id
+           AND f.is_funded;
+
+        -- Park what we couldn't fund for participants with a working card.
+
+        UPDATE current_payment_instructions cpi
+           SET due = f.amount
+          FROM payday_funding f
+          JOIN payday_participants p ON p.id = f.participant_id
+         WHERE cpi.participant_id = f.participant_id
+           AND cpi.team_id = f.team_id
+           AND NOT f.is_funded
+           AND p.has_credit_card
+           AND f.amount <> 0;
+
+        INSERT INTO events (type, payload)
+             SELECT 'payday'
+                  , ( CASE WHEN f.is_funded
+                           THEN '{"action":"pay","participant_id":"' || f.participant_id
+                                || '", "team_id":"' || f.team_id || '", "amount":' || f.amount || '}'
+                           ELSE '{"action":"due","participant_id":"' || f.participant_id
+                                || '", "team_id":"' || f.team_id || '", "due":' || f.amount || '}'
+                       END )::json
+               FROM payday_funding f
+               JOIN payday_participants p ON p.id = f.participant_id
+              WHERE f.amount <> 0
+                AND (f.is_funded OR p.has_credit_card)
+           ORDER BY f.ord;
+
+        """)
+        self._pay(cursor, "(SELECT * FROM payday_funding WHERE is_funded)", 'to-team')
+
+
+    def _pay_takes(self, cursor):
+        cursor.run("""
+
+        DROP TABLE IF EXISTS payday_take_payments;
+        CREATE TEMP TABLE payday_take_payments ON COMMIT DROP AS
+            SELECT row_number() OVER (ORDER BY team_id, ord) AS ord
+                 , team_id, participant_id, amount
+              FROM ( SELECT t.team_id, t.participant_id
+                          , row_number() OVER w AS ord
+                          , LEAST( t.amount
+                                 , GREATEST(pt.available_today - (sum(t.amount) OVER w - t.amount), 0)
+                                  ) AS amount
+                       FROM payday_takes t
+                       JOIN payday_teams pt ON pt.id = t.team_id
+                     WINDOW w AS ( PARTITION BY t.team_id
+                                   ORDER BY t.amount ASC, t.participant_id ASC
+                                   ROWS UNBOUNDED PRECEDING
+                                  )
+                   ) takes
+             WHERE amount > 0;
+
+        UPDATE payday_teams t
+           SET available_today = (available_today - x.amount)
+          FROM ( SELECT team_id, sum(amount) AS amount
+                   FROM payday_take_payments
+               GROUP BY team_id
+               ) x
+         WHERE t.id = x.team_id;
+
+        """)
+        self._pay(cursor, "payday_take_payments", 'to-participant')
+
+
+    def _pay_remainders(self, cursor):
+        cursor.run("""
+
+        DROP TABLE IF EXISTS payday_draws;
+        CREATE TEMP TABLE payday_draws ON COMMIT DROP AS
+            SELECT row_number() OVER (ORDER BY t.id) AS ord
+                 , (SELECT id FROM participants WHERE username=t.owner) AS participant_id
+                 , t.id AS team_id
+                 , t.balance AS amount
+              FROM payday_teams t
+             WHERE t.is_drained IS NOT true
+               AND t.balance <> 0;
+
+        """)
+        self._pay(cursor, "payday_draws", 'to-participant')
         cursor.run("UPDATE payday_teams SET is_drained=true;")
 
 
+    @staticmethod
+    def _pay(cursor, payments, direction):
+        """Record and apply many payments at once, like ``pay()`` does for one.
+
+        :param cursor: a cursor inside the payday transaction
+        :param unicode payments: a table (or subquery) with ``ord``,
+            ``participant_id``, ``team_id``, and ``amount`` columns
+        :param unicode direction: ``to-team`` or ``to-participant``
+
+        """
+        sign = '-' if direction == 'to-team' else '+'
+        cursor.run("""
+
+        UPDATE payday_participants p
+           SET new_balance = (new_balance {sign} x.amount)
+          FROM ( SELECT participant_id, sum(amount) AS amount
+                   FROM {payments} payments
+               GROUP BY participant_id
+               ) x
+         WHERE p.id = x.participant_id;
+
+        UPDATE payday_teams t
+           SET balance = (balance {opposite} x.amount)
+          FROM ( SELECT team_id, sum(amount) AS amount
+                   FROM {payments} payments
+               GROUP BY team_id
+               ) x
+         WHERE t.id = x.team_id;
+
+        UPDATE current_payment_instructions cpi
+           SET due = 0
+          FROM {payments} x
+         WHERE cpi.participant_id = x.participant_id
+           AND cpi.team_id = x.team_id
+           AND cpi.due > 0
+           AND x.amount <> 0;
+
+        INSERT INTO payday_payments
+                    (participant, team, amount, direction)
+             SELECT ( SELECT p.username
+                        FROM participants p
+                        JOIN payday_participants p2 ON p.id = p2.id
+                       WHERE p2.id = x.participant_id )
+                  , ( SELECT t.slug
+                        FROM teams t
+                        JOIN payday_teams t2 ON t.id = t2.id
+                       WHERE t2.id = x.team_id )
+                  , x.amount
+                  , %(direction)s
+               FROM {payments} x
+              WHERE x.amount <> 0
+           ORDER BY x.ord;
+
+        """.format( payments=payments
+                  , sign=sign
+                  , opposite='+' if sign == '-' else '-'
+                   ), dict(direction=direction))
+
+
     def settle_card_holds(self, cursor, holds):
         log("Settling card holds.")
         participants = cursor.all("""
@@ -263,13 +690,14 @@ class Payday(object):
         def capture(p):
             amount = -p.new_balance
             capture_card_hold(self.db, p, amount, holds.pop(p.id))
-        threaded_map(capture, participants)
+        braintree_executor.map(capture, participants)
         log("Captured %i card holds." % len(participants))
 
         log("Canceling card holds.")
         # Cancel the remaining holds
-        threaded_map(cancel_card_hold, holds.values())
+        braintree_executor.map(cancel_card_hold, holds.values())
         log("Canceled %i card holds." % len(holds))
+        braintree_executor.log_stats()
 
 
     @staticmethod
@@ -303,107 +731,78 @@ class Payday(object):
         """)
 
         log("Updated the balances of %i participants." % len(participants))
+        return len(participants)
 
 
-    def take_over_balances(self):
-        """If an account that receives money is taken over during payin we need
-        to transfer the balance to the absorbing account.
-        """
-        log("Taking over balances.")
-        for i in itertools.count():
-            if i > 10:
-                raise Exception('possible infinite loop')
-            count = self.db.one("""
+    @staticmethod
+    def record_facts(cursor):
+        """Record who paid and who owes whom during this payday, in ``payday_facts``.
 
-                DROP TABLE IF EXISTS temp;
-                CREATE TEMPORARY TABLE temp AS
-                    SELECT archived_as, absorbed_by, balance AS archived_balance
-                      FROM absorptions a
-                      JOIN participants p ON a.archived_as = p.username
-                     WHERE balance > 0;
+        These are the facts that :py:meth:`update_stats` summarizes: the
+        payments we're about to commit, plus the payment instructions we
+        parked as dues for participants whose card is still working.
 
-                SELECT count(*) FROM temp;
+        """
+        cursor.run("""
 
-            """)
-            if not count:
-                break
-            self.db.run("""
+            INSERT INTO payday_facts (payday, participant_id, team_id, amount, direction)
+                 SELECT current_payday_id(), p.id, t.id, pp.amount, pp.direction
+                   FROM payday_payments pp
+                   JOIN participants p ON p.username = pp.participant
+                   JOIN teams t ON t.slug = pp.team;
+
+            INSERT INTO payday_facts (payday, participant_id, team_id, amount, direction, is_due)
+                 SELECT current_payday_id(), i.participant_id, i.team_id, (i.amount + i.due)
+                      , 'to-team', true
+                   FROM payday_payment_instructions i
+                   JOIN payday_participants p ON p.id = i.participant_id
+                  WHERE i.is_funded IS NOT true
+                    AND p.has_credit_card
+                    AND ( SELECT count(*)
+                            FROM current_exchange_routes r
+                           WHERE r.participant = i.participant_id
+                             AND network = 'braintree-cc'
+                             AND error = ''
+                        ) > 0;
+
+        """)
 
-                INSERT INTO transfers (tipper, tippee, amount, context)
-                    SELECT archived_as, absorbed_by, archived_balance, 'take-over'
-                      FROM temp;
 
-                UPDATE participants
-                   SET balance = (balance - archived_balance)
-                  FROM temp
-                 WHERE username = archived_as;
+    def take_over_balances(self):
+        """If an account that receives money is taken over during payin we need
+        to transfer the balance to the absorbing account.
 
-                UPDATE participants
-                   SET balance = (balance + archived_balance)
-                  FROM temp
-                 WHERE username = absorbed_by;
+        See :py:mod:`gratipay.billing.absorptions`. Returns the number of
+        archived accounts we took money out of.
 
-            """)
+        """
+        log("Taking over balances.")
+        with self.db.get_cursor() as cursor:
+            chains = take_over_balances(cursor)
+        for chain in chains:
+            log("Took over ${} along {}.".format(chain.amount, ' -> '.join(chain.path)))
+        return len(chains)
 
 
     def update_stats(self):
+        """Summarize this payday's ``payday_facts`` in its ``paydays`` row.
+        """
         log("Updating stats.")
         self.db.run("""
 
-          WITH payments_and_dues AS (
-
-              -- Participants who have either received/given money
-
-              SELECT p.id as participant_id
-                   , t.id as team_id
-                   , amount
-                   , direction
-                FROM payments
-                JOIN participants p ON p.username = payments.participant
-                JOIN teams t ON t.slug = payments.team
-               WHERE payday = %(payday)s
-
-              UNION
-
-              -- Participants who weren't charged due to amount + due < MINIMUM_CHARGE
-
-              SELECT (payload->>'participant_id')::bigint AS participant_id
-                   , (payload->>'team_id')::bigint AS team_id
-                   , '0' AS amount
-                   , 'to-team' AS direction
-                FROM events
-               WHERE (
-                      (SELECT ts_end FROM paydays WHERE id = %(payday)s) = '1970-01-01T00:00:00+00'::timestamptz
-
-                      OR
-
-                      ts < (SELECT ts_end FROM paydays WHERE id = %(payday)s)
-                    )
-                 AND ts > (SELECT ts_start FROM paydays WHERE id = %(payday)s)
-                 AND type='payday'
-                 AND payload->>'action' IN ('due')
-
-                 -- Filter out participants with bad CCs
-
-                 AND (
-                   SELECT COUNT(*)
-                     FROM current_exchange_routes r
-                     JOIN participants p ON p.id = r.participant
-                    WHERE p.id = (payload->>'participant_id')::bigint
-                      AND network = 'braintree-cc'
-                      AND error = ''
-                 ) > 0
-          )
-
           UPDATE paydays p
              SET nusers = (
-                  SELECT COUNT(DISTINCT(participant_id)) FROM payments_and_dues
+                  SELECT COUNT(DISTINCT(participant_id)) FROM payday_facts WHERE payday = p.id
                  )
                , nteams = (
-                  SELECT COUNT(DISTINCT(team_id)) FROM payments_and_dues
+                  SELECT COUNT(DISTINCT(team_id)) FROM payday_facts WHERE payday = p.id
                  )
                , volume = (
-                  SELECT COALESCE(sum(amount), 0) FROM payments_and_dues WHERE direction='to-team'
+                  SELECT COALESCE(sum(amount), 0)
+                    FROM payday_facts
+                   WHERE payday = p.id
+                     AND direction = 'to-team'
+                     AND NOT is_due
                  )
            WHERE id=%(payday)s
 
@@ -423,6 +822,13 @@ class Payday(object):
 
 
     def notify_participants(self):
+        """Queue an email for each participant we charged (or failed to charge).
+
+        We look up how many teams each participant gives to, and their top
+        team, for everyone in a single query, and then queue all of the
+        messages with :py:meth:`~gratipay.email.Queue.put_many`.
+
+        """
         log("Notifying participants.")
         ts_start, ts_end = self.ts_start, self.ts_end
         exchanges = self.db.all("""
@@ -434,51 +840,53 @@ class Payday(object):
                AND amount > 0
                AND p.notify_charge > 0
         """, locals())
+        notify = []
         for e in exchanges:
             if e.status not in ('failed', 'succeeded'):
                 log('exchange %s has an unexpected status: %s' % (e.id, e.status))
                 continue
             i = 1 if e.status == 'failed' else 2
-            p = e.participant
-            if p.notify_charge & i == 0:
+            if e.participant.notify_charge & i == 0:
                 continue
-            participant_id = p.id
-            nteams, top_team = self.db.one("""
-                WITH tippees AS (
-                         SELECT t.slug, amount
-                           FROM ( SELECT DISTINCT ON (team_id) team_id, amount
-                                    FROM payment_instructions
-                                   WHERE mtime < %(ts_start)s
-                                     AND participant_id = %(participant_id)s
-                                ORDER BY team_id, mtime DESC
-                                ) s
-                           JOIN teams t ON s.team_id = t.id
-                           JOIN participants p ON t.owner = p.username
-                          WHERE s.amount > 0
-                            AND t.is_approved IS true
-                            AND t.is_closed IS NOT true
-                            AND (SELECT count(*)
-                                   FROM current_exchange_routes er
-                                  WHERE er.participant = p.id
-                                    AND network = 'paypal'
-                                    AND error = ''
-                                ) > 0
-                     )
-                SELECT ( SELECT count(*) FROM tippees ) AS nteams
-                     , ( SELECT slug
-                           FROM tippees
-                       ORDER BY amount DESC
-                          LIMIT 1
-                       ) AS top_team
-            """, locals())
-            self.app.email_queue.put(
-                p,
-                'charge_'+e.status,
-                exchange=dict(id=e.id, amount=e.amount, fee=e.fee, note=e.note),
-                nteams=nteams,
-                top_team=top_team,
-                _user_initiated=False
-            )
+            notify.append(e)
+        if not notify:
+            return 0
+
+        participant_ids = list(set(e.participant.id for e in notify))
+        tippees = dict((r.participant_id, r) for r in self.db.all("""
+            SELECT s.participant_id
+                 , count(*) AS nteams
+                 , (array_agg(t.slug ORDER BY s.amount DESC, t.slug))[1] AS top_team
+              FROM ( SELECT DISTINCT ON (participant_id, team_id)
+                            participant_id, team_id, amount
+                       FROM payment_instructions
+                      WHERE mtime < %(ts_start)s
+                        AND participant_id = ANY(%(participant_ids)s)
+                   ORDER BY participant_id, team_id, mtime DESC
+                   ) s
+              JOIN teams t ON s.team_id = t.id
+              JOIN participants p ON t.owner = p.username
+             WHERE s.amount > 0
+               AND t.is_approved IS true
+               AND t.is_closed IS NOT true
+               AND (SELECT count(*)
+                      FROM current_exchange_routes er
+                     WHERE er.participant = p.id
+                       AND network = 'paypal'
+                       AND error = ''
+                   ) > 0
+          GROUP BY s.participant_id
+        """, locals()))
+
+        def messages():
+            for e in notify:
+                t = tippees.get(e.participant.id)
+                yield e.participant, 'charge_'+e.status, dict(
+                    exchange=dict(id=e.id, amount=e.amount, fee=e.fee, note=e.note),
+                    nteams=t.nteams if t else 0,
+                    top_team=t.top_team if t else None,
+                )
+        return self.app.email_queue.put_many(messages())
 
 
     def mark_stage_done(self):
@@ -490,3 +898,70 @@ class Payday(object):
          RETURNING id
 
         """, default=NoPayday)
+
+
+def backfill_facts(db, payday_ids=None):
+    """Compute ``payday_facts`` for paydays from before we recorded them.
+
+    :param db: a :py:class:`~gratipay.models.GratipayDB`
+    :param list payday_ids: the paydays to backfill; defaults to all finished
+        paydays without any facts
+
+    We reconstruct facts the way ``update_stats`` used to compute stats: from
+    the ``payments`` table, and from the ``due`` events logged during the
+    payday for participants whose card is working now. Each payday is
+    backfilled in its own transaction, replacing any facts it already has.
+
+    :returns: the number of paydays backfilled
+
+    """
+    if payday_ids is None:
+        payday_ids = db.all("""
+            SELECT id
+              FROM paydays p
+             WHERE ts_end > ts_start
+               AND NOT EXISTS (SELECT 1 FROM payday_facts f WHERE f.payday = p.id)
+          ORDER BY id
+        """)
+    for payday_id in payday_ids:
+        with db.get_cursor() as cursor:
+            cursor.run("DELETE FROM payday_facts WHERE payday = %s", (payday_id,))
+            nfacts = cursor.one("""
+
+              WITH payday AS ( SELECT * FROM paydays WHERE id = %(payday)s )
+                 , inserted AS (
+                      INSERT INTO payday_facts (payday, participant_id, team_id, amount, direction)
+                           SELECT %(payday)s, p.id, t.id, amount, direction
+                             FROM payments
+                             JOIN participants p ON p.username = payments.participant
+                             JOIN teams t ON t.slug = payments.team
+                            WHERE payday = %(payday)s
+                        RETURNING 1
+                   )
+                 , inserted_dues AS (
+                      INSERT INTO payday_facts
+                                  (payday, participant_id, team_id, amount, direction, is_due)
+                           SELECT %(payday)s
+                                , (payload->>'participant_id')::bigint
+                                , (payload->>'team_id')::bigint
+                                , (payload->>'due')::numeric
+                                , 'to-team'
+                                , true
+                             FROM events
+                            WHERE ts > (SELECT ts_start FROM payday)
+                              AND ts < (SELECT ts_end FROM payday)
+                              AND type='payday'
+                              AND payload->>'action' = 'due'
+                              AND ( SELECT COUNT(*)
+                                      FROM current_exchange_routes r
+                                     WHERE r.participant = (payload->>'participant_id')::bigint
+                                       AND network = 'braintree-cc'
+                                       AND error = ''
+                                  ) > 0
+                        RETURNING 1
+                   )
+              SELECT (SELECT count(*) FROM inserted) + (SELECT count(*) FROM inserted_dues)
+
+            """, dict(payday=payday_id))
+        log("Backfilled {} facts for payday {}.".format(nfacts, payday_id))
+    return len(payday_ids)
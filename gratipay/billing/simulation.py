@@ -0,0 +1,241 @@
+"""Simulate payday in memory.
+
+The :py:class:`Simulation` class loads what payday would work on (the
+``payday_*`` tables built by ``sql/payday.sql``, plus takes) into plain Python
+structures once, and then replays the funding, takes, and remainder algorithm
+in Python. Nothing is written to the database, and Braintree is not contacted:
+we assume that every card hold we would try to create succeeds.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import namedtuple
+from decimal import Decimal
+
+from gratipay.billing.exchanges import MINIMUM_CHARGE, _prep_hit, upcharge
+
+
+ZERO = Decimal('0.00')
+
+Instruction = namedtuple('Instruction', 'participant_id team_id amount')
+Take = namedtuple('Take', 'team_id participant_id amount')
+Payment = namedtuple('Payment', 'participant_id team_id amount direction')
+
+
+#: The takes payday pays out, in the order it pays them: the latest take of
+#: each member as of ``%(ts_start)s``, skipping any that a crashed payday
+#: already paid. :py:meth:`Payday.process_takes` and :py:meth:`Simulation.load`
+#: both use this, so that a dry run agrees with a resumed payday.
+SELECT_TAKES = """
+    SELECT team_id, participant_id, amount
+      FROM ( SELECT DISTINCT ON (team_id, participant_id)
+                    team_id, participant_id, amount
+               FROM takes
+              WHERE mtime < %(ts_start)s
+           ORDER BY team_id, participant_id, mtime DESC
+           ) t
+     WHERE t.amount > 0
+       AND t.team_id IN (SELECT id FROM payday_teams)
+       AND t.participant_id IN (SELECT id FROM payday_participants)
+       AND ( SELECT ppd.id
+               FROM payday_payments_done ppd
+               JOIN participants ON participants.id = t.participant_id
+               JOIN teams ON teams.id = t.team_id
+              WHERE participants.username = ppd.participant
+                AND teams.slug = ppd.team
+                AND direction = 'to-participant'
+           ) IS NULL
+  ORDER BY t.team_id, t.amount ASC, t.participant_id ASC
+"""
+
+
+class _Participant(object):
+    __slots__ = ( 'id', 'username', 'old_balance', 'new_balance', 'giving_today'
+                , 'has_credit_card', 'is_suspicious', 'card_hold_ok'
+                 )
+
+    def __init__(self, id, username, old_balance, giving_today, has_credit_card, is_suspicious):
+        self.id = id
+        self.username = username
+        self.old_balance = self.new_balance = old_balance
+        self.giving_today = giving_today
+        self.has_credit_card = has_credit_card
+        self.is_suspicious = is_suspicious
+        self.card_hold_ok = False
+
+
+class _Team(object):
+    __slots__ = ('id', 'slug', 'owner_id', 'available', 'balance', 'available_today')
+
+    def __init__(self, id, slug, owner_id, available):
+        self.id = id
+        self.slug = slug
+        self.owner_id = owner_id
+        self.available = available
+        self.balance = self.available_today = ZERO
+
+
+class Simulation(object):
+    """Represent one in-memory run of payin.
+
+    :param participants: an iterable of records like ``payday_participants``
+    :param teams: an iterable of records like ``payday_teams``, with an
+        additional ``owner_id``
+    :param instructions: an iterable of :py:class:`Instruction`, in the order
+        payday processes them (``amount`` includes ``due``)
+    :param takes: an iterable of :py:class:`Take`, in the order payday
+        processes them
+
+    """
+
+    def __init__(self, participants, teams, instructions, takes):
+        self.participants = {}
+        for p in participants:
+            self.participants[p.id] = _Participant( p.id, p.username, p.old_balance
+                                                  , p.giving_today, p.has_credit_card
+                                                  , p.is_suspicious
+                                                   )
+        self.teams = {}
+        for t in teams:
+            self.teams[t.id] = _Team(t.id, t.slug, t.owner_id, t.available)
+        self.instructions = list(instructions)
+        self.takes = list(takes)
+
+        self.payments = []
+        self.dues = {}
+        self.holds = {}
+        self.captures = {}
+
+
+    @classmethod
+    def load(cls, cursor, ts_start):
+        """Load a simulation from the ``payday_*`` tables.
+
+        :param cursor: a cursor on which :py:meth:`Payday.prepare` has run
+        :param datetime ts_start: the start of the current payday
+
+        """
+        participants = cursor.all("""
+            SELECT id, username, old_balance, giving_today, has_credit_card, is_suspicious
+              FROM payday_participants
+        """)
+        teams = cursor.all("""
+            SELECT id, slug, available
+                 , (SELECT id FROM participants WHERE username=t.owner) AS owner_id
+              FROM payday_teams t
+        """)
+        instructions = cursor.all("""
+            SELECT participant_id, team_id, (amount + due) AS amount
+              FROM payday_payment_instructions
+          ORDER BY ord
+        """)
+        takes = cursor.all(SELECT_TAKES, dict(ts_start=ts_start))
+        return cls( participants
+                  , teams
+                  , (Instruction(*i) for i in instructions)
+                  , (Take(*t) for t in takes)
+                   )
+
+
+    def run(self):
+        """Run through payin, and return a report :py:class:`dict`.
+        """
+        self.create_card_holds()
+        self.process_payment_instructions()
+        self.process_takes()
+        self.process_remainder()
+        self.settle_card_holds()
+        return self.report()
+
+
+    def pay(self, participant_id, team_id, amount, direction):
+        if amount == 0:
+            return
+        if direction == 'to-team':
+            participant_delta, team_delta = -amount, amount
+        else:
+            participant_delta, team_delta = amount, -amount
+        participant = self.participants.get(participant_id)
+        if participant is not None:
+            participant.new_balance += participant_delta
+        self.teams[team_id].balance += team_delta
+        if self.dues.get((participant_id, team_id), ZERO) > 0:
+            self.dues[(participant_id, team_id)] = ZERO
+        self.payments.append(Payment(participant_id, team_id, amount, direction))
+
+
+    def create_card_holds(self):
+        for p in self.participants.values():
+            if p.old_balance < p.giving_today and p.has_credit_card and p.is_suspicious is False:
+                amount = p.giving_today - p.old_balance
+                if amount >= MINIMUM_CHARGE:
+                    self.holds[p.id] = upcharge(amount)[0]
+                    p.card_hold_ok = True
+
+
+    def process_payment_instructions(self):
+        for i in self.instructions:
+            participant = self.participants[i.participant_id]
+            if i.amount <= participant.new_balance or participant.card_hold_ok:
+                self.pay(i.participant_id, i.team_id, i.amount, 'to-team')
+            elif participant.has_credit_card and i.amount != 0:
+                self.dues[(i.participant_id, i.team_id)] = i.amount
+
+
+    def process_takes(self):
+        for team in self.teams.values():
+            team.available_today = min(team.available, team.balance)
+        for take in self.takes:
+            team = self.teams[take.team_id]
+            amount = min(take.amount, team.available_today)
+            if amount > 0:
+                team.available_today -= amount
+                self.pay(take.participant_id, take.team_id, amount, 'to-participant')
+
+
+    def process_remainder(self):
+        for team in sorted(self.teams.values(), key=lambda t: t.id):
+            self.pay(team.owner_id, team.id, team.balance, 'to-participant')
+
+
+    def settle_card_holds(self):
+        for p_id in self.holds:
+            participant = self.participants[p_id]
+            if participant.new_balance < 0:
+                cents, amount_str, charge_amount, fee = _prep_hit(-participant.new_balance)
+                self.captures[p_id] = (charge_amount, fee)
+
+
+    def report(self):
+        """Summarize what payday would do.
+        """
+        deltas, negative_balances = {}, []
+        for p in self.participants.values():
+            charge_amount, fee = self.captures.get(p.id, (ZERO, ZERO))
+            credited = charge_amount - fee
+            delta = p.new_balance - p.old_balance
+            if delta or credited:
+                deltas[p.id] = delta + credited
+            before = p.old_balance + credited
+            after = before + delta
+            if delta and after < 0 and after < before:
+                negative_balances.append(p.username)
+
+        username = lambda p_id: getattr(self.participants.get(p_id), 'username', None)
+        payments = [ (username(p.participant_id), self.teams[p.team_id].slug, p.amount, p.direction)
+                     for p in self.payments
+                    ]
+        to_team = [p for p in self.payments if p.direction == 'to-team']
+        return dict( payments=payments
+                   , npayments=len(to_team)
+                   , volume=sum((p.amount for p in to_team), ZERO)
+                   , nusers=len(set(p.participant_id for p in to_team))
+                   , nteams=len(set(p.team_id for p in to_team))
+                   , dues=dict((k, v) for k, v in self.dues.items() if v > 0)
+                   , nholds=len(self.holds)
+                   , hold_total=sum(self.holds.values(), ZERO)
+                   , ncaptures=len(self.captures)
+                   , capture_total=sum((c[0] for c in self.captures.values()), ZERO)
+                   , deltas=deltas
+                   , negative_balances=sorted(negative_balances)
+                    )
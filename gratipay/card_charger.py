@@ -6,6 +6,8 @@ import random
 import braintree
 from decimal import Decimal as D
 
+from gratipay.billing import braintree_executor
+
 
 class CardCharger(object):
 
@@ -26,7 +28,7 @@ class Braintree(object):
     def charge(self, params):
         """Charge using the Braintree APi, returning a result.
         """
-        return braintree.Transaction.sale(params)
+        return braintree_executor.call_once(braintree.Transaction.sale, params)
 
 
 # Offline
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import json
+import sys
+
+from aspen import log
+from gratipay.application import Application
+from gratipay.billing import braintree_executor
+from gratipay.testing import payday_benchmark
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='benchmark-payday')
+    parser.add_argument('--sizes', default=','.join(map(str, payday_benchmark.SIZES)),
+                        help="comma-separated numbers of payment instructions")
+    parser.add_argument('--engine', help="the payday engine to run")
+    parser.add_argument('--per-giver', type=int, default=5,
+                        help="how many teams each giver gives to")
+    parser.add_argument('--output', default='payday-benchmark.json',
+                        help="where to write the report")
+    parser.add_argument('--compare', metavar='REPORT',
+                        help="a report from an earlier run to compare against")
+    return parser.parse_args(argv)
+
+
+def main(_argv=sys.argv, _print=print):
+    """This function is installed via an entrypoint in ``setup.py`` as
+    ``benchmark-payday``.
+
+    Usage::
+
+      benchmark-payday [--sizes=10000,100000,1000000] [--engine=ENGINE]
+                       [--per-giver=5] [--output=FILE] [--compare=REPORT]
+
+    We run payin once for each population size, against a fake Braintree, and
+    write the per-stage timings to ``--output`` as JSON (see
+    :py:mod:`gratipay.testing.payday_benchmark`). With ``--compare`` we also
+    print how the timings changed since an earlier report.
+
+    **This wipes the database.** Run it with a ``DATABASE_URL`` that points
+    at a scratch database.
+
+    """
+    args = parse_args(_argv[1:])
+    log('Instantiating Application from gratipay.cli.benchmark_payday')
+    app = Application()
+
+    # The fake Braintree doesn't need protecting, and we want to measure
+    # payday, not our rate limit.
+    braintree_executor.configure(rate=0, timeout=0, log_every=0)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    report = payday_benchmark.benchmark(app, sizes, args.engine, per_giver=args.per_giver)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    log("Wrote {}.".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for line in payday_benchmark.compare(old, report):
+            _print(line)
@@ -11,9 +11,8 @@ def main(_argv=sys.argv, _input=raw_input):
     """This is a script to flush the email queue.
 
     In production we have a thread inside the main web process that sends
-    emails according to the FLUSH_EMAIL_QUEUE_EVERY envvar. This script is more
-    for development, though when we're ready to move to a separate worker
-    process/dyno we can start with this.
+    emails according to the FLUSH_EMAIL_QUEUE_EVERY envvar, or a separate
+    ``email-worker`` process. This script is more for development.
 
     """
     log('Instantiating Application from gratipay.cli.dequeue_emails')
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import signal
+import sys
+
+from aspen import log
+from gratipay import email
+from gratipay.application import Application
+
+
+def main(_argv=sys.argv, _print=print):
+    """This function is installed via an entrypoint in ``setup.py`` as
+    ``email-worker``.
+
+    Usage::
+
+      email-worker
+
+    We send queued emails as soon as they're queued, until we get ``SIGTERM``
+    or ``SIGINT``, and then we finish the batch we're on and exit (see
+    :py:class:`gratipay.email.Worker`). Set ``EMAIL_QUEUE_FLUSH_EVERY=0`` for
+    the web processes once this is running, so they stop flushing the queue
+    themselves.
+
+    """
+    log('Instantiating Application from gratipay.cli.email_worker')
+    app = Application()
+    env = app.env
+    worker = email.Worker( app.email_queue
+                         , poll_every=env.email_worker_poll_every
+                         , heartbeat_every=env.email_worker_heartbeat_every
+                         , _print=_print
+                          )
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    log('Waiting for email.')
+    worker.run()
+    log('Stopped.')
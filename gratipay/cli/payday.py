@@ -1,14 +1,40 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import sys
+
 from aspen import log
 from gratipay.application import Application
+from gratipay.billing.payday import backfill_facts
+
+
+def main(_argv=sys.argv):
+    """This function is installed via an entrypoint in ``setup.py`` as
+    ``payday``.
+
+    Usage::
+
+      payday [--dry-run | --backfill-facts]
+
+    With ``--dry-run`` we load payday's data into memory, report the payments,
+    dues, card holds, and balance changes that payday would make, and exit
+    without writing anything.
 
+    With ``--backfill-facts`` we compute ``payday_facts`` for past paydays
+    that don't have any (see :py:func:`gratipay.billing.payday.backfill_facts`)
+    and exit.
 
-def main():
+    """
     try:
         log('Instantiating Application from gratipay.cli.payday')
-        Application().payday_runner.run_payday()
+        app = Application()
+        runner = app.payday_runner
+        if '--dry-run' in _argv[1:]:
+            runner.simulate_payday()
+        elif '--backfill-facts' in _argv[1:]:
+            backfill_facts(app.db)
+        else:
+            runner.run_payday()
     except KeyboardInterrupt:
         pass
     except:
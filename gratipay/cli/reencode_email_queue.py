@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+
+from aspen import log
+from gratipay.application import Application
+
+
+def main(_argv=sys.argv, _print=print):
+    """This is a script to re-encode the contexts of queued email messages.
+
+    We used to pickle message contexts. Now they're written with the
+    serializer named by the EMAIL_QUEUE_CONTEXT_FORMAT envvar, and old pickles
+    are still read, but it's quicker to flush the queue once the backlog has
+    been re-encoded. Run this after deploying, or after changing the envvar.
+    It's safe to run while the queue is being flushed.
+
+    """
+    log('Instantiating Application from gratipay.cli.reencode_email_queue')
+    queue = Application().email_queue
+    nreencoded, nskipped = queue.reencode_pending()
+    _print("Re-encoded {} queued message(s) as {}.".format(nreencoded, queue.serializer.name))
+    if nskipped:
+        _print("Left {} message(s) that {} can't encode.".format(nskipped, queue.serializer.name))
@@ -3,32 +3,61 @@
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import sys
 import time
 
 from aspen import log
 
 from gratipay import wireup
-from gratipay.sync_npm import consume_change_stream, get_last_seq, production_change_stream
+from gratipay.sync_npm import Pipeline, get_last_seq, import_dump, production_change_stream
 from gratipay.utils import sentry
+from gratipay.utils.lru import LRU
 
 
-def main():
+def main(_argv=sys.argv):
     """This function is installed via an entrypoint in ``setup.py`` as
     ``sync-npm``.
 
     Usage::
 
-      sync-npm
+      sync-npm [--import FILE]
+
+    We read from the registry on one thread and write to the db on another
+    (see :py:class:`gratipay.sync_npm.Pipeline`), with up to
+    ``NPM_SYNC_QUEUE_SIZE`` changes in between. We write changes in batches of
+    up to ``NPM_SYNC_BATCH_SIZE``, or every ``NPM_SYNC_FLUSH_EVERY``
+    milliseconds, and print metrics every ``NPM_SYNC_LOG_METRICS_EVERY``
+    seconds. We remember what we wrote for the last
+    ``NPM_SYNC_FINGERPRINT_CACHE_SIZE`` packages, so that we can skip changes
+    that don't affect them.
+
+    With ``--import`` we load a newline-delimited JSON dump of registry docs
+    instead, and exit (see :py:func:`gratipay.sync_npm.import_dump`). Run
+    ``sync-npm`` again afterwards to follow the change stream from the dump's
+    ``update_seq``.
 
     """
     env = wireup.env()
     db = wireup.db(env)
+    if '--import' in _argv[1:]:
+        filename = _argv[_argv.index('--import') + 1]
+        with open(filename) as f:
+            n = import_dump(f, db)
+        log("Imported {} packages from {}, as of seq {}.".format(n, filename, get_last_seq(db)))
+        return
+    fingerprints = LRU(env.npm_sync_fingerprint_cache_size)
     while 1:
         with sentry.teller(env):
             last_seq = get_last_seq(db)
             log("Picking up with npm sync at {}.".format(last_seq))
             stream = production_change_stream(last_seq)
-            consume_change_stream(stream, db)
+            Pipeline( stream, db
+                    , queue_size=env.npm_sync_queue_size
+                    , log_every=env.npm_sync_log_metrics_every
+                    , batch_size=env.npm_sync_batch_size
+                    , flush_every=env.npm_sync_flush_every
+                    , fingerprints=fingerprints
+                     ).run()
         try:
             last_seq = get_last_seq(db)
             sleep_for = 60
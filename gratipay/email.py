@@ -2,11 +2,15 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
-import pickle
+import select
 import sys
-from time import sleep
+import threading
+import time
+import traceback
+from collections import namedtuple
 
 import boto3
+import psycopg2
 from aspen import log_dammit
 from aspen.simplates.pagination import parse_specline, split_and_escape
 from aspen_jinja2_renderer import SimplateLoader
@@ -15,7 +19,17 @@ from markupsafe import escape as htmlescape
 
 from gratipay.exceptions import NoEmailAddress, Throttled
 from gratipay.models.participant import Participant
-from gratipay.utils import find_files, i18n
+from gratipay.utils import find_files, i18n, serializers
+from gratipay.utils.executor import Executor
+
+
+#: The outcome of trying to send one message: ``result`` and
+#: ``remote_message_id`` are what we store in ``email_messages``, and
+#: ``exc_info`` is set if we failed.
+SendResult = namedtuple('SendResult', 'id result remote_message_id exc_info nqueries')
+
+#: The channel we ``NOTIFY`` when messages are queued (see :py:class:`Worker`).
+CHANNEL = 'email_queue'
 
 
 class Queue(object):
@@ -36,18 +50,28 @@ class Queue(object):
 
         self.db = db
         self.tell_sentry = tell_sentry
-        self.sleep_for = env.email_queue_sleep_for
+        self.batch_size = env.email_queue_batch_size
+        self.executor = Executor( 'email'
+                                , concurrency=env.email_queue_concurrency
+                                , rate=env.email_queue_send_rate
+                                 )
         self.allow_up_to = env.email_queue_allow_up_to
+        self.claim_timeout = env.email_queue_claim_timeout
         self.log_every = env.email_queue_log_metrics_every
+        self.serializer = serializers.get_serializer(env.email_queue_context_format)
+        self._flush_stats_lock = threading.Lock()
+        self.nflushed = self.nflush_queries = 0
 
         templates = {}
         templates_dir = os.path.join(root, 'emails')
         assert os.path.isdir(templates_dir)
+        layout = read_email_spt(os.path.join(templates_dir, 'base.spt'))
         i = len(templates_dir) + 1
         for spt in find_files(templates_dir, '*.spt'):
             base_name = spt[i:-4]
-            templates[base_name] = compile_email_spt(spt)
+            templates[base_name] = compile_email_spt(spt, layout)
         self._email_templates = templates
+        self._helpers = {}
 
 
     def _have_ses(self, env):
@@ -91,7 +115,8 @@ class Queue(object):
                              context,
                              user_initiated)
                      VALUES (%s, %s, %s, %s, %s)
-            """, (participant_id, email, template, pickle.dumps(context), _user_initiated))
+            """, (participant_id, email, template, self._dumps(context), _user_initiated))
+            cursor.run("NOTIFY " + CHANNEL)
 
             if _user_initiated:
                 nqueued = self._get_nqueued(cursor, to, email)
@@ -99,6 +124,89 @@ class Queue(object):
                     raise Throttled()
 
 
+    def put_many(self, messages, batch_size=1000):
+        """Put many system-initiated email messages on the queue at once.
+
+        :param messages: an iterable of ``(to, template, context)`` tuples,
+            with the same meanings as the arguments to :py:meth:`put`
+        :param int batch_size: the most rows to insert per statement
+
+        System-initiated messages aren't throttled, so instead of a round trip
+        per message we insert them with multi-row ``INSERT`` statements, all
+        in one transaction.
+
+        :returns: the number of messages queued
+
+        """
+        rows = [ (to.id, template, self._dumps(context), False)
+                 for to, template, context in messages
+                ]
+        with self.db.get_cursor() as cursor:
+            for i in range(0, len(rows), batch_size):
+                values = b', '.join( cursor.mogrify(b'(%s, %s, %s, %s)', row)
+                                     for row in rows[i:i+batch_size]
+                                    )
+                cursor.run(b"""
+                    INSERT INTO email_messages
+                                (participant, spt_name, context, user_initiated)
+                         VALUES """ + values)
+            if rows:
+                cursor.run("NOTIFY " + CHANNEL)
+        return len(rows)
+
+
+    def _dumps(self, context):
+        return psycopg2.Binary(serializers.dumps(context, self.serializer))
+
+
+    def reencode_pending(self, batch_size=1000):
+        """Re-encode the context of queued messages that weren't written with
+        our current serializer (older ones are pickles).
+
+        We work in batches, skipping messages that a flush has claimed, so
+        this is safe to run while the queue is being flushed. Contexts that
+        our serializer can't handle are left as they are.
+
+        :returns: a ``(nreencoded, nskipped)`` tuple
+
+        """
+        nreencoded = 0
+        skipped = []
+        while True:
+            with self.db.get_cursor() as cursor:
+                messages = cursor.all("""
+                    SELECT id, context
+                      FROM email_messages
+                     WHERE result is null
+                       AND claimed is null
+                       AND get_byte(context, 0) <> %s
+                       AND id <> ALL(%s::int[])
+                  ORDER BY id
+                     LIMIT %s
+                       FOR UPDATE SKIP LOCKED
+                """, (ord(self.serializer.version), skipped, batch_size))
+                if not messages:
+                    break
+                rows = []
+                for id, context in messages:
+                    try:
+                        rows.append((id, self._dumps(serializers.loads(context))))
+                    except (TypeError, ValueError):
+                        skipped.append(id)
+                if rows:
+                    values = b', '.join( cursor.mogrify(b'(%s::int, %s::bytea)', row)
+                                         for row in rows
+                                        )
+                    cursor.run(b"""
+                        UPDATE email_messages m
+                           SET context = v.context
+                          FROM (VALUES """ + values + b""") v (id, context)
+                         WHERE m.id = v.id
+                    """)
+                nreencoded += len(rows)
+        return nreencoded, len(skipped)
+
+
     def _get_nqueued(self, cursor, participant, email_address):
         """Returns the number of messages already queued for the given
         participant or email address. Prefers participant if provided, falls
@@ -111,6 +219,11 @@ class Queue(object):
             for.
 
         :returns number of queued messages
+
+        We run this on every user-initiated :py:meth:`put`, so both queries are
+        answered from partial indexes that only cover pending, user-initiated
+        messages. Throttling keeps those to a handful per recipient, so this
+        doesn't slow down as the history of sent messages grows.
         """
 
         if participant:
@@ -131,44 +244,142 @@ class Queue(object):
             """, (email_address, ))
 
 
-    def flush(self):
+    def flush(self, stop=None):
         """Load messages queued for sending, and send them.
+
+        We work in batches of ``EMAIL_QUEUE_BATCH_SIZE`` messages. Each batch
+        is claimed (with ``FOR UPDATE SKIP LOCKED``, so several processes can
+        flush the queue at once) by setting ``claimed``, and that's committed
+        before we send anything. If we crash before storing the results, the
+        batch stays claimed rather than going back to pending: a message that
+        was lost beats one sent twice. Claims older than
+        ``EMAIL_QUEUE_CLAIM_TIMEOUT`` seconds are given up on as lost (see
+        :py:meth:`reap_lost_claims`) before we start. Messages in a batch are rendered and
+        sent on ``EMAIL_QUEUE_CONCURRENCY`` threads, at no more than
+        ``EMAIL_QUEUE_SEND_RATE`` messages per second overall (match it to the
+        SES sending quota), and the results are stored with one ``UPDATE``.
+        The participants for a batch are loaded with one query up front,
+        rather than one per message.
+
+        If sending a message fails, we record that as its result, finish the
+        batch, and then raise the first error (we want to see it in Sentry).
+
+        :param stop: a callable; if it returns true we stop between batches
+        :returns: the number of messages sent
+
         """
-        fetch_messages = lambda: self.db.all("""
-            SELECT *
-              FROM email_messages
-             WHERE result is null
-          ORDER BY ctime ASC
-             LIMIT 60
-        """)
+        self.reap_lost_claims()
         nsent = 0
-        while True:
-            messages = fetch_messages()
-            if not messages:
-                break
-            for rec in messages:
-                try:
-                    message = self._prepare_email_message_for_ses(rec)
-                    result = self._mailer.send_email(**message)
-                    remote_message_id = result['MessageId']  # let KeyErrors go to Sentry
-                except Exception as exc:
-                    self._store_result(rec.id, repr(exc), None)
-                    raise  # we want to see this in Sentry
-                self._store_result(rec.id, '', remote_message_id)
-                nsent += 1
-                sleep(self.sleep_for)
+        while not (stop and stop()):
+            nqueries = self.db.nqueries
+            with self.db.get_cursor() as cursor:
+                messages = cursor.all("""
+                    UPDATE email_messages
+                       SET claimed = now()
+                     WHERE id IN ( SELECT id
+                                     FROM email_messages
+                                    WHERE result is null
+                                      AND claimed is null
+                                 ORDER BY ctime ASC
+                                    LIMIT %s
+                                      FOR UPDATE SKIP LOCKED
+                                  )
+                 RETURNING *
+                """, (self.batch_size,))
+                if not messages:
+                    break
+                messages.sort(key=lambda rec: (rec.ctime, rec.id))
+                participants = self._load_participants(cursor, messages)
+            send = lambda rec: self._send(rec, participants.get(rec.participant))
+            results = self.executor.map(send, messages)
+            with self.db.get_cursor() as cursor:
+                self._store_results(cursor, results)
+            nqueries = self.db.nqueries - nqueries + sum(r.nqueries for r in results)
+            self._count_flushed(len(results), nqueries)
+            nsent += sum(1 for r in results if not r.exc_info)
+            for r in results:
+                if r.exc_info:
+                    exc_type, exc_value, tb = r.exc_info
+                    raise exc_type, exc_value, tb
         return nsent
 
 
-    def _store_result(self, message_id, result, remote_message_id):
-        self.db.run("UPDATE email_messages SET result=%s, remote_message_id=%s "
-                    "WHERE id=%s", (result, remote_message_id, message_id))
+    def reap_lost_claims(self):
+        """Record messages that were claimed by a flush that never stored
+        their results (because it crashed, say) as lost.
+
+        We don't know whether those messages went out, so rather than risk
+        sending them twice we give up on them. Until we do they're still
+        pending, and count against their recipients' throttling.
+
+        :returns: the number of messages we gave up on
+
+        """
+        lost = self.db.all("""
+            UPDATE email_messages
+               SET result = 'lost: claimed at ' || claimed
+             WHERE result is null
+               AND claimed < now() - %s::interval
+         RETURNING id
+        """, ('{} seconds'.format(self.claim_timeout),))
+        if lost:
+            log_dammit("Gave up on {} email message(s) with stale claims.".format(len(lost)))
+        return len(lost)
+
+
+    def _load_participants(self, cursor, messages):
+        """Load the participants for a batch of messages, and return them in
+        a ``dict`` by id.
+        """
+        ids = list({rec.participant for rec in messages if rec.participant})
+        if not ids:
+            return {}
+        participants = cursor.all("""
+            SELECT p.*::participants FROM participants p WHERE id = ANY(%s)
+        """, (ids,))
+        return {p.id: p for p in participants}
+
+
+    def _count_flushed(self, nflushed, nqueries):
+        with self._flush_stats_lock:
+            self.nflushed += nflushed
+            self.nflush_queries += nqueries
+
+
+    def _send(self, rec, participant=None):
+        nqueries = self.db.nqueries
+        try:
+            message = self._prepare_email_message_for_ses(rec, participant)
+            result = self.executor.call(self._mailer.send_email, **message)
+            remote_message_id = result['MessageId']  # let KeyErrors go to Sentry
+        except Exception as exc:
+            return SendResult( rec.id, repr(exc), None, sys.exc_info()
+                             , self.db.nqueries - nqueries
+                              )
+        return SendResult(rec.id, '', remote_message_id, None, self.db.nqueries - nqueries)
+
+
+    def _store_results(self, cursor, results):
+        """Store many :py:class:`SendResult` records with one ``UPDATE``.
+        """
+        values = b', '.join( cursor.mogrify(b'(%s::int, %s::text, %s::text)', r[:3])
+                             for r in results
+                            )
+        cursor.run(b"""
+            UPDATE email_messages m
+               SET result = v.result
+                 , remote_message_id = v.remote_message_id
+              FROM (VALUES """ + values + b""") v (id, result, remote_message_id)
+             WHERE m.id = v.id
+        """)
 
 
-    def _prepare_email_message_for_ses(self, rec):
+    def _prepare_email_message_for_ses(self, rec, participant=None):
         """Prepare an email message for delivery via Amazon SES.
 
         :param Record rec: a database record from the ``email_messages`` table
+        :param Participant participant: the participant the message is for,
+            if the caller has already loaded it; otherwise we load it here
 
         :returns: ``dict`` if we can find an email address to send to
         :raises: ``NoEmailAddress`` if we can't find an email address to send to
@@ -179,9 +390,9 @@ class Queue(object):
         #. ``participant.email_address``.
 
         """
-        participant = Participant.from_id(rec.participant)
-        spt = self._email_templates[rec.spt_name]
-        context = pickle.loads(rec.context)
+        if participant is None and rec.participant:
+            participant = Participant.from_id(rec.participant)
+        context = serializers.loads(rec.context)
 
         email = rec.email_address or participant.email_address
 
@@ -208,15 +419,7 @@ class Queue(object):
         accept_lang = (participant and participant.email_lang) or 'en'
         langs = i18n.parse_accept_lang(accept_lang)
         locale = i18n.match_lang(langs)
-        i18n.add_helpers_to_context(self.tell_sentry, context, locale)
-        context['escape'] = lambda s: s
-        context_html = dict(context)
-        i18n.add_helpers_to_context(self.tell_sentry, context_html, locale)
-        context_html['escape'] = htmlescape
-        base_spt = self._email_templates['base']
-        def render(t, context):
-            b = base_spt[t].render(context).strip()
-            return b.replace('$body', spt[t].render(context).strip())
+        subject, text, html = self.render(rec.spt_name, context, locale)
 
         message = {}
         message['Source'] = 'Gratipay Support <support@gratipay.com>'
@@ -229,18 +432,48 @@ class Queue(object):
         message['Destination']['ToAddresses'] = [destination]
         message['Message'] = {}
         message['Message']['Subject'] = {}
-        message['Message']['Subject']['Data'] = spt['subject'].render(context).strip()
+        message['Message']['Subject']['Data'] = subject
         message['Message']['Body'] = {
             'Text': {
-                'Data': render('text/plain', context)
+                'Data': text
             },
             'Html': {
-                'Data': render('text/html', context_html)
+                'Data': html
             }
         }
         return message
 
 
+    def render(self, spt_name, context, locale):
+        """Render an email template, and return its subject, text, and HTML.
+
+        The text and HTML templates are already wrapped in the layout from
+        ``emails/base.spt`` (see :py:func:`compile_email_spt`), so each part
+        takes one render. The i18n helpers for each locale and content type
+        are made once, and reused.
+
+        """
+        spt = self._email_templates[spt_name]
+        rendered = []
+        for content_type in ('subject', 'text/plain', 'text/html'):
+            context_ = dict(context)
+            context_.update(self._get_helpers(locale, content_type))
+            rendered.append(spt[content_type].render(context_).strip())
+        return tuple(rendered)
+
+
+    def _get_helpers(self, locale, content_type):
+        escape = htmlescape if content_type == 'text/html' else lambda s: s
+        key = (str(locale), escape is htmlescape)
+        helpers = self._helpers.get(key)
+        if helpers is None:
+            helpers = {}
+            i18n.add_helpers_to_context(self.tell_sentry, helpers, locale)
+            helpers['escape'] = escape  # the helpers look it up here, so it's fixed for good
+            self._helpers[key] = helpers
+        return helpers
+
+
     def log_metrics(self, _print=print):
         stats = self.db.one("""
             SELECT count(CASE WHEN result = '' THEN 1 END)      AS sent
@@ -251,16 +484,113 @@ class Queue(object):
         """, ('{} seconds'.format(self.log_every),), back_as=dict)
         prefix = 'count#email_queue'
         variables = ('sent', 'failed', 'pending')
-        _print(' '.join('{}_{}={}'.format(prefix, v, stats[v]) for v in variables))
+        line = ' '.join('{}_{}={}'.format(prefix, v, stats[v]) for v in variables)
+        with self._flush_stats_lock:
+            nflushed, nqueries = self.nflushed, self.nflush_queries
+            self.nflushed = self.nflush_queries = 0
+        if nflushed:
+            # Should stay flat as batches grow; if it climbs, something in
+            # rendering or sending is querying per message again.
+            line += ' measure#email_queue_queries_per_message={:.2f}'.format(nqueries / nflushed)
+        _print(line)
+
+
+class Worker(object):
+    """Flush a :py:class:`Queue` as soon as messages are put on it.
+
+    :py:meth:`Queue.put` sends a ``NOTIFY`` on :py:data:`CHANNEL` when it
+    commits. We ``LISTEN`` on a connection of our own, and when we're woken we
+    flush the queue until it's empty. We also flush every ``poll_every``
+    seconds regardless, to pick up anything that was queued while we weren't
+    listening.
+
+    Every ``heartbeat_every`` seconds we print a heartbeat metric, with the
+    number of messages sent and the number of times we were woken since the
+    last one. Call :py:meth:`stop` (from a signal handler, say) to shut down
+    once the batch we're working on is done.
+
+    """
+
+    def __init__(self, queue, poll_every=60, heartbeat_every=60, _print=print, _time=time.time,
+                 _select=select.select):
+        self.queue = queue
+        self.poll_every = poll_every
+        self.heartbeat_every = heartbeat_every
+        self._print = _print
+        self._time = _time
+        self._select = _select
+        self.stopping = False
+        self.nsent = self.nwakeups = 0
+
+
+    def stop(self, *a):
+        self.stopping = True
+
+
+    def run(self):
+        """Listen and flush until we're stopped.
+        """
+        with self.queue.db.get_connection() as connection:
+            connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute("LISTEN " + CHANNEL)
+            try:
+                self._loop(connection)
+            finally:
+                cursor.execute("UNLISTEN " + CHANNEL)
+                connection.autocommit = False
+
+
+    def _loop(self, connection):
+        timeouts = [t for t in (self.poll_every, self.heartbeat_every) if t > 0]
+        timeout = min(timeouts) if timeouts else None
+        last_heartbeat = self._time()
+        while not self.stopping:
+            self.flush()
+            now = self._time()
+            if self.heartbeat_every > 0 and now - last_heartbeat >= self.heartbeat_every:
+                self.heartbeat()
+                last_heartbeat = now
+            if not self.stopping:
+                self.wait(connection, timeout)
+
+
+    def flush(self):
+        try:
+            self.nsent += self.queue.flush(stop=lambda: self.stopping)
+        except Exception as e:
+            self.queue.tell_sentry(e, {})
+            log_dammit(traceback.format_exc().strip())
+
+
+    def wait(self, connection, timeout):
+        """Wait up to ``timeout`` seconds for a notification.
+        """
+        try:
+            self._select([connection], [], [], timeout)
+        except select.error:
+            return  # interrupted by a signal; we'll check whether to stop
+        connection.poll()
+        if connection.notifies:
+            self.nwakeups += 1
+            del connection.notifies[:]
+
+
+    def heartbeat(self):
+        self._print('count#email_worker_heartbeat=1 count#email_worker_sent={} '
+                    'count#email_worker_wakeups={}'.format(self.nsent, self.nwakeups))
+        self.nsent = self.nwakeups = 0
 
 
 jinja_env = Environment()
 jinja_env_html = Environment(autoescape=True, extensions=['jinja2.ext.autoescape'])
 
-def compile_email_spt(fpath):
-    """Compile an email template from a simplate.
+def read_email_spt(fpath):
+    """Read the pages of an email simplate.
 
     :param unicode fpath: the filesystem path of the simplate
+    :returns: a ``dict`` of template sources, keyed by ``subject`` for the
+        first page and by content type for the others
 
     """
     r = {}
@@ -270,7 +600,26 @@ def compile_email_spt(fpath):
         tmpl = b'\n' * page.offset + page.content
         content_type, renderer = parse_specline(page.header)
         key = 'subject' if i == 1 else content_type
-        env = jinja_env_html if content_type == 'text/html' else jinja_env
+        r[key] = tmpl
+    return r
+
+
+def compile_email_spt(fpath, layout=None):
+    """Compile an email template from a simplate.
+
+    :param unicode fpath: the filesystem path of the simplate
+    :param dict layout: template sources from :py:func:`read_email_spt`; each
+        of our pages with the same key is put in place of ``$body`` in the
+        layout's page before compiling, so that one render gives us the whole
+        email
+
+    """
+    r = {}
+    for key, tmpl in read_email_spt(fpath).items():
+        if layout and b'$body' in layout.get(key, b''):
+            body = b'{% filter trim %}' + tmpl + b'{% endfilter %}'
+            tmpl = layout[key].replace(b'$body', body)
+        env = jinja_env_html if key == 'text/html' else jinja_env
         r[key] = SimplateLoader(fpath, tmpl).load(env, fpath)
     return r
 
@@ -6,9 +6,12 @@ the most important two. Participant, in particular, is at the center of
 everything on Gratipay.
 
 """
+import threading
+from collections import namedtuple
 from contextlib import contextmanager
 
 from postgres import Postgres
+from postgres.cursors import SimpleDictCursor, SimpleNamedTupleCursor, SimpleTupleCursor
 
 from .account_elsewhere import AccountElsewhere
 from .community import Community
@@ -29,6 +32,44 @@ def just_yield(obj):
     yield obj
 
 
+_counts = threading.local()
+
+
+class CountingMixin(object):
+    """Count the queries run on each thread (see :py:attr:`GratipayDB.nqueries`).
+    Mix this in ahead of one of postgres.py's cursor classes.
+    """
+
+    def execute(self, *a, **kw):
+        _counts.nqueries = getattr(_counts, 'nqueries', 0) + 1
+        return super(CountingMixin, self).execute(*a, **kw)
+
+    def executemany(self, *a, **kw):
+        _counts.nqueries = getattr(_counts, 'nqueries', 0) + 1
+        return super(CountingMixin, self).executemany(*a, **kw)
+
+
+class CountingCursor(CountingMixin, SimpleNamedTupleCursor):
+    """Our default cursor.
+    """
+
+class CountingTupleCursor(CountingMixin, SimpleTupleCursor):
+    pass
+
+class CountingDictCursor(CountingMixin, SimpleDictCursor):
+    pass
+
+
+#: The counting cursor for each value of ``back_as`` that postgres.py takes.
+COUNTING_CURSORS = { tuple: CountingTupleCursor
+                   , 'tuple': CountingTupleCursor
+                   , namedtuple: CountingCursor
+                   , 'namedtuple': CountingCursor
+                   , dict: CountingDictCursor
+                   , 'dict': CountingDictCursor
+                    }
+
+
 class GratipayDB(Postgres):
     """Model the Gratipay database.
     """
@@ -37,6 +78,7 @@ class GratipayDB(Postgres):
         """Extend to make the ``Application`` object available on models at
         ``.app``.
         """
+        kw.setdefault('cursor_factory', CountingCursor)
         Postgres.__init__(self, *a, **kw)
         for model in MODELS:
             self.register_model(model)
@@ -47,8 +89,21 @@ class GratipayDB(Postgres):
             if kw:
                 raise ValueError('cannot change options when reusing a cursor')
             return just_yield(cursor)
+        # Swap back_as for the counting cursor it stands for, so that run, one,
+        # and all count every query. (Cursors from get_connection don't count
+        # unless they're of the default type.)
+        if 'cursor_factory' not in kw and kw.get('back_as') in COUNTING_CURSORS:
+            kw['cursor_factory'] = COUNTING_CURSORS[kw.pop('back_as')]
         return super(GratipayDB, self).get_cursor(**kw)
 
+    @property
+    def nqueries(self):
+        """The number of queries run so far on the current thread. Take the
+        difference between two readings to count the queries a piece of code
+        makes.
+        """
+        return getattr(_counts, 'nqueries', 0)
+
     def self_check(self):
         with self.get_cursor() as cursor:
             check_db(cursor)
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
+from hashlib import md5
+
 from postgres.orm import Model
 
 from .emails import Emails
@@ -83,6 +86,17 @@ class Package(Model, Emails, Team):
                           )
 
 
+    @staticmethod
+    def fingerprint(description, emails):
+        """Return a hash of the parts of a package that we keep up to date
+        from npm, so that we can tell when an update wouldn't change anything.
+        We hash them as JSON, so that no two different packages can run
+        together into the same string.
+        """
+        encoded = json.dumps([description or '', sorted(emails)], separators=(',', ':'))
+        return md5(encoded.encode('utf8')).hexdigest()
+
+
     @classmethod
     def upsert(cls, package_manager, **kw):
         """Upsert a package. Required keyword arguments:
@@ -99,16 +113,88 @@ class Package(Model, Emails, Team):
 
         """
         cursor = kw.pop('cursor', cls.db)
+        kw['fingerprint'] = cls.fingerprint(kw['description'], kw['emails'])
         cursor.run('''
         INSERT INTO packages
-                    (package_manager, name, description, emails)
-             VALUES ('npm', %(name)s, %(description)s, %(emails)s)
+                    (package_manager, name, description, emails, fingerprint)
+             VALUES ('npm', %(name)s, %(description)s, %(emails)s, %(fingerprint)s)
 
         ON CONFLICT (package_manager, name) DO UPDATE
-                SET description=%(description)s, emails=%(emails)s
+                SET description=%(description)s, emails=%(emails)s, fingerprint=%(fingerprint)s
         ''', kw)
 
 
+    @classmethod
+    def upsert_many(cls, package_manager, packages, cursor=None):
+        """Upsert several packages with one statement.
+
+        :param packages: a list of dicts with the keyword arguments that
+            :py:meth:`upsert` takes; names must be unique within the list
+        :return: the number of packages inserted or changed; we don't touch
+            packages whose :py:meth:`fingerprint` is the same as before
+
+        """
+        if not packages:
+            return 0
+        with cls.db.get_cursor(cursor) as cursor:
+            values = b', '.join(cursor.mogrify( '(%s, %s, %s, %s, %s)'
+                                              , ( package_manager, p['name'], p['description']
+                                                , p['emails']
+                                                , cls.fingerprint(p['description'], p['emails'])
+                                                 )
+                                               ) for p in packages)
+            return len(cursor.all(b'''
+            INSERT INTO packages
+                        (package_manager, name, description, emails, fingerprint)
+                 VALUES ''' + values + b'''
+
+            ON CONFLICT (package_manager, name) DO UPDATE
+                    SET description=excluded.description
+                      , emails=excluded.emails
+                      , fingerprint=excluded.fingerprint
+                  WHERE packages.fingerprint IS DISTINCT FROM excluded.fingerprint
+              RETURNING id
+            '''))
+
+
+    @classmethod
+    def delete_many(cls, package_manager, names, cursor=None):
+        """Delete the packages with the given names, like :py:meth:`delete` does.
+
+        :return: the number of packages deleted; names we don't have are ignored
+
+        """
+        if not names:
+            return 0
+        with cls.db.get_cursor(cursor) as cursor:
+            return cls._delete_many(cursor, package_manager, list(names))
+
+
+    @classmethod
+    def _delete_many(cls, cursor, package_manager, names):
+        linked = cursor.all("""
+            SELECT tp.package_id, tp.team_id
+              FROM teams_to_packages tp
+              JOIN packages p ON p.id = tp.package_id
+             WHERE p.package_manager=%s AND p.name = ANY(%s)
+        """, (package_manager, names))
+        for package_id, team_id in linked:
+            cursor.run('DELETE FROM teams_to_packages WHERE package_id=%s', (package_id,))
+            cls.app.add_event( cursor
+                             , 'package'
+                             , dict(id=package_id, action='unlink', values=dict(team_id=team_id))
+                              )
+        cursor.run("""
+            DELETE FROM claims
+             WHERE package_id IN ( SELECT id FROM packages
+                                    WHERE package_manager=%s AND name = ANY(%s)
+                                  )
+        """, (package_manager, names))
+        return len(cursor.all("""
+            DELETE FROM packages WHERE package_manager=%s AND name = ANY(%s) RETURNING id
+        """, (package_manager, names)))
+
+
     def delete(self, cursor=None):
         """Delete the package, unlinking any team (the team itself lives on)
         and clearing any claim.
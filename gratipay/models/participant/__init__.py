@@ -11,6 +11,7 @@ from postgres.orm import Model
 from psycopg2 import IntegrityError
 
 import gratipay
+from gratipay.billing.absorptions import take_over_balances
 from gratipay.exceptions import (
     NotSane,
     UsernameIsEmpty,
@@ -141,6 +142,7 @@ class Participant(Model, Email, ExchangeRoutes, Identity, Packages):
                AND is_suspicious IS NOT true
         """, (new_token, expires, self.id))
         self.set_attributes(session_token=new_token, session_expires=expires)
+        self.forget_cached_session()
 
     def set_session_expires(self, expires):
         """Set ``session_expires`` to the given datetime.
@@ -153,6 +155,42 @@ class Participant(Model, Email, ExchangeRoutes, Identity, Packages):
                    , (expires, self.id,)
                     )
         self.set_attributes(session_expires=expires)
+        self.forget_cached_session()
+
+    def extend_session(self, expires, refresh):
+        """Set ``session_expires`` to the given datetime, unless it's already
+        within ``refresh`` (a timedelta) of it.
+
+        Concurrent requests in the same session all want to do this at about
+        the same time; the database decides which one gets to, so we write once
+        per ``refresh`` at most.
+
+        :database: One UPDATE, zero or one rows
+        :returns: whether we were the one to extend the session
+
+        """
+        extended = self.db.one("""
+            UPDATE participants
+               SET session_expires=%(expires)s
+             WHERE id=%(id)s
+               AND session_token=%(token)s
+               AND session_expires < %(due)s
+               AND is_suspicious IS NOT true
+         RETURNING session_expires
+        """, dict(expires=expires, id=self.id, token=self.session_token, due=expires - refresh))
+        if extended is None:
+            return False
+        self.set_attributes(session_expires=extended)
+        self.forget_cached_session()
+        return True
+
+    def forget_cached_session(self):
+        """Drop this participant from the
+        :py:class:`~gratipay.security.authentication.SessionCache`. Call this
+        after changing their session or standing.
+        """
+        from gratipay.security.authentication import session_cache  # dodge a circular import
+        session_cache.invalidate(self.id)
 
 
     # Suspiciousness
@@ -313,6 +351,7 @@ class Participant(Model, Email, ExchangeRoutes, Identity, Packages):
                         "WHERE username=%(username)s"
                       , dict(username=self.username, is_closed=is_closed)
                        )
+            self.forget_cached_session()
             self.app.add_event( cursor
                               , 'participant'
                               , dict(id=self.id, action='set', values=dict(is_closed=is_closed))
@@ -380,6 +419,7 @@ class Participant(Model, Email, ExchangeRoutes, Identity, Packages):
 
         """, dict(username=self.username, participant_id=self.id))
         self.set_attributes(**r._asdict())
+        self.forget_cached_session()
 
 
     # Notifications
@@ -948,6 +988,7 @@ class Participant(Model, Email, ExchangeRoutes, Identity, Packages):
                                                                    , old_username=self.username
                                                                     )
                                                        ))
+        self.forget_cached_session()
         return archived_as
 
 
@@ -1312,6 +1353,16 @@ class Participant(Model, Email, ExchangeRoutes, Identity, Packages):
                                          )
                                    )
 
+                # Take over balances further down the chain.
+                # ==========================================
+                # Accounts that other absorbed in the past now end their
+                # absorption chains with us. Sweep up anything left in them.
+
+                if take_over_balances(cursor, absorbed_by=self.username):
+                    new_balance = cursor.one( "SELECT balance FROM participants WHERE id=%s"
+                                            , (self.id,)
+                                             )
+
 
         if new_balance is not None:
             self.set_attributes(balance=new_balance)
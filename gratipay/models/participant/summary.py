@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from . import Participant
+
+
+#: Named sets of columns for :py:meth:`ParticipantSummary.load`.
+COLUMN_SETS = { 'listing': ('id', 'username', 'avatar_url', 'claimed_time')
+              , 'payout': ('id', 'username', 'balance')
+               }
+
+
+class ParticipantSummary(object):
+    """Represent a few columns of a participant, for pages that list many.
+
+    A :py:class:`~gratipay.models.participant.Participant` carries every
+    column of a wide table. Listings mostly need a username and an avatar, so
+    we load just the columns we're asked for (see :py:meth:`load`) into slots.
+    Anything else, whether a column we didn't load or another attribute of
+    :py:class:`~gratipay.models.participant.Participant`, loads the whole
+    participant on first access, and we pass it through from there.
+
+    """
+
+    __slots__ = ( 'id', 'username', 'avatar_url', 'claimed_time', 'email_address', 'balance'
+                , 'is_suspicious', 'is_closed'
+                , '_participant'
+                 )
+
+    def __init__(self, **columns):
+        self._participant = None
+        for name, value in columns.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # We only get here for what our slots and class don't have.
+        if name.startswith('__'):
+            raise AttributeError(name)  # don't load for protocol checks
+        return getattr(self.participant, name)
+
+    def __eq__(self, other):
+        if not isinstance(other, (ParticipantSummary, Participant)):
+            return False
+        return self.id == other.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<ParticipantSummary: %s>' % self.username
+
+
+    # Loading
+    # =======
+
+    @classmethod
+    def load(cls, db, ids, columns='listing'):
+        """Load summaries of the participants with the given ids.
+
+        :param columns: the name of one of our :py:data:`COLUMN_SETS`, or a
+            tuple of column names (which must be slots of ours, and include ``id``)
+        :return: a list of summaries, in the order of ``ids``; ids we don't
+            have are skipped
+
+        """
+        columns = COLUMN_SETS.get(columns, columns)
+        unknown = set(columns) - set(cls.__slots__[:-1])
+        if unknown or 'id' not in columns:
+            raise ValueError("bad column set: {!r}".format(columns))
+        if not ids:
+            return []
+        rows = db.all( "SELECT {} FROM participants WHERE id = ANY(%s)".format(', '.join(columns))
+                     , (list(ids),)
+                     , back_as=dict
+                      )
+        by_id = {row['id']: cls(**row) for row in rows}
+        return [by_id[id] for id in ids if id in by_id]
+
+    @property
+    def participant(self):
+        """The whole :py:class:`~gratipay.models.participant.Participant`,
+        loaded on first access.
+        """
+        if self._participant is None:
+            self._participant = Participant.from_id(self.id)
+        return self._participant
+
+
+    # These only need what we have, so they don't load the rest.
+    # ==========================================================
+
+    @property
+    def db(self):
+        return Participant.db
+
+    url_path = Participant.url_path
+    get_statement = Participant.get_statement.__func__
+    list_identity_metadata = Participant.list_identity_metadata.__func__
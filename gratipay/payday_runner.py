@@ -15,7 +15,7 @@ class PaydayRunner(object):
         self.app = app
 
 
-    def run_payday(self):
+    def run_payday(self, engine=None):
         """Run Gratipay's weekly payday.
 
         If there is a Payday that hasn't finished yet, then the UNIQUE
@@ -23,11 +23,40 @@ class PaydayRunner(object):
         we load the existing Payday and work on it some more. We use the start
         time of the current Payday to synchronize our work.
 
+        :param unicode engine: one of :py:data:`gratipay.billing.payday.ENGINES`;
+            defaults to the ``PAYDAY_ENGINE`` envvar
+
         """
-        self._start_payday().run()
+        self._start_payday(engine).run()
+
+
+    def simulate_payday(self):
+        """Report what a payday run now would do, without writing anything.
+
+        We build payday's tables and, if needed, a paydays row inside a
+        transaction that is always rolled back.
+
+        """
+        with self.app.db.get_connection() as conn:
+            cursor = conn.cursor()
+            d = cursor.one("""
+                SELECT id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage
+                  FROM paydays
+                 WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+            """)
+            if d is None:
+                d = cursor.one("""
+                    INSERT INTO paydays DEFAULT VALUES
+                    RETURNING id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage
+                """)
+            aspen.log("Simulating payday as of %s." % d.ts_start)
+            payday = Payday(self)
+            payday.__dict__.update(d._asdict())
+            payday.ts_start = payday.ts_start.replace(tzinfo=aspen.utils.utc)
+            return payday.simulate(cursor)
 
 
-    def _start_payday(self):
+    def _start_payday(self, engine=None):
         try:
             d = self.app.db.one("""
                 INSERT INTO paydays DEFAULT VALUES
@@ -46,6 +75,6 @@ class PaydayRunner(object):
 
         aspen.log("Payday started at %s." % d['ts_start'])
 
-        payday = Payday(self)
+        payday = Payday(self, engine or self.app.env.payday_engine)
         payday.__dict__.update(d)
         return payday
@@ -1,16 +1,108 @@
 """Defines website authentication helpers.
 """
 import binascii
+import threading
+import time
 from datetime import date
 
 from aspen import Response
+from aspen.utils import utcnow
 from gratipay.models.participant import Participant
 from gratipay.security import csrf
 from gratipay.security.crypto import constant_time_compare
 from gratipay.security.user import User, SESSION
+from gratipay.utils.lru import LRU
 
 
 ANON = User()
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')  # as in csrf.reject_forgeries
+
+#: The channel that the ``notify_session_cache`` trigger notifies, with a
+#: participant id, when their session or standing changes.
+CHANNEL = 'session_cache'
+
+
+class SessionCache(object):
+    """Remember whose session a token is for a few seconds.
+
+    Nearly every request carries a session cookie, and finding the participant
+    for it costs a query, polls and XHR calls included. We keep the
+    participant's row for ``ttl`` seconds (zero turns us off), and build a
+    fresh :py:class:`~gratipay.models.participant.Participant` from it each
+    time so that requests don't share one. We're only used for safe requests:
+    anything that might change something loads the participant afresh.
+
+    We drop a participant's entry when their session or standing changes (see
+    :py:meth:`Participant.forget_cached_session`), and after any unsafe request
+    they make, so they see their own changes. Other processes hear about
+    changes on :py:data:`CHANNEL` if they listen for it (see
+    :py:meth:`QueryCache.listen`), and otherwise notice them when ``ttl`` is up.
+
+    """
+
+    def __init__(self, ttl=5, maxsize=10000, _time=time.time):
+        self.ttl = ttl
+        self._time = _time
+        self._rows = LRU(maxsize, on_evict=self._unindex)   # token -> (timestamp, row)
+        self._tokens = {}           # participant id -> set of their tokens in _rows
+        self._generation = 0        # bumped on invalidation, so we don't cache a stale load
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        """Return the participant whose unexpired session this is, or None.
+        """
+        if not self.ttl:
+            return Participant.from_session_token(token)
+        with self.lock:
+            cached = self._rows.get(token)
+            generation = self._generation
+        if cached is None or self._time() - cached[0] > self.ttl:
+            row = Participant.db.one( "SELECT * FROM participants WHERE session_token=%s"
+                                    , (token,)
+                                    , back_as=dict
+                                     )
+            if row is None:
+                return None
+            cached = (self._time(), row)
+            with self.lock:
+                if generation == self._generation:
+                    self._rows[token] = cached
+                    self._tokens.setdefault(row['id'], set()).add(token)
+        row = cached[1]
+        if row['session_expires'] < utcnow():
+            return None
+        return Participant(dict(row))
+
+    def invalidate(self, participant_id):
+        """Forget the sessions of the given participant.
+        """
+        with self.lock:
+            self._generation += 1
+            for token in self._tokens.pop(participant_id, ()):
+                self._rows.pop(token)
+
+    def clear(self):
+        with self.lock:
+            self._generation += 1
+            self._rows.clear()
+            self._tokens.clear()
+
+    def handle_notification(self, payload):
+        """Forget the sessions of the participant with the id in ``payload``,
+        from a notification on :py:data:`CHANNEL`.
+        """
+        self.invalidate(int(payload))
+
+    def _unindex(self, token, cached):
+        # Called by our LRU, under our lock.
+        tokens = self._tokens.get(cached[1]['id'])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens[cached[1]['id']]
+
+
+session_cache = SessionCache()
 
 def _get_user_via_api_key(api_key):
     """Given an api_key, return a User. This auth method is deprecated.
@@ -74,7 +166,10 @@ def authenticate_user_if_possible(request, user):
                 _turn_off_csrf(request)
     elif SESSION in request.headers.cookie:
         token = request.headers.cookie[SESSION].value
-        user = User.from_session_token(token)
+        if request.line.method in SAFE_METHODS:
+            user = User(session_cache.get(token))
+        else:
+            user = User.from_session_token(token)
     return {'user': user}
 
 def add_auth_to_response(response, request=None, user=ANON):
@@ -86,3 +181,5 @@ def add_auth_to_response(response, request=None, user=ANON):
     if SESSION in request.headers.cookie:
         if not user.ANON:
             user.keep_signed_in(response.headers.cookie)
+            if request.line.method not in SAFE_METHODS:
+                session_cache.invalidate(user.participant.id)
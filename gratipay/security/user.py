@@ -65,9 +65,9 @@ class User(object):
         """
         new_expires = utcnow() + SESSION_TIMEOUT
         if new_expires - self.participant.session_expires > SESSION_REFRESH:
-            self.participant.set_session_expires(new_expires)
-            token = self.participant.session_token
-            set_cookie(cookies, SESSION, token, expires=new_expires)
+            if self.participant.extend_session(new_expires, SESSION_REFRESH):
+                token = self.participant.session_token
+                set_cookie(cookies, SESSION, token, expires=new_expires)
 
     def sign_out(self, cookies):
         """End the user's current session.
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import io
+import json
+import sys
+import threading
+import time
+from Queue import Empty, Full, Queue
+
 import requests
 from couchdb import Database
 
@@ -31,12 +38,78 @@ def process_doc(doc):
     if 'name' not in doc:
         return None
     name = doc['name']
-    description = doc.get('description', '')
+    description = unicode(doc.get('description') or '')  # npm has nulls, and the odd non-string
     emails = [e for e in [m.get('email') for m in doc.get('maintainers', [])] if e.strip()]
     return {'name': name, 'description': description, 'emails': sorted(set(emails))}
 
 
-def consume_change_stream(stream, db):
+class ChangeBatch(object):
+    """Collect changes from the npm registry, to apply to our db in one go.
+
+    Only the last change to a package in a batch counts, so a package that is
+    published ten times in a row is upserted once, and a package that is
+    created and deleted in the same batch is only deleted (which is a no-op if
+    we never had it).
+
+    """
+
+    def __init__(self):
+        self.upserts = {}
+        self.deletes = set()
+        self.nchanges = 0
+        self.nskipped = 0
+        self.seq = None
+
+    def __len__(self):
+        return self.nchanges
+
+    def add(self, change):
+        if change.get('deleted'):
+            name = change['id']
+            self.upserts.pop(name, None)
+            self.deletes.add(name)
+        else:
+            doc = change.get('doc')
+            kw = process_doc(doc) if doc else None  # We've seen missing docs in the wild.
+            if kw:
+                self.deletes.discard(kw['name'])
+                self.upserts[kw['name']] = kw
+        self.nchanges += 1
+        self.seq = change['seq']
+
+    def apply(self, cursor, fingerprints=None):
+        """Apply the batch, and advance ``npm_last_seq``, using ``cursor``.
+
+        Most changes are new versions that don't touch anything we store. We
+        skip upserting packages whose :py:meth:`~Package.fingerprint` is what
+        we last wrote, per the ``fingerprints`` :py:class:`~gratipay.utils.lru.LRU`
+        (package name to fingerprint), and :py:meth:`~Package.upsert_many`
+        skips the ones that match what's in the db. We count both kinds in
+        ``nskipped``.
+
+        """
+        upserts = self.upserts.values()
+        if fingerprints is not None:
+            fingerprint = lambda p: Package.fingerprint(p['description'], p['emails'])
+            upserts = [p for p in upserts if fingerprints.get(p['name']) != fingerprint(p)]
+        self.nskipped = len(self.upserts) - Package.upsert_many(NPM, upserts, cursor)
+        # As a result of CouchDB's compaction algorithm, we might receive
+        # 'deleted' events for docs even if we haven't seen the corresponding
+        # events for when the doc was created. delete_many ignores those.
+        Package.delete_many(NPM, self.deletes, cursor)
+        cursor.run('UPDATE worker_coordination SET npm_last_seq=%s', (self.seq,))
+
+    def remember(self, fingerprints):
+        """Record what we wrote in ``fingerprints``, once it's committed.
+        """
+        for p in self.upserts.values():
+            fingerprints[p['name']] = Package.fingerprint(p['description'], p['emails'])
+        for name in self.deletes:
+            fingerprints.pop(name)
+
+
+def consume_change_stream(stream, db, batch_size=1000, flush_every=1000, on_commit=None,
+                          fingerprints=None, _time=time.time):
     """Given an iterable of CouchDB change notifications and a
     :py:class:`~GratipayDB`, read from the stream and write to the db.
 
@@ -45,35 +118,236 @@ def consume_change_stream(stream, db):
     here is to maintain open connections to both the registry and our own
     database, and write as we read.
 
+    We write in batches of up to ``batch_size`` changes, or whatever we've got
+    after ``flush_every`` milliseconds, whichever comes first. The interval is
+    checked as items arrive; the stream can yield ``None`` to have it checked
+    when there's no change to give us (see :py:class:`Pipeline`). Each batch
+    is one transaction that also advances ``npm_last_seq``, so if we crash we
+    replay at most one batch, and replaying is harmless. We call
+    ``on_commit(batch)`` after each one. Pass an :py:class:`~gratipay.utils.lru.LRU`
+    as ``fingerprints`` to skip writing packages that haven't changed (see
+    :py:meth:`ChangeBatch.apply`).
+
     """
+    def flush():
+        batch.apply(connection.cursor(), fingerprints)
+        connection.commit()
+        if fingerprints is not None:
+            batch.remember(fingerprints)
+        if on_commit:
+            on_commit(batch)
+
     with db.get_connection() as connection:
+        batch = ChangeBatch()
         for change in stream:
+            if change is not None:
+                if not batch:
+                    started = _time()
+                batch.add(change)
+            if batch and (len(batch) >= batch_size or (_time() - started) * 1000 >= flush_every):
+                flush()
+                batch = ChangeBatch()
+        if batch:
+            flush()
+
+
+class Pipeline(object):
+    """Read the change stream on one thread, and write to the db on another.
+
+    :param stream: an iterable of changes, from :py:func:`production_change_stream`
+    :param GratipayDB db: the db to write to, with :py:func:`consume_change_stream`
+    :param int queue_size: how many changes to read ahead before the reader
+        blocks (waiting on the writer)
+    :param int log_every: how often, in seconds, to print metrics (``0`` means
+        never)
+
+    Any other keyword arguments are passed through to
+    :py:func:`consume_change_stream`. The writer is the only one to touch
+    ``npm_last_seq``, and it only does so when it commits a batch, so we are
+    exactly as crash-safe as :py:func:`consume_change_stream` is.
+
+    """
+
+    _done = object()
+
+    def __init__(self, stream, db, queue_size=10000, log_every=60, _print=print,
+                 _time=time.time, **kw):
+        self.stream = stream
+        self.db = db
+        self.queue = Queue(maxsize=queue_size)
+        self.log_every = log_every
+        self.kw = kw
+        self._print = _print
+        self._time = _time
+        self._stopped = threading.Event()
+        self.error = None
+        self.nread = self.nwritten = self.nskipped = 0
+        self.read_seq = self.written_seq = None
+        self._last_logged = (_time(), 0, 0)
+
+
+    def run(self):
+        """Sync until the stream ends, re-raising any error from either thread.
+        """
+        reader = threading.Thread(target=self._read, name='sync-npm-reader')
+        reader.daemon = True  # a blocking read on the stream won't hold up exit
+        reader.start()
+        try:
+            consume_change_stream(self._changes(), self.db, on_commit=self._committed,
+                                  _time=self._time, **self.kw)
+        finally:
+            self._stopped.set()
+        if self.error:
+            exc_type, exc_value, tb = self.error
+            raise exc_type, exc_value, tb
+
+
+    def log_metrics(self):
+        """Print throughput, how many changes are waiting in the queue, how
+        far the db is behind what we've read, and how many package writes we
+        skipped since last time.
+        """
+        now = self._time()
+        then, nwritten, nskipped = self._last_logged
+        self._last_logged = (now, self.nwritten, self.nskipped)
+        rate = (self.nwritten - nwritten) / ((now - then) or 1)
+        if self.read_seq is None or self.written_seq is None:
+            lag = self.nread - self.nwritten
+        else:
+            lag = self.read_seq - self.written_seq
+        prefix = 'count#npm-sync'
+        self._print("{0}-changes-per-sec={1:.1f} {0}-queue-depth={2} {0}-seq-lag={3} "
+                    "{0}-skipped={4}"
+                    .format(prefix, rate, self.queue.qsize(), lag, self.nskipped - nskipped))
+
+
+    def _read(self):
+        try:
+            for change in self.stream:
+                if not self._put(change):
+                    return
+                self.nread += 1
+                self.read_seq = change['seq']
+        except:
+            self.error = sys.exc_info()
+        self._put(self._done)
+
+
+    def _put(self, item):
+        # Block while the queue is full, but give up if the writer is gone.
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+
+
+    def _changes(self):
+        timeout = self.kw.get('flush_every', 1000) / 1000
+        while True:
+            if self.log_every and self._time() - self._last_logged[0] >= self.log_every:
+                self.log_metrics()
+            try:
+                change = self.queue.get(timeout=timeout)
+            except Empty:
+                yield None  # let consume_change_stream flush what it has
+                continue
+            if change is self._done:
+                return
+            yield change
+
+
+    def _committed(self, batch):
+        self.nwritten += len(batch)
+        self.nskipped += batch.nskipped
+        self.written_seq = batch.seq
+
+
+def _copy_escape(value):
+    """Escape a value for ``COPY``'s text format.
+    """
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n') \
+                .replace('\r', '\\r').replace('\x00', '')
+
+
+def import_dump(lines, db, chunk_size=10000):
+    """Load packages from a dump of the npm registry, and return how many we
+    inserted or changed.
+
+    :param lines: an iterable of newline-delimited JSON, one registry doc per
+        line (what :py:func:`process_doc` takes), plus a line with the
+        ``update_seq`` of the registry as of the dump (as in CouchDB's database
+        info), which can come anywhere
+    :param GratipayDB db: the db to load into
+    :param int chunk_size: how many docs to buffer in memory at once
+
+    We stream the docs into a temporary table with ``COPY``, a chunk at a
+    time, and then merge them into ``packages`` with one statement (when a
+    package is in the dump twice, the later doc wins) and set
+    ``npm_last_seq`` to the dump's ``update_seq``, in one transaction. Then
+    :py:func:`consume_change_stream` can pick up from there.
+
+    """
+    seq = None
+    with db.get_cursor() as cursor:
+        cursor.run("""
+            CREATE TEMP TABLE npm_import
+            ( n bigint, name text, description text, emails json, fingerprint text )
+            ON COMMIT DROP
+        """)
+
+        buf = io.BytesIO()
+        def flush():
+            buf.seek(0)
+            cursor.copy_from(buf, 'npm_import')
+            buf.seek(0)
+            buf.truncate()
+
+        n = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            if 'name' not in doc and 'update_seq' in doc:
+                seq = int(doc['update_seq'])
+                continue
+            kw = process_doc(doc)
+            if not kw:
+                continue
+            n += 1
+            description = unicode(kw['description'] or '')
+            fingerprint = Package.fingerprint(description, kw['emails'])
+            row = [unicode(n), kw['name'], description, json.dumps(kw['emails']), fingerprint]
+            buf.write(('\t'.join(_copy_escape(v) for v in row) + '\n').encode('utf8'))
+            if n % chunk_size == 0:
+                flush()
+        flush()
+
+        if seq is None:
+            raise ValueError("The dump doesn't have an update_seq.")
 
-            # Decide what to do.
-            if change.get('deleted'):
-                package = Package.from_names(NPM, change['id'])
-                if not package:
-                    # As a result of CouchDB's compaction algorithm, we might
-                    # receive 'deleted' events for docs even if we haven't seen
-                    # the corresponding events for when the doc was created
-                    continue
-                op, kw = package.delete, {}
-            else:
-                op = Package.upsert
-                doc = change.get('doc')
-                if not doc:
-                    continue    # We've seen this in the wild.
-                kw = process_doc(doc)
-                if not kw:
-                    continue
-                kw['package_manager'] = NPM
-
-            # Do it.
-            cursor = connection.cursor()
-            kw['cursor'] = cursor
-            op(**kw)
-            cursor.run('UPDATE worker_coordination SET npm_last_seq=%(seq)s', change)
-            connection.commit()
+        nloaded = cursor.one("""
+            WITH upserted AS (
+                INSERT INTO packages (package_manager, name, description, emails, fingerprint)
+                     SELECT DISTINCT ON (name)
+                            %s, name, description
+                          , ARRAY(SELECT json_array_elements_text(emails))
+                          , fingerprint
+                       FROM npm_import
+                   ORDER BY name, n DESC
+                ON CONFLICT (package_manager, name) DO UPDATE
+                        SET description=excluded.description
+                          , emails=excluded.emails
+                          , fingerprint=excluded.fingerprint
+                      WHERE packages.fingerprint IS DISTINCT FROM excluded.fingerprint
+                  RETURNING 1
+            )
+            SELECT count(*) FROM upserted
+        """, (NPM,))
+        cursor.run('UPDATE worker_coordination SET npm_last_seq=%s', (seq,))
+    return nloaded
 
 
 def check(db, _print=print):
@@ -16,13 +16,15 @@ from .vcr import use_cassette
 
 class PaydayMixin(object):
 
+    payday_engine = 'trigger'
+
     @mock.patch.object(Payday, 'fetch_card_holds')
     def run_payday(self, fch):
         fch.return_value = {}
-        return self.app.payday_runner.run_payday()
+        return self.app.payday_runner.run_payday(self.payday_engine)
 
     def start_payday(self):
-        return self.app.payday_runner._start_payday()
+        return self.app.payday_runner._start_payday(self.payday_engine)
 
 
 class BillingHarness(Harness, PaydayMixin):
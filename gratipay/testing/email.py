@@ -8,12 +8,12 @@ class _AbstractEmailHarness(Harness):
 
     def setUp(self):
         Harness.setUp(self)
-        self.__sleep_for = self.app.email_queue.sleep_for
-        self.app.email_queue.sleep_for = 0
+        self.__send_rate = self.app.email_queue.executor.rate
+        self.app.email_queue.executor.configure(rate=0)
 
     def tearDown(self):
         Harness.tearDown(self)
-        self.app.email_queue.sleep_for = self.__sleep_for
+        self.app.email_queue.executor.configure(rate=self.__send_rate)
 
     def _get_last_email(self):
         raise NotImplementedError
@@ -52,7 +52,9 @@ class QueuedEmailHarness(_AbstractEmailHarness):
         """
         out = self.get_last_email()
         rec = self.db.one(self._SELECT)
-        self.app.email_queue._store_result(rec.id, '', 'deadbeef')
+        self.db.run( "UPDATE email_messages SET result='', remote_message_id='deadbeef' "
+                     "WHERE id=%s", (rec.id,)
+                    )
         return out
 
 
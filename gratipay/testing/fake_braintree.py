@@ -0,0 +1,138 @@
+"""A local, in-memory stand-in for the parts of Braintree that payday uses.
+
+VCR cassettes are fine for replaying a handful of calls, but they can't tell
+us how payday behaves with thousands of holds, or with holds that don't match
+the cassette. Use :py:class:`FakeBraintree` as a context manager to patch
+``braintree.Transaction`` for the duration of a test::
+
+    with FakeBraintree() as bt:
+        bt.authorize(participant_id=42, amount='10.00')
+        holds = Payday.fetch_card_holds({42})
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from decimal import Decimal
+from itertools import count
+
+import braintree
+import mock
+
+
+class FakeTransaction(object):
+
+    def __init__(self, id, amount, participant_id, status='authorized'):
+        self.id = id
+        self.amount = Decimal(amount)
+        self.custom_fields = {'participant_id': unicode(participant_id)}
+        self.status = status
+
+    def __repr__(self):
+        return '<FakeTransaction {} {} {}>'.format(self.id, self.amount, self.status)
+
+
+class FakeResult(object):
+
+    def __init__(self, transaction=None, message=None):
+        self.transaction = transaction
+        self.is_success = message is None
+        self.message = message
+        self.errors = mock.Mock(deep_errors=[])
+
+
+class FakeSearchResults(object):
+    """Mimic ``braintree.ResourceCollection``: ids up front, items a page at a time.
+    """
+
+    def __init__(self, fake, ids):
+        self.fake = fake
+        self.ids = ids
+
+    @property
+    def maximum_size(self):
+        return len(self.ids)
+
+    @property
+    def items(self):
+        page_size = self.fake.page_size
+        for i in range(0, len(self.ids), page_size):
+            self.fake.npages += 1
+            for id in self.ids[i:i+page_size]:
+                yield self.fake.transactions[id]
+
+
+class FakeBraintree(object):
+    """Keep transactions in a dict, and patch ``braintree.Transaction`` to use it.
+
+    :param int page_size: how many transactions a search returns per page
+
+    """
+
+    def __init__(self, page_size=50):
+        self.page_size = page_size
+        self.transactions = {}
+        self.npages = 0
+        self._ids = count(1)
+        self._patchers = []
+
+    def __enter__(self):
+        for name in ('search', 'sale', 'submit_for_settlement', 'void'):
+            patcher = mock.patch.object(braintree.Transaction, name, getattr(self, name))
+            patcher.start()
+            self._patchers.append(patcher)
+        return self
+
+    def __exit__(self, *exc_info):
+        while self._patchers:
+            self._patchers.pop().stop()
+
+    def authorize(self, participant_id, amount):
+        """Add an authorized transaction (a card hold) directly.
+        """
+        id = 'fake{}'.format(next(self._ids))
+        self.transactions[id] = FakeTransaction(id, amount, participant_id)
+        return self.transactions[id]
+
+    def holds(self):
+        """Return the authorized transactions, ordered by id.
+        """
+        return [t for t in self._sorted() if t.status == 'authorized']
+
+    def _sorted(self):
+        return sorted(self.transactions.values(), key=lambda t: int(t.id[4:]))
+
+
+    # braintree.Transaction API
+    # =========================
+
+    def search(self, *query):
+        if query and isinstance(query[0], list):
+            query = query[0]
+        transactions = self._sorted()
+        for term in query:
+            values = term.to_param()
+            if not isinstance(values, list):
+                raise NotImplementedError("FakeBraintree only supports multiple value searches.")
+            field = 'id' if term.name == 'ids' else term.name
+            transactions = [t for t in transactions if getattr(t, field) in values]
+        return FakeSearchResults(self, [t.id for t in transactions])
+
+    def sale(self, params):
+        participant_id = params.get('custom_fields', {}).get('participant_id')
+        return FakeResult(self.authorize(participant_id, params['amount']))
+
+    def submit_for_settlement(self, id, amount=None):
+        transaction = self.transactions[id]
+        if transaction.status != 'authorized':
+            return FakeResult(message='Cannot submit for settlement unless status is authorized.')
+        if amount is not None:
+            transaction.amount = Decimal(amount)
+        transaction.status = 'submitted_for_settlement'
+        return FakeResult(transaction)
+
+    def void(self, id):
+        transaction = self.transactions[id]
+        if transaction.status != 'authorized':
+            return FakeResult(message='Transaction can only be voided if status is authorized.')
+        transaction.status = 'voided'
+        return FakeResult(transaction)
@@ -24,7 +24,7 @@ from gratipay.models.package import NPM, Package
 from gratipay.models.participant import Participant, MAX_TIP, MIN_TIP
 from gratipay.models.payment_for_open_source import PaymentForOpenSource
 from gratipay.models.team import Team
-from gratipay.security import user
+from gratipay.security import authentication, user
 from gratipay.testing import P
 from gratipay.testing.vcr import use_cassette
 from psycopg2 import IntegrityError, InternalError
@@ -90,6 +90,7 @@ class Harness(unittest.TestCase):
                         "WHERE schemaname='public' AND tablename != 'countries'")
     seq = itertools.count(0)
     use_VCR = True
+    cassette = None             # defaults to the class name
 
 
     @classmethod
@@ -111,7 +112,7 @@ class Harness(unittest.TestCase):
         information, and you can commit that with your updated tests.
 
         """
-        cls.vcr_cassette = use_cassette(cls.__name__)
+        cls.vcr_cassette = use_cassette(cls.cassette or cls.__name__)
         cls.vcr_cassette.__enter__()
 
 
@@ -127,6 +128,8 @@ class Harness(unittest.TestCase):
 
     def tearDown(self):
         resources.__cache__ = {}  # Clear the simplate cache.
+        self.app.query_cache.clear()
+        authentication.session_cache.clear()
         self.clear_tables()
 
 
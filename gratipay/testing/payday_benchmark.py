@@ -0,0 +1,226 @@
+"""Benchmark payday against a synthetic population.
+
+We load participants, teams, payment instructions, and takes with ``COPY``, so
+that a million payment instructions load in minutes instead of hours. Then we
+run :py:meth:`~gratipay.billing.payday.Payday.payin` against a
+:py:class:`~gratipay.testing.fake_braintree.FakeBraintree` and read the
+per-stage timings back out of ``payday_metrics``. The report is JSON, so that
+reports from two commits can be compared with :py:func:`compare`.
+
+**This wipes the database.** Only point it at a scratch one.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import random
+import subprocess
+import time
+from datetime import timedelta
+
+from aspen import log
+from aspen.utils import utcnow
+
+from gratipay.billing import braintree_executor
+from gratipay.billing.payday import MEASURED_STAGES
+from gratipay.testing.fake_braintree import FakeBraintree
+
+
+#: The population sizes we run by default, in payment instructions.
+SIZES = (10000, 100000, 1000000)
+
+GIFTS = ('1.00', '2.00', '5.00', '10.00', '25.00')
+TAKES = ('5.00', '10.00', '20.00')
+
+
+def reset_db(db):
+    """Empty every table but ``countries``, like the test harness does.
+    """
+    tablenames = db.all("""
+        SELECT tablename FROM pg_tables WHERE schemaname='public' AND tablename != 'countries'
+    """)
+    with db.get_cursor() as cursor:
+        cursor.run("TRUNCATE {} RESTART IDENTITY CASCADE".format(', '.join(tablenames)))
+        cursor.run("INSERT INTO worker_coordination DEFAULT VALUES")
+
+
+def _copy(cursor, table, columns, rows):
+    """Load ``rows`` into ``table`` with ``COPY``, and return how many there were.
+    """
+    buf = io.BytesIO()
+    n = 0
+    for row in rows:
+        line = '\t'.join(r'\N' if v is None else unicode(v) for v in row) + '\n'
+        buf.write(line.encode('utf8'))
+        n += 1
+    buf.seek(0)
+    cursor.copy_from(buf, table, columns=columns)
+    return n
+
+
+def populate(db, ninstructions, per_giver=5, team_size=3, seed=0):
+    """Load a population with ``ninstructions`` payment instructions.
+
+    :param int ninstructions: how many payment instructions to make
+    :param int per_giver: how many teams each giver gives to
+    :param int team_size: how many members (besides the owner) take from each team
+    :param int seed: seeds the amounts, so that runs are comparable
+
+    Every giver has a working credit card and no balance, so payday has to put
+    a card hold on everyone whose gifts add up to the minimum charge. There's
+    one team per hundred payment instructions, each with a PayPal-enabled owner.
+
+    """
+    rng = random.Random(seed)
+    ngivers = -(-ninstructions // per_giver)
+    nteams = max(ninstructions // 100, per_giver)
+    nmembers = nteams * team_size
+
+    # Everything happened a week ago, well before the payday we're about to run.
+    then = (utcnow() - timedelta(days=7)).isoformat()
+
+    with db.get_cursor() as cursor:
+        owners = range(1, nteams + 1)
+        members = range(nteams + 1, nteams + nmembers + 1)
+        givers = range(nteams + nmembers + 1, nteams + nmembers + ngivers + 1)
+
+        def participants():
+            for kind, ids in (('owner', owners), ('member', members), ('giver', givers)):
+                for id in ids:
+                    username = '{}{}'.format(kind, id)
+                    yield (id, username, username, then, False, 'cus{}'.format(id))
+        _copy( cursor, 'participants'
+             , ('id', 'username', 'username_lower', 'claimed_time', 'is_suspicious'
+               , 'braintree_customer_id')
+             , participants()
+              )
+
+        def routes():
+            for id in owners:
+                yield (id, 'paypal', 'owner{}@example.com'.format(id), '')
+            for id in givers:
+                yield (id, 'braintree-cc', 'card{}'.format(id), '')
+        _copy(cursor, 'exchange_routes', ('participant', 'network', 'address', 'error'), routes())
+
+        def teams():
+            for id in owners:
+                slug = 'team{}'.format(id)
+                yield ( id, slug, slug, slug, 'http://example.com/', 'Benchmarking.'
+                      , 'owner{}'.format(id), True, '1000000.00'
+                       )
+        _copy( cursor, 'teams'
+             , ('id', 'slug', 'slug_lower', 'name', 'homepage', 'product_or_service', 'owner'
+               , 'is_approved', 'available')
+             , teams()
+              )
+
+        def payment_instructions():
+            step = max(nteams // per_giver, 1)
+            for i in range(ninstructions):
+                giver, j = divmod(i, per_giver)
+                team = owners[(giver + j * step) % nteams]
+                yield (then, then, rng.choice(GIFTS), givers[giver], team)
+        _copy( cursor, 'payment_instructions'
+             , ('ctime', 'mtime', 'amount', 'participant_id', 'team_id')
+             , payment_instructions()
+              )
+
+        def takes():
+            for i, member in enumerate(members):
+                team = owners[i // team_size]
+                yield (then, then, member, team, rng.choice(TAKES), team)
+        _copy( cursor, 'takes'
+             , ('ctime', 'mtime', 'participant_id', 'team_id', 'amount', 'recorder_id')
+             , takes()
+              )
+
+        for table in ('participants', 'teams'):
+            cursor.run("SELECT setval('{0}_id_seq', (SELECT max(id) FROM {0}))".format(table))
+
+    for table in ('participants', 'exchange_routes', 'teams', 'payment_instructions', 'takes'):
+        db.run("ANALYZE {}".format(table))
+
+    return dict(participants=nteams + nmembers + ngivers, teams=nteams)
+
+
+def run(app, ninstructions, engine=None, **kw):
+    """Populate the database and run payin on it, and return a report :py:class:`dict`.
+
+    Any keyword arguments are passed through to :py:func:`populate`.
+
+    """
+    log("Benchmarking payday with {} payment instructions.".format(ninstructions))
+    reset_db(app.db)
+
+    start = time.time()
+    population = populate(app.db, ninstructions, **kw)
+    populated = time.time()
+
+    with FakeBraintree():
+        payday = app.payday_runner._start_payday(engine)
+        payday.payin()
+    finished = time.time()
+
+    stages = {}
+    for m in app.db.all("""
+        SELECT stage, seconds, nrows, nbraintree_calls, nbraintree_retries
+          FROM payday_metrics
+         WHERE payday = %s
+    """, (payday.id,)):
+        stages[m.stage] = dict(m._asdict(), seconds=float(m.seconds))
+        del stages[m.stage]['stage']
+
+    return dict( ninstructions=ninstructions
+               , engine=payday.engine
+               , population=population
+               , populate_seconds=round(populated - start, 3)
+               , payin_seconds=round(finished - populated, 3)
+               , stages=stages
+                )
+
+
+def benchmark(app, sizes=SIZES, engine=None, **kw):
+    """Run :py:func:`run` for each of ``sizes``, and return the whole report.
+    """
+    return dict( commit=git_commit()
+               , ts=utcnow().isoformat()
+               , braintree_concurrency=braintree_executor.concurrency
+               , runs=[run(app, n, engine, **kw) for n in sizes]
+                )
+
+
+def git_commit():
+    """Return the commit we're running, or ``None`` if we can't tell.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD']) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode('ascii') + ('-dirty' if dirty else '')
+
+
+def compare(old, new):
+    """Compare two reports, and return a list of lines for a human.
+
+    Runs are matched on population size and engine, and stages are listed in
+    the order payday runs them.
+
+    """
+    def index(report):
+        return {(r['ninstructions'], r['engine']): r for r in report['runs']}
+    old_runs, new_runs = index(old), index(new)
+
+    lines = ["{} -> {}".format(old.get('commit'), new.get('commit'))]
+    for key in sorted(set(old_runs) & set(new_runs)):
+        a, b = old_runs[key], new_runs[key]
+        lines.append("{} instructions, {} engine:".format(*key))
+        rows = [(stage, a['stages'].get(stage), b['stages'].get(stage)) for stage in MEASURED_STAGES]
+        rows.append(('payin', {'seconds': a['payin_seconds']}, {'seconds': b['payin_seconds']}))
+        for stage, x, y in rows:
+            if not (x and y):
+                continue
+            x, y = x['seconds'], y['seconds']
+            change = '{:+.0%}'.format((y - x) / x) if x else 'n/a'
+            lines.append("  {:<24} {:>10.3f}s {:>10.3f}s {:>8}".format(stage, x, y, change))
+    return lines
@@ -7,6 +7,7 @@ import os
 import re
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import datetime, timedelta
+from functools import partial
 
 from aspen import Response, json
 from aspen.utils import to_rfc822, utcnow
@@ -226,8 +227,20 @@ def to_javascript(obj):
     return json.dumps(obj).replace('</', '<\\/')
 
 
-def get_featured_projects(db):
-    npopular, nunpopular = db.one("""
+def get_featured_projects(db, query_cache=None):
+    """Return up to ten approved projects, most of them popular, in random order.
+
+    Pass a :py:class:`~gratipay.utils.query_cache.QueryCache` to reuse a
+    selection for a while rather than picking a new one on every request.
+
+    """
+    if query_cache is not None:
+        one = partial(query_cache.one, depends_on=('teams',))
+        all_ = partial(query_cache.all, depends_on=('teams',))
+    else:
+        one, all_ = db.one, db.all
+
+    npopular, nunpopular = one("""
 
         WITH eligible_teams AS (
             SELECT *
@@ -253,7 +266,7 @@ def get_featured_projects(db):
     # Fill in the rest with unpopular
     nunpopular = min(nunpopular, 10-npopular)
 
-    featured_projects = db.all("""
+    featured_projects = all_("""
 
         WITH eligible_teams AS (
             SELECT *
@@ -276,8 +289,9 @@ def get_featured_projects(db):
       ORDER BY random()
          LIMIT %(nunpopular)s)
 
-    """, locals())
+    """, dict(npopular=npopular, nunpopular=nunpopular))
 
+    featured_projects = list(featured_projects)  # don't shuffle a cached list in place
     random.shuffle(featured_projects)
     return featured_projects
 
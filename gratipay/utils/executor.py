@@ -0,0 +1,312 @@
+"""Run calls to a remote service with bounded concurrency and a rate limit.
+
+We use this for Braintree (see :py:data:`gratipay.billing.braintree_executor`),
+whose API calls dominate payday's wall-clock time when we have thousands of
+card holds to create, capture, and cancel.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import threading
+import time
+from Queue import Queue
+
+from aspen import log
+
+from gratipay.utils.threaded_map import threaded_map
+
+
+def _name(func):
+    return getattr(func, '__name__', repr(func))
+
+
+class CallTimedOut(Exception):
+    def __str__(self):
+        return "Call to {} timed out after {} seconds.".format(*self.args)
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket.
+
+    :param float rate: the number of tokens added per second
+    :param int capacity: the most tokens the bucket holds, i.e., the largest
+        burst we allow; defaults to ``rate`` (but at least one)
+
+    """
+
+    def __init__(self, rate, capacity=None, _time=time.time, _sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity or max(int(rate), 1)
+        self.tokens = self.capacity
+        self._time = _time
+        self._sleep = _sleep
+        self._last = _time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Take a token, blocking until one is available.
+        """
+        while True:
+            with self._lock:
+                now = self._time()
+                self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self._sleep(wait)
+
+
+class Executor(object):
+    """Make calls to a remote service, politely.
+
+    :param unicode name: what to call this executor in the logs
+    :param int concurrency: the most calls we make at once
+    :param float rate: the most calls we start per second (``0`` means no limit)
+    :param float timeout: how long :py:meth:`call` waits for a single call
+        before raising :py:exc:`CallTimedOut` (``0`` means wait forever); the
+        call itself is abandoned, not interrupted, and keeps its place against
+        ``concurrency`` until it finishes
+    :param int retries: how many times to retry a call that raised one of the
+        ``transient`` exceptions (:py:meth:`call_once` never retries)
+    :param float backoff: how long to sleep before the first retry, doubling
+        after each one
+    :param tuple transient: exception classes that are worth a retry
+    :param int log_every: how often, in seconds, to log throughput and latency
+        (``0`` means never)
+
+    """
+
+    def __init__(self, name, concurrency=5, rate=0, timeout=0, retries=0, backoff=0.5,
+                 transient=(), log_every=0, _time=time.time, _sleep=time.sleep):
+        self.name = name
+        self._time = _time
+        self._sleep = _sleep
+        self._stats_lock = threading.Lock()
+        self.configure( concurrency=concurrency
+                      , rate=rate
+                      , timeout=timeout
+                      , retries=retries
+                      , backoff=backoff
+                      , transient=transient
+                      , log_every=log_every
+                       )
+
+
+    def configure(self, **kw):
+        """Change settings, and start counting from scratch.
+        """
+        for key in ('concurrency', 'rate', 'timeout', 'retries', 'backoff', 'transient',
+                                                                                'log_every'):
+            if key in kw:
+                setattr(self, key, kw.pop(key))
+        if kw:
+            raise TypeError("Unknown settings: {}.".format(', '.join(sorted(kw))))
+        self._semaphore = threading.BoundedSemaphore(self.concurrency)
+        self._bucket = TokenBucket(self.rate, _time=self._time, _sleep=self._sleep) \
+                                                                        if self.rate else None
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.ncalls = self.nerrors = self.nretries = self.ntimeouts = 0
+            self.total_latency = self.max_latency = 0.0
+            self._started = self._last_logged = self._time()
+
+
+    def call(self, func, *a, **kw):
+        """Call ``func(*a, **kw)`` within our limits, and return its result.
+
+        We retry ``transient`` errors, so ``func`` must be safe to repeat: a
+        connection can fail after the remote end has acted on our request. Use
+        :py:meth:`call_once` for calls that aren't.
+
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._call_once(func, a, kw)
+            except self.transient as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                with self._stats_lock:
+                    self.nretries += 1
+                log("{}: retrying {} in {}s after {!r} ({}/{}).".format(
+                    self.name, _name(func), delay, e, attempt, self.retries))
+                self._sleep(delay)
+
+
+    def call_once(self, func, *a, **kw):
+        """Call ``func(*a, **kw)`` within our limits, but never retry it.
+
+        We don't time it out either: we'd lose the outcome of a call that
+        we can't repeat, so we wait for it (``func`` should have a timeout of
+        its own, as Braintree's HTTP client does).
+
+        """
+        return self._call_once(func, a, kw, timeout=0)
+
+
+    def map(self, func, iterable):
+        """Map ``func`` over ``iterable`` using ``concurrency`` threads.
+
+        This is :py:func:`~gratipay.utils.threaded_map.threaded_map` sized for
+        this executor. The remote calls inside ``func`` should go through
+        :py:meth:`call`.
+
+        """
+        return threaded_map(func, iterable, self.concurrency)
+
+
+    def batch(self, func):
+        """Return a :py:class:`Batch` that applies ``func`` on our threads.
+        """
+        return Batch(func, self.concurrency)
+
+
+    def log_stats(self):
+        with self._stats_lock:
+            elapsed = (self._time() - self._started) or 1e-9
+            avg = self.total_latency / self.ncalls if self.ncalls else 0
+            msg = ( "{}: {} calls in {:.0f}s ({:.1f}/s), {} retries, {} timeouts, {} errors; "
+                    "latency avg {:.0f}ms, max {:.0f}ms."
+                   ).format( self.name, self.ncalls, elapsed, self.ncalls / elapsed
+                           , self.nretries, self.ntimeouts, self.nerrors
+                           , avg * 1000, self.max_latency * 1000
+                            )
+            self._last_logged = self._time()
+        log(msg)
+
+
+    def _call_once(self, func, a, kw, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        semaphore = self._semaphore  # configure can replace it while we wait
+        semaphore.acquire()
+        if self._bucket:
+            self._bucket.take()
+        start = self._time()
+        error = None
+        try:
+            return self._run(func, a, kw, timeout, semaphore)
+        except CallTimedOut:
+            error = 'timeout'
+            raise
+        except Exception:
+            error = 'error'
+            raise
+        finally:
+            self._record(self._time() - start, error)
+
+
+    def _run(self, func, a, kw, timeout, semaphore):
+        """Run ``func``, and release ``semaphore`` when it's done, even if we
+        gave up waiting for it.
+        """
+        if not timeout:
+            try:
+                return func(*a, **kw)
+            finally:
+                semaphore.release()
+        outcome = {}
+        def target():
+            try:
+                outcome['result'] = func(*a, **kw)
+            except:
+                outcome['exc_info'] = sys.exc_info()
+            finally:
+                semaphore.release()
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        try:
+            thread.start()
+        except:
+            semaphore.release()
+            raise
+        thread.join(timeout)
+        if thread.is_alive():
+            raise CallTimedOut(_name(func), timeout)
+        if 'exc_info' in outcome:
+            exc_type, exc_value, tb = outcome['exc_info']
+            raise exc_type, exc_value, tb
+        return outcome['result']
+
+
+    def _record(self, latency, error):
+        with self._stats_lock:
+            self.ncalls += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if error == 'timeout':
+                self.ntimeouts += 1
+            elif error:
+                self.nerrors += 1
+            due = self.log_every and self._time() - self._last_logged >= self.log_every
+        if due:
+            self.log_stats()
+
+
+class Batch(object):
+    """Apply a function to items as they are produced, on a pool of threads.
+
+    Unlike :py:meth:`Executor.map`, which needs the whole iterable up front,
+    this lets us start working on the first items while we're still fetching
+    the rest. Use it as a context manager::
+
+        with executor.batch(func) as batch:
+            for item in stream:
+                batch.put(item)
+
+    Leaving the block waits for the outstanding items, and then re-raises the
+    first exception raised by ``func``, if any.
+
+    """
+
+    def __init__(self, func, threads):
+        self.func = func
+        self.nput = 0
+        self.errors = []
+        self._queue = Queue(maxsize=threads * 2)
+        self._threads = [threading.Thread(target=self._work) for i in range(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # Don't mask an exception raised while producing items.
+        self.join(reraise=exc_type is None)
+
+    def put(self, *a):
+        """Queue up ``func(*a)``, blocking if the threads are falling behind.
+        """
+        self.nput += 1
+        self._queue.put(a)
+
+    def join(self, reraise=True):
+        """Wait for the queued items, and re-raise the first error.
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self.errors and reraise:
+            exc_type, exc_value, tb = self.errors[0]
+            raise exc_type, exc_value, tb
+
+    def _work(self):
+        while True:
+            a = self._queue.get()
+            if a is None:
+                break
+            try:
+                self.func(*a)
+            except:
+                self.errors.append(sys.exc_info())
@@ -0,0 +1,70 @@
+"""A size-bounded, least-recently-used mapping.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import OrderedDict
+
+
+class LRU(object):
+    """Hold at most ``maxsize`` items, dropping the least recently used first.
+
+    With ``maxbytes`` we also drop items while their total size is over
+    budget, measuring each item with ``sizeof`` when it's set (we always keep
+    the item we just set, even if it's over budget by itself).
+
+    If given, ``on_evict`` is called with the key and value of each item we
+    drop to make room (not for items that are popped or cleared).
+
+    Getting and setting both count as a use. This isn't thread-safe, so keep
+    each instance on one thread or lock around it.
+
+    """
+
+    def __init__(self, maxsize, maxbytes=None, sizeof=None, on_evict=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.nbytes = 0
+        self.nevicted = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        self._data[key] = value
+        if self.maxbytes:
+            self._sizes[key] = self.sizeof(value)
+            self.nbytes += self._sizes[key]
+        while len(self._data) > self.maxsize or \
+                (self.maxbytes and self.nbytes > self.maxbytes and len(self._data) > 1):
+            key = next(iter(self._data))
+            value = self.pop(key)
+            self.nevicted += 1
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+    def items(self):
+        return list(self._data.items())
+
+    def pop(self, key, default=None):
+        self.nbytes -= self._sizes.pop(key, 0)
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self.nbytes = 0
@@ -1,7 +1,138 @@
+from __future__ import print_function
+
+import select
 import sys
 import threading
 import time
 import traceback
+from collections import namedtuple
+from hashlib import md5
+
+import psycopg2
+from aspen import log_dammit
+from postgres import url_to_dsn
+
+from gratipay.utils import serializers
+from gratipay.utils.lru import LRU
+
+
+#: The channel that the ``invalidate_query_cache`` trigger notifies.
+CHANNEL = 'query_cache'
+
+
+# Define cache backends.
+# ======================
+# A QueryCache always keeps results in its own entries. A backend is somewhere
+# else to look for a result before running a query, and to put it afterwards.
+
+class InProcessBackend(object):
+    """Share nothing: each process runs its own queries.
+    """
+
+    def get(self, key, max_age):
+        return False, None
+
+    def set(self, key, value, tables):
+        pass
+
+
+class PostgresBackend(object):
+    """Share results between processes through the ``query_cache`` table.
+
+    The table is ``UNLOGGED``, so it's cheap to write and is emptied after a
+    crash, which is fine for a cache. Results are written with one of our
+    :py:mod:`~gratipay.utils.serializers` (never pickled), with tuples and
+    records (as from ``back_as=namedtuple``, the default) marked so that they
+    come back as such. Results with anything else in them (models, say) are
+    only cached in-process, and we remember not to look for them here. Rows for
+    results that depend on a table are deleted by the ``invalidate_query_cache``
+    trigger on that table.
+
+    """
+
+    def __init__(self, db, serializer='json', maxunshared=1000):
+        self.db = db
+        self.serializer = serializers.get_serializer(serializer)
+        self._unshared = LRU(maxunshared)   # digests of results we couldn't serialize
+        self._lock = threading.Lock()
+
+    def _digest(self, key):
+        return md5(repr(key).encode('utf8')).hexdigest()
+
+    def get(self, key, max_age):
+        digest = self._digest(key)
+        with self._lock:
+            if digest in self._unshared:
+                return False, None
+        value = self.db.one("""
+            SELECT value
+              FROM query_cache
+             WHERE key = %s
+               AND ts > now() - make_interval(secs => %s)
+        """, (digest, max_age))
+        if value is None:
+            return False, None
+        try:
+            return True, _unpack(serializers.loads(value, allow_pickle=False))
+        except ValueError:
+            return False, None
+
+    def set(self, key, value, tables):
+        digest = self._digest(key)
+        try:
+            value = serializers.dumps(_pack(value), self.serializer)
+        except (TypeError, ValueError):
+            with self._lock:
+                self._unshared[digest] = True
+            return
+        self.db.run("""
+            INSERT INTO query_cache (key, value, tables)
+                 VALUES (%s, %s, %s)
+            ON CONFLICT (key) DO UPDATE
+                    SET value = excluded.value
+                      , tables = excluded.tables
+                      , ts = now()
+        """, (digest, psycopg2.Binary(value), list(tables)))
+
+
+_record_classes = {}
+
+def _pack(value):
+    """Turn tuples and records into what our serializers can round-trip.
+    """
+    if isinstance(value, tuple):
+        fields = getattr(value, '_fields', None)
+        if fields is not None:
+            return {'__record__': [list(fields), [_pack(v) for v in value]]}
+        return {'__tuple__': [_pack(v) for v in value]}
+    if isinstance(value, list):
+        return [_pack(v) for v in value]
+    if isinstance(value, dict):
+        if not all(isinstance(k, basestring) for k in value):
+            raise TypeError("only string keys survive serialization")
+        return {k: _pack(v) for k, v in value.items()}
+    return value
+
+def _unpack(value):
+    """Undo :py:func:`_pack`.
+    """
+    if isinstance(value, list):
+        return [_unpack(v) for v in value]
+    if isinstance(value, dict):
+        if len(value) == 1:
+            if '__tuple__' in value:
+                return tuple(_unpack(v) for v in value['__tuple__'])
+            if '__record__' in value:
+                fields, values = value['__record__']
+                fields = tuple(str(f) for f in fields)
+                if fields not in _record_classes:
+                    _record_classes[fields] = namedtuple('Record', fields, rename=True)
+                return _record_classes[fields](*(_unpack(v) for v in values))
+        return {k: _unpack(v) for k, v in value.items()}
+    return value
+
+
+BACKENDS = {'memory': lambda db: InProcessBackend(), 'postgres': PostgresBackend}
 
 
 # Define a query cache.
@@ -19,6 +150,9 @@ class Entry(object):
     timestamp = None    # The timestamp of the last query run [datetime.datetime]
     lock = None         # Access control for this record [threading.Lock]
     exc = None          # Any exception in query or formatting [Exception]
+    threshold = None    # Maximum life of this entry, if not the default [seconds]
+    tables = ()         # Tables whose changes make this entry stale [tuple]
+    nbytes = 0          # Estimated size of the result, for LRUQueryCache [int]
 
     def __init__(self, timestamp=0, lock=None, result=None):
         """Populate with dummy data or an actual db entry.
@@ -56,6 +190,20 @@ class QueryCache(object):
     entries on a more relaxed schedule (default: 60 seconds). It keeps the
     cache clean without interfering too much with actual usage.
 
+    The ``one`` and ``all`` methods take the same arguments as their
+    counterparts on :py:class:`~postgres.Postgres` (which are part of the
+    cache key), plus a ``process`` callback (which isn't), a ``threshold``
+    to override the default for that call, and ``depends_on``, a tuple of
+    tables whose changes should drop the entry early (see :py:meth:`listen`).
+
+    Before running a query we look for its result in our ``backend``, which
+    lets processes share results (see :py:class:`PostgresBackend`); the
+    default, :py:class:`InProcessBackend`, shares nothing.
+
+    We count cache hits, misses (the query wasn't cached), stale hits (it
+    was, but had expired), and shared hits (a miss that our backend had);
+    :py:meth:`log_metrics` reports and resets them.
+
     If the actual database call or the formatting callback raise an Exception,
     then that is cached as well, and will be raised on further calls until the
     cache expires as usual.
@@ -72,40 +220,66 @@ class QueryCache(object):
     threshold_prune = 60    # time between pruning runs [seconds as int]
 
 
-    def __init__(self, db, threshold=5, threshold_prune=60):
+    def __init__(self, db, threshold=5, threshold_prune=60, backend=None):
         """
         """
         self.db = db
         self.threshold = threshold
         self.threshold_prune = threshold_prune
+        self.backend = backend or InProcessBackend()
         self.cache = {}
+        self.nhits = self.nmisses = self.nstale = self.nshared = 0
 
         class Locks:
             checkin = threading.Lock()
             checkout = threading.Lock()
+            stats = threading.Lock()
         self.locks = Locks()
+        self.start_pruner()
+
 
+    def start_pruner(self):
         self.pruner = threading.Thread(target=self.prune)
         self.pruner.setDaemon(True)
         self.pruner.start()
 
 
-    def one(self, query, params, process=None):
-        return self._do_query(self.db.one, query, params, process)
+    def _key(self, query, params, kw):
+        if isinstance(params, dict):
+            params = tuple(sorted(params.items()))
+        return (query, params, tuple(sorted(kw.items())))
+
+    def one(self, query, params=None, process=None, threshold=None, depends_on=(), **kw):
+        return self._do_query(self.db.one, query, params, process, threshold, depends_on, kw)
 
-    def all(self, query, params, process=None):
+    def all(self, query, params=None, process=None, threshold=None, depends_on=(), **kw):
         if process is None:
             process = lambda g: list(g)
-        return self._do_query(self.db.all, query, params, process)
+        return self._do_query(self.db.all, query, params, process, threshold, depends_on, kw)
 
-    def _do_query(self, fetchfunc, query, params, process):
+    def _compute(self, key, threshold, fetchfunc, query, params, process, tables, kw):
+        """Run a query and process its result, unless our backend has it.
+        """
+        found, result = self.backend.get(key, threshold)
+        if found:
+            self._count('nshared')
+            return result
+        result = fetchfunc(query, params, **kw)  # XXX uses postgres.py api, not dbapi2!
+        if process is not None:
+            result = process(result)
+        self.backend.set(key, result, tables)
+        return result
+
+    def _do_query(self, fetchfunc, query, params, process, threshold, tables, kw):
         """Given a function, a SQL string, a tuple, and a function, return ???.
         """
 
         # Compute a cache key.
         # ====================
 
-        key = (query, params)
+        key = self._key(query, params, kw)
+        if threshold is None:
+            threshold = self.threshold
 
 
         # Check out an entry.
@@ -164,16 +338,20 @@ class QueryCache(object):
             # Decide whether it's a hit or miss.
             # ==================================
 
-            if time.time() - entry.timestamp < self.threshold:  # cache hit
+            if time.time() - entry.timestamp < threshold:       # cache hit
+                self._count('nhits')
                 if entry.exc is not None:
                     raise entry.exc
                 return entry.result
 
             else:                                               # cache miss
-                try:                    # XXX uses postgres.py api, not dbapi2!
-                    entry.result = fetchfunc(query, params)
-                    if process is not None:
-                        entry.result = process(entry.result)
+                self._count('nstale' if entry.timestamp else 'nmisses')
+                entry.threshold = threshold
+                entry.tables = tuple(tables)
+                try:
+                    entry.result = self._compute( key, threshold, fetchfunc, query, params
+                                                , process, tables, kw
+                                                 )
                     entry.exc = None
                 except:
                     entry.result = None
@@ -231,7 +409,8 @@ class QueryCache(object):
                     # ==================================
 
                     try:  # critical section
-                        if time.time() - entry.timestamp > self.threshold_prune:
+                        max_age = max(self.threshold_prune, entry.threshold or 0)
+                        if time.time() - entry.timestamp > max_age:
                             del self.cache[key]
                     finally:
                         entry.lock.release()
@@ -240,3 +419,284 @@ class QueryCache(object):
                 self.locks.checkout.release()
 
             last = time.time()
+
+
+    def clear(self):
+        """Drop every entry.
+        """
+        self.locks.checkout.acquire()
+        try:  # critical section
+            self.cache.clear()
+        finally:
+            self.locks.checkout.release()
+
+
+    def invalidate(self, table):
+        """Drop the entries that depend on ``table`` (see ``depends_on``).
+        """
+        self.locks.checkout.acquire()
+        try:  # critical section
+            for key, entry in list(self.cache.items()):
+                if table in entry.tables:
+                    self.cache.pop(key)
+        finally:
+            self.locks.checkout.release()
+
+
+    def listen(self, url, handlers=None):
+        """Start a thread that listens for changes to tables that entries
+        depend on, and drops those entries.
+
+        The ``invalidate_query_cache`` trigger notifies us on the
+        :py:data:`CHANNEL` channel with the table's name as the payload (it
+        also drops shared entries, see :py:class:`PostgresBackend`). We hold
+        a connection to ``url`` of our own for this, rather than tie one up
+        from the pool for good, so only long-running processes that serve
+        cached pages should call this.
+
+        :param dict handlers: other channels to listen on, mapped to callables
+            that we call with the payload of each notification on that channel
+
+        """
+        dsn = url_to_dsn(url) if url.startswith('postgres://') else url
+        handlers = dict(handlers or {})
+        handlers[CHANNEL] = self.invalidate
+        def listen():
+            while True:
+                connection = None
+                try:
+                    connection = psycopg2.connect(dsn)
+                    connection.autocommit = True
+                    cursor = connection.cursor()
+                    for channel in handlers:
+                        cursor.execute("LISTEN " + channel)
+                    while True:
+                        select.select([connection], [], [], 60)
+                        connection.poll()
+                        while connection.notifies:
+                            notify = connection.notifies.pop(0)
+                            handlers[notify.channel](notify.payload)
+                except Exception:
+                    log_dammit(traceback.format_exc().strip())
+                    time.sleep(5)
+                finally:
+                    if connection is not None:
+                        connection.close()
+        self.listener = threading.Thread(target=listen)
+        self.listener.setDaemon(True)
+        self.listener.start()
+
+
+    def _count(self, stat):
+        self.locks.stats.acquire()
+        try:  # critical section
+            setattr(self, stat, getattr(self, stat) + 1)
+        finally:
+            self.locks.stats.release()
+
+
+    def log_metrics(self, _print=print):
+        """Print our hit, miss, and stale counts since the last call, and
+        reset them.
+        """
+        self.locks.stats.acquire()
+        try:  # critical section
+            stats = (self.nhits, self.nmisses, self.nstale, self.nshared)
+            self.nhits = self.nmisses = self.nstale = self.nshared = 0
+        finally:
+            self.locks.stats.release()
+        _print('count#query_cache_hits={} count#query_cache_misses={} '
+               'count#query_cache_stale={} count#query_cache_shared={}'.format(*stats))
+
+
+# Define a bounded query cache.
+# =============================
+
+class LRUQueryCache(QueryCache):
+    """A :py:class:`QueryCache` with a size limit and no pruning thread.
+
+    We hold at most ``maxsize`` entries, and (if given) about ``maxbytes``
+    worth of results, dropping the least recently used entries first. Sizes
+    are estimated with :py:func:`sizeof` when an entry is filled.
+
+    When an entry has expired but is less than ``grace`` seconds past its
+    threshold, we return the stale result straight away and refresh it on a
+    background thread (only one refresh per entry runs at a time). Past that,
+    or on a miss, the caller runs the query, and other callers for the same
+    entry wait for it rather than running it too.
+
+    Exceptions and ``None`` results are cached for ``negative_threshold``
+    seconds instead of the usual threshold.
+
+    Besides hits, misses, and stale hits, we count evictions, callers that
+    waited for another thread to fill an entry, and acquisitions of our
+    global lock that had to wait.
+
+    """
+
+    def __init__(self, db, threshold=5, maxsize=1000, maxbytes=None, grace=60,
+                 negative_threshold=1, backend=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.grace = grace
+        self.negative_threshold = negative_threshold
+        self.nwaited = self.ncontended = 0
+        self._nevicted = 0
+        QueryCache.__init__(self, db, threshold, backend=backend)
+        self.cache = LRU(maxsize, maxbytes, lambda entry: entry.nbytes)
+
+
+    def start_pruner(self):
+        pass  # the LRU keeps us in bounds
+
+
+    def _do_query(self, fetchfunc, query, params, process, threshold, tables, kw):
+        key = self._key(query, params, kw)
+        if threshold is None:
+            threshold = self.threshold
+        fill = lambda entry: self._fill( key, entry, threshold, fetchfunc, query, params, process
+                                       , tables, kw
+                                        )
+
+        self._acquire()
+        try:  # critical section
+            entry = self.cache.get(key)
+            if entry is None:
+                entry = self.cache[key] = Entry()
+        finally:
+            self.locks.checkout.release()
+
+        age = time.time() - entry.timestamp
+        ttl = self._ttl(entry, threshold)
+        if entry.timestamp and age < ttl:
+            self._count('nhits')
+            return self._result(entry)
+        if entry.timestamp and age < ttl + self.grace:
+            self._count('nstale')
+            if entry.lock.acquire(False):
+                self._refresh(entry, threshold, fill)
+            return self._result(entry)
+
+        if not entry.lock.acquire(False):
+            self._count('nwaited')
+            entry.lock.acquire()
+        try:  # critical section
+            if entry.timestamp and time.time() - entry.timestamp < self._ttl(entry, threshold):
+                self._count('nhits')  # someone filled it while we waited
+            else:
+                self._count('nstale' if entry.timestamp else 'nmisses')
+                entry.threshold = threshold
+                fill(entry)
+        finally:
+            entry.lock.release()
+        return self._result(entry)
+
+
+    def _ttl(self, entry, threshold):
+        if entry.exc is not None or (entry.timestamp and entry.result is None):
+            return self.negative_threshold
+        return threshold
+
+
+    def _result(self, entry):
+        if entry.exc is not None:
+            raise entry.exc[0]
+        return entry.result
+
+
+    def _refresh(self, entry, threshold, fill):
+        """Fill ``entry`` on a background thread; the caller holds its lock.
+        """
+        def refresh():
+            try:
+                entry.threshold = threshold
+                fill(entry)
+            finally:
+                entry.lock.release()
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+
+    def _fill(self, key, entry, threshold, fetchfunc, query, params, process, tables, kw):
+        entry.tables = tuple(tables)
+        try:
+            result = self._compute(key, threshold, fetchfunc, query, params, process, tables, kw)
+            entry.result, entry.exc = result, None
+        except:
+            entry.result = None
+            entry.exc = ( FormattingError(traceback.format_exc())
+                        , sys.exc_info()[2]
+                         )
+        entry.nbytes = sizeof(entry.result) if self.maxbytes else 0
+        entry.timestamp = time.time()
+
+        self._acquire()
+        try:  # critical section
+            if self.cache.get(key) is entry:
+                self.cache[key] = entry  # re-measure it
+        finally:
+            self.locks.checkout.release()
+
+
+    def _acquire(self):
+        if not self.locks.checkout.acquire(False):
+            self._count('ncontended')
+            self.locks.checkout.acquire()
+
+
+    def clear(self):
+        self._acquire()
+        try:  # critical section
+            self.cache.clear()
+        finally:
+            self.locks.checkout.release()
+
+
+    def invalidate(self, table):
+        self._acquire()
+        try:  # critical section
+            for key, entry in self.cache.items():
+                if table in entry.tables:
+                    self.cache.pop(key)
+        finally:
+            self.locks.checkout.release()
+
+
+    def log_metrics(self, _print=print):
+        """Print our hit, miss, stale, eviction, wait, and contention counts
+        since the last call, and reset them.
+        """
+        self.locks.stats.acquire()
+        try:  # critical section
+            nevicted = self.cache.nevicted - self._nevicted
+            self._nevicted = self.cache.nevicted
+            stats = ( self.nhits, self.nmisses, self.nstale, self.nshared, nevicted, self.nwaited
+                    , self.ncontended
+                     )
+            self.nhits = self.nmisses = self.nstale = self.nshared = 0
+            self.nwaited = self.ncontended = 0
+        finally:
+            self.locks.stats.release()
+        _print('count#query_cache_hits={} count#query_cache_misses={} '
+               'count#query_cache_stale={} count#query_cache_shared={} count#query_cache_evicted={} '
+               'count#query_cache_waited={} count#query_cache_contended={} '
+               'measure#query_cache_entries={} measure#query_cache_bytes={}'
+               .format(*(stats + (len(self.cache), self.cache.nbytes))))
+
+
+def sizeof(obj, _seen=None):
+    """Estimate how much memory ``obj`` and everything it refers to takes up.
+    """
+    _seen = set() if _seen is None else _seen
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k, _seen) + sizeof(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(x, _seen) for x in obj)
+    elif hasattr(obj, '__dict__'):
+        size += sizeof(obj.__dict__, _seen)
+    return size
@@ -0,0 +1,120 @@
+"""Versioned serializers for the data we keep in ``bytea`` columns.
+
+Serialized data starts with a version byte naming the serializer that wrote
+it, so we can switch formats without rewriting old rows. Our version bytes are
+low control characters, which no pickle starts with, so :py:func:`loads` can
+still read the pickles we used to store.
+
+Besides what the format handles natively, both serializers round-trip
+:py:class:`~decimal.Decimal`, :py:class:`~datetime.datetime`, and
+:py:class:`~datetime.date` values (tuples come back as lists). Anything else
+raises :py:exc:`TypeError` when serializing, rather than when loading.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import pickle
+from datetime import date, datetime
+from decimal import Decimal
+
+from dateutil.parser import parse as parse_datetime
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return {'__decimal__': unicode(obj)}
+    if isinstance(obj, datetime):
+        return {'__datetime__': obj.isoformat()}
+    if isinstance(obj, date):
+        return {'__date__': obj.isoformat()}
+    raise TypeError("{!r} is not serializable".format(obj))
+
+
+_DECODERS = { '__decimal__': Decimal
+            , '__datetime__': parse_datetime
+            , '__date__': lambda s: parse_datetime(s).date()
+             }
+
+def _object_hook(d):
+    if len(d) == 1:
+        key, value = next(iter(d.items()))
+        if key in _DECODERS:
+            return _DECODERS[key](value)
+    return d
+
+
+class JSONSerializer(object):
+    name = 'json'
+    version = b'\x01'
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=_default, separators=(',', ':')).encode('utf8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf8'), object_hook=_object_hook)
+
+
+class MsgpackSerializer(object):
+    """This one is smaller and quicker to load than JSON, but it needs the
+    optional ``msgpack`` package.
+    """
+    name = 'msgpack'
+    version = b'\x02'
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, obj):
+        return self.msgpack.packb(obj, default=_default, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, object_hook=_object_hook, raw=False)
+
+
+SERIALIZERS = (JSONSerializer, MsgpackSerializer)
+_by_name = {s.name: s for s in SERIALIZERS}
+_by_version = {s.version: s for s in SERIALIZERS}
+_instances = {}
+
+
+def get_serializer(name):
+    """Return the serializer called ``name`` (``json`` or ``msgpack``).
+
+    :raises ValueError: if there's no such serializer
+    :raises ImportError: if the serializer needs a package we don't have
+
+    """
+    if name not in _by_name:
+        raise ValueError("unknown serializer: {!r}".format(name))
+    return _get(_by_name[name])
+
+
+def _get(cls):
+    if cls not in _instances:
+        _instances[cls] = cls()
+    return _instances[cls]
+
+
+def dumps(obj, serializer):
+    """Serialize ``obj`` with ``serializer``, and prefix its version byte.
+    """
+    return serializer.version + serializer.dumps(obj)
+
+
+def loads(data, allow_pickle=True):
+    """Load data written by :py:func:`dumps` with any serializer, or pickled.
+
+    Pass ``allow_pickle=False`` for data we never pickled, so that we raise
+    :py:exc:`ValueError` instead of unpickling whatever is there.
+
+    """
+    data = bytes(data)  # psycopg2 gives us a buffer for bytea
+    cls = _by_version.get(data[:1])
+    if cls is None:
+        if not allow_pickle:
+            raise ValueError("data has no serializer version")
+        return pickle.loads(data)
+    return _get(cls).loads(data[1:])
+
@@ -2,6 +2,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import base64
+from functools import partial
 from math import ceil
 
 import aspen
@@ -140,15 +141,18 @@ class Website(BaseWebsite):
 
 
     def update_cta(self):
-        nusers = self.db.one("""
+        # Every process runs this, so go through the query cache, which with a
+        # shared backend means we only hit the database once per interval.
+        one = partial(self.app.query_cache.one, threshold=self.env.update_cta_every)
+        nusers = one("""
             SELECT nusers FROM paydays
             ORDER BY ts_end DESC LIMIT 1
-        """, default=0)
-        nreceiving_from = self.db.one("""
+        """, default=0, depends_on=('paydays',))
+        nreceiving_from = one("""
             SELECT nreceiving_from
               FROM teams
              WHERE slug = 'Gratipay'
-        """, default=0)
+        """, default=0, depends_on=('teams',))
         self.support_current = cur = int(round(nreceiving_from / nusers * 100)) if nusers else 0
         if cur < 10:    goal = 20
         elif cur < 15:  goal = 30
@@ -160,10 +164,10 @@ class Website(BaseWebsite):
         elif cur > 70:  goal = None
         self.support_goal = goal
 
-        self.campaign_npayments, self.campaign_raised = self.db.one("""
+        self.campaign_npayments, self.campaign_raised = one("""
             SELECT count(amount), coalesce(sum(amount), 0)
               FROM payments_for_open_source
              WHERE braintree_result_message = ''
                AND ctime < '2017-11-01'::timestamptz
                   ;
-        """)
+        """, back_as=tuple)
@@ -17,6 +17,7 @@ import balanced
 import braintree
 import gratipay
 import gratipay.billing.payday
+from gratipay.billing import braintree_executor
 import raven
 from environment import Environment, is_yesish
 from gratipay.application import Application
@@ -31,6 +32,7 @@ from gratipay.elsewhere.twitter import Twitter
 from gratipay.elsewhere.venmo import Venmo
 from gratipay.models.account_elsewhere import AccountElsewhere
 from gratipay.models.participant import Participant, Identity
+from gratipay.security import authentication
 from gratipay.security.crypto import EncryptingPacker
 from gratipay.utils import find_files
 from gratipay.utils.http_caching import asset_etag
@@ -45,6 +47,9 @@ def base_url(website, env):
 def secure_cookies(env):
     gratipay.use_secure_cookies = env.base_url.startswith('https')
 
+def session_cache(env):
+    authentication.session_cache.ttl = env.session_cache_ttl
+
 def db(env):
 
     # Instantiating Application calls the rest of these wireup functions, and
@@ -78,6 +83,13 @@ def billing(env):
         env.braintree_private_key
     )
 
+    braintree_executor.configure( concurrency=env.braintree_concurrency
+                                , rate=env.braintree_rate_limit
+                                , timeout=env.braintree_timeout
+                                , retries=env.braintree_retries
+                                , log_every=env.braintree_log_stats_every
+                                 )
+
 
 def username_restrictions(website):
     gratipay.RESTRICTED_USERNAMES = os.listdir(website.www_root)
@@ -352,6 +364,11 @@ def env():
         BRAINTREE_PUBLIC_KEY            = unicode,
         BRAINTREE_PRIVATE_KEY           = unicode,
         BRAINTREE_CLIENT_AUTHORIZATION  = unicode,
+        BRAINTREE_CONCURRENCY           = int,
+        BRAINTREE_RATE_LIMIT            = float,
+        BRAINTREE_TIMEOUT               = float,
+        BRAINTREE_RETRIES               = int,
+        BRAINTREE_LOG_STATS_EVERY       = int,
         GITHUB_CLIENT_ID                = unicode,
         GITHUB_CLIENT_SECRET            = unicode,
         GITHUB_CALLBACK                 = unicode,
@@ -382,10 +399,30 @@ def env():
         UPDATE_CTA_EVERY                = int,
         CHECK_DB_EVERY                  = int,
         CHECK_NPM_SYNC_EVERY            = int,
+        NPM_SYNC_BATCH_SIZE             = int,
+        NPM_SYNC_FLUSH_EVERY            = int,
+        NPM_SYNC_QUEUE_SIZE             = int,
+        NPM_SYNC_LOG_METRICS_EVERY      = int,
+        NPM_SYNC_FINGERPRINT_CACHE_SIZE = int,
         EMAIL_QUEUE_FLUSH_EVERY         = int,
-        EMAIL_QUEUE_SLEEP_FOR           = int,
+        EMAIL_QUEUE_BATCH_SIZE          = int,
+        EMAIL_QUEUE_CONCURRENCY         = int,
+        EMAIL_QUEUE_SEND_RATE           = float,
         EMAIL_QUEUE_ALLOW_UP_TO         = int,
         EMAIL_QUEUE_LOG_METRICS_EVERY   = int,
+        EMAIL_QUEUE_CONTEXT_FORMAT      = unicode,
+        EMAIL_QUEUE_CLAIM_TIMEOUT       = int,
+        EMAIL_WORKER_POLL_EVERY         = int,
+        EMAIL_WORKER_HEARTBEAT_EVERY    = int,
+        QUERY_CACHE_THRESHOLD           = int,
+        QUERY_CACHE_MAXSIZE             = int,
+        QUERY_CACHE_MAXBYTES            = int,
+        QUERY_CACHE_GRACE               = int,
+        QUERY_CACHE_NEGATIVE_THRESHOLD  = int,
+        QUERY_CACHE_LOG_METRICS_EVERY   = int,
+        QUERY_CACHE_BACKEND             = unicode,
+        QUERY_CACHE_LISTEN              = is_yesish,
+        SESSION_CACHE_TTL               = int,
         OPTIMIZELY_ID                   = unicode,
         SENTRY_DSN                      = unicode,
         CSP_REPORT_URI                  = unicode,
@@ -399,6 +436,7 @@ def env():
         GUNICORN_OPTS                   = unicode,
         LIBERAPAY_BASE_URL              = unicode,
         LIBERAPAY_SECRET                = unicode,
+        PAYDAY_ENGINE                   = unicode,
     )
 
 
@@ -1,4 +1,11 @@
 from aspen import log
 from gratipay.application import Application
+from gratipay.security import authentication
 log('Instantiating Application from gunicorn_entrypoint')
-website = Application().website
+app = Application()
+if app.env.query_cache_listen:
+    # only the web process serves cached pages and sessions
+    app.query_cache.listen( app.env.database_url
+                          , {authentication.CHANNEL: authentication.session_cache.handle_notification}
+                           )
+website = app.website
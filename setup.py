@@ -7,12 +7,15 @@ setup( name='gratipay'
      , version=get_version()
      , packages=find_packages()
      , entry_points = { 'console_scripts'
-                      : [             'payday=gratipay.cli.payday:main'
-                        ,          'fake-data=gratipay.cli.fake_data:main'
-                        ,           'sync-npm=gratipay.cli.sync_npm:main'
-                        , 'queue-branch-email=gratipay.cli.queue_branch_email:main'
-                        ,  'flush-email-queue=gratipay.cli.flush_email_queue:main'
-                        ,   'list-email-queue=gratipay.cli.list_email_queue:main'
+                      : [               'payday=gratipay.cli.payday:main'
+                        ,            'fake-data=gratipay.cli.fake_data:main'
+                        ,             'sync-npm=gratipay.cli.sync_npm:main'
+                        ,   'queue-branch-email=gratipay.cli.queue_branch_email:main'
+                        ,    'flush-email-queue=gratipay.cli.flush_email_queue:main'
+                        ,     'list-email-queue=gratipay.cli.list_email_queue:main'
+                        ,     'benchmark-payday=gratipay.cli.benchmark_payday:main'
+                        , 'reencode-email-queue=gratipay.cli.reencode_email_queue:main'
+                        ,         'email-worker=gratipay.cli.email_worker:main'
                          ]
                        }
       )
@@ -58,6 +58,7 @@ CREATE TABLE payday_payments_done AS
 DROP TABLE IF EXISTS payday_payment_instructions;
 CREATE TABLE payday_payment_instructions AS
     SELECT s.id, participant_id, team_id, amount, due
+         , row_number() OVER (ORDER BY p.claimed_time ASC, s.ctime ASC, s.id ASC) AS ord
       FROM ( SELECT DISTINCT ON (participant_id, team_id) *
                FROM payment_instructions
               WHERE mtime < (SELECT ts_start FROM current_payday())
@@ -72,7 +73,7 @@ CREATE TABLE payday_payment_instructions AS
                 AND t.slug = done.team
                 AND direction = 'to-team'
            ) IS NULL
-  ORDER BY p.claimed_time ASC, s.ctime ASC;
+  ORDER BY p.claimed_time ASC, s.ctime ASC, s.id ASC;
 
 CREATE INDEX ON payday_payment_instructions (participant_id);
 CREATE INDEX ON payday_payment_instructions (team_id);
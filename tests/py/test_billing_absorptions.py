@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.billing.absorptions import take_over_balances
+from gratipay.models.account_elsewhere import AccountElsewhere
+from gratipay.testing import Harness, D,P
+
+
+class TestTakeOverBalances(Harness):
+
+    def make_chain(self, n, balances=None):
+        """Make ``n`` archived participants absorbed one after another by the
+        next, and a live participant at the end.
+        """
+        balances = balances or {}
+        usernames = ['p{}'.format(i) for i in range(n + 1)]
+        for i, username in enumerate(usernames):
+            self.make_participant(username, balance=balances.get(i, 0))
+        for dead, live in zip(usernames, usernames[1:]):
+            self.db.run("""
+                INSERT INTO absorptions (absorbed_was, absorbed_by, archived_as)
+                     VALUES (%s, %s, %s)
+            """, ('was-' + dead, live, dead))
+        return usernames
+
+    def take_over_balances(self, **kw):
+        with self.db.get_cursor() as cursor:
+            return take_over_balances(cursor, **kw)
+
+    def test_does_nothing_without_absorptions(self):
+        self.make_participant('alice', balance=10)
+        assert self.take_over_balances() == []
+        assert P('alice').balance == 10
+
+    def test_follows_a_deep_chain_in_one_pass(self):
+        usernames = self.make_chain(50, {0: D('5.00'), 30: D('3.00')})
+        chains = self.take_over_balances()
+        assert [(c.source, c.target, c.amount) for c in chains] == [ ('p0', 'p50', D('5.00'))
+                                                                  , ('p30', 'p50', D('3.00'))
+                                                                   ]
+        assert chains[0].path == usernames
+        assert chains[1].path == usernames[30:]
+        assert P('p0').balance == P('p30').balance == 0
+        assert P('p50').balance == D('8.00')
+        transfers = self.db.all("SELECT tipper, tippee, amount, context FROM transfers")
+        assert sorted(transfers) == [ ('p0', 'p50', D('5.00'), 'take-over')
+                                    , ('p30', 'p50', D('3.00'), 'take-over')
+                                     ]
+
+    def test_settles_several_chains(self):
+        self.make_participant('alice', balance=1)
+        self.make_participant('bob')
+        self.make_participant('carl', balance=2)
+        self.make_participant('dana')
+        self.db.run("""
+            INSERT INTO absorptions (absorbed_was, absorbed_by, archived_as)
+                 VALUES ('a', 'bob', 'alice'), ('c', 'dana', 'carl')
+        """)
+        assert len(self.take_over_balances()) == 2
+        assert P('bob').balance == 1
+        assert P('dana').balance == 2
+
+    def test_can_be_limited_to_chains_ending_at_one_account(self):
+        self.make_chain(3, {0: D('1.00')})
+        self.make_participant('alice', balance=2)
+        self.make_participant('bob')
+        self.db.run("""
+            INSERT INTO absorptions (absorbed_was, absorbed_by, archived_as)
+                 VALUES ('a', 'bob', 'alice')
+        """)
+        chains = self.take_over_balances(absorbed_by='bob')
+        assert [c.source for c in chains] == ['alice']
+        assert P('p0').balance == 1
+        assert P('bob').balance == 2
+
+    def test_ignores_empty_accounts(self):
+        self.make_chain(3)
+        assert self.take_over_balances() == []
+
+
+class TestTakeOverSweepsAbsorbedAccounts(Harness):
+
+    def test_take_over_sweeps_money_left_in_accounts_absorbed_earlier(self):
+        alice = self.make_participant('alice', claimed_time='now', elsewhere='github')
+        bob = self.make_participant('bob', claimed_time='now', elsewhere='twitter')
+        self.make_participant('carl', claimed_time='now', elsewhere='twitter')
+
+        # bob absorbs carl, then money lands in carl's archived account
+        bob.take_over(AccountElsewhere.from_user_name('twitter', 'carl'), have_confirmation=True)
+        archived_as = self.db.one("SELECT archived_as FROM absorptions")
+        self.db.run("UPDATE participants SET balance = 7 WHERE username=%s", (archived_as,))
+
+        # alice takes bob's last login, absorbing him, and what carl's account got
+        alice.take_over(AccountElsewhere.from_user_name('twitter', 'carl'), have_confirmation=True)
+        assert P('alice').balance == 7
+        assert alice.balance == 7
+        assert P(archived_as).balance == 0
@@ -1,18 +1,25 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
+from datetime import timedelta
 
 import braintree
 import mock
 import pytest
 
+from gratipay.billing import braintree_executor
 from gratipay.billing.exchanges import create_card_hold, MINIMUM_CHARGE
-from gratipay.billing.payday import NoPayday, Payday
+from gratipay.billing.payday import ( MEASURED_STAGES, NoPayday, PAYIN_STEPS, Payday
+                                    , backfill_facts
+                                     )
+from gratipay.cli.fake_data import main as fake_data_cli
 from gratipay.exceptions import NegativeBalance
 from gratipay.models.participant import Participant
-from gratipay.testing import Foobar, D,P
+from gratipay.testing import Foobar, Harness, D,P
 from gratipay.testing.billing import BillingHarness, PaydayMixin
+from gratipay.testing.fake_braintree import FakeBraintree
 from gratipay.testing.email import QueuedEmailHarness
+from gratipay.utils import serializers
 
 
 class TestPayday(BillingHarness):
@@ -184,6 +191,36 @@ class TestPayday(BillingHarness):
         nusers = self.db.one("SELECT nusers FROM paydays")
         assert nusers == 1
 
+    def test_payday_records_facts(self):
+        Enterprise = self.make_team(is_approved=True)
+        alice = self.make_participant('alice', claimed_time='now', balance=20)
+        alice.set_payment_instruction(Enterprise, '10.00')
+        self.obama.set_payment_instruction(Enterprise, '6.00')  # below MINIMUM_CHARGE
+        self.run_payday()
+
+        facts = self.db.all("""
+            SELECT participant_id, team_id, amount, direction, is_due FROM payday_facts
+        """)
+        picard = P('picard')
+        assert sorted(facts) == sorted([ (alice.id, Enterprise.id, D('10.00'), 'to-team', False)
+                                       , (picard.id, Enterprise.id, D('10.00'), 'to-participant', False)
+                                       , (self.obama.id, Enterprise.id, D('6.00'), 'to-team', True)
+                                        ])
+        assert self.db.one("SELECT nusers, nteams, volume FROM paydays") == (3, 1, D('10.00'))
+
+    def test_backfill_facts_reconstructs_facts_from_payments_and_events(self):
+        Enterprise = self.make_team(is_approved=True)
+        alice = self.make_participant('alice', claimed_time='now', balance=20)
+        alice.set_payment_instruction(Enterprise, '10.00')
+        self.obama.set_payment_instruction(Enterprise, '6.00')  # below MINIMUM_CHARGE
+        self.run_payday()
+        recorded = sorted(self.db.all("SELECT * FROM payday_facts"))
+        self.db.run("DELETE FROM payday_facts")
+
+        assert backfill_facts(self.db) == 1
+        assert sorted(self.db.all("SELECT * FROM payday_facts")) == recorded
+        assert backfill_facts(self.db) == 0
+
     @mock.patch('aspen.log')
     def test_start_prepare(self, log):
         self.clear_tables()
@@ -232,6 +269,19 @@ class TestPayday(BillingHarness):
         for args, _ in log.call_args_list:
             assert args[0] == expected_logging_call_args.pop()
 
+    def test_payday_records_metrics_for_each_stage(self):
+        self.run_payday()
+        stages = self.db.all("SELECT stage FROM payday_metrics")
+        assert sorted(stages) == sorted(MEASURED_STAGES)
+
+    @mock.patch('gratipay.billing.payday.print', create=True)
+    def test_payday_prints_metrics(self, print_):
+        with mock.patch.object(self.app.env, 'log_metrics', True):
+            self.run_payday()
+        lines = [args[0] for args, _ in print_.call_args_list]
+        assert any(l.startswith('measure#payday_prepared=') for l in lines)
+        assert 'count#payday_notify_participants_rows=0' in lines
+
     def test_end(self):
         self.start_payday().end()
         result = self.db.one("SELECT count(*) FROM paydays "
@@ -502,6 +552,39 @@ class TestPayin(BillingHarness):
         assert filename.endswith('_payments.csv')
         os.unlink(filename)
 
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_payin_checkpoints_each_step(self, fch):
+        fch.return_value = {}
+        alice = self.make_participant('alice', claimed_time='now', balance=100)
+        alice.set_payment_instruction(self.make_team(is_approved=True), D('10'))
+        payday = self.start_payday()
+        payday.payin()
+        checkpoints = self.db.one("SELECT checkpoints FROM paydays WHERE id=%s", (payday.id,))
+        assert sorted(checkpoints) == sorted(PAYIN_STEPS)
+        assert all(c['seconds'] >= 0 for c in checkpoints.values())
+        assert checkpoints['prepared']['engine'] == self.payday_engine
+
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_payin_resumes_after_the_last_checkpoint(self, fch):
+        fch.return_value = {}
+        alice = self.make_participant('alice', claimed_time='now', balance=100)
+        alice.set_payment_instruction(self.make_team(is_approved=True), D('10'))
+
+        with mock.patch.object(Payday, 'process_takes') as process_takes:
+            process_takes.side_effect = Foobar
+            with self.assertRaises(Foobar):
+                self.start_payday().payin()
+        checkpoints = self.db.one("SELECT checkpoints FROM paydays")
+        assert sorted(checkpoints) == ['holds_created', 'instructions_processed', 'prepared']
+
+        with mock.patch.object(Payday, 'prepare') as prepare:
+            with mock.patch.object(Payday, 'create_card_holds') as create_card_holds:
+                self.start_payday().payin()
+        assert not prepare.called
+        assert not create_card_holds.called
+        assert P('alice').balance == D('90')
+        assert P('picard').balance == D('10')
+
 
 class TestTakes(BillingHarness):
 
@@ -637,3 +720,283 @@ class TestNotifyParticipants(QueuedEmailHarness, PaydayMixin):
             assert 'Gratiteam' in self.get_last_email()['body_text']
             assert 'Gratiteam' in self.get_last_email()['body_html']
             self.app.email_queue.flush()
+
+    def test_it_looks_up_top_teams_for_everyone_at_once(self):
+        Gratiteam = self.make_team('Gratiteam', is_approved=True)
+        Trident = self.make_team('The Trident', is_approved=True)
+        kalel = self.make_participant('kalel', claimed_time='now', is_suspicious=False,
+                                                email_address='kalel@example.net', notify_charge=3)
+        kara = self.make_participant('kara', claimed_time='now', is_suspicious=False,
+                                               email_address='kara@example.net', notify_charge=3)
+        kalel.set_payment_instruction(Gratiteam, 10)
+        kalel.set_payment_instruction(Trident, 20)
+        kara.set_payment_instruction(Gratiteam, 10)
+
+        payday = self.start_payday()
+        self.make_exchange('balanced-cc', 30, 0, kalel, 'succeeded')
+        self.make_exchange('balanced-cc', 10, 0, kara, 'failed')
+        payday.end()
+        with mock.patch.object(self.db, 'one') as one:
+            assert payday.notify_participants() == 2
+        assert not one.called
+
+        contexts = dict((m.participant, serializers.loads(m.context)) for m in self.db.all("""
+            SELECT participant, context FROM email_messages
+        """))
+        assert contexts[kalel.id]['nteams'] == 2
+        assert contexts[kalel.id]['top_team'] == 'TheTrident'
+        assert contexts[kara.id]['nteams'] == 1
+        assert contexts[kara.id]['top_team'] == 'Gratiteam'
+
+
+# Engines
+# =======
+# Run the tests above again against the set-based engine, and check that both
+# engines agree on a fake_data population.
+
+class TestPaydaySetBased(TestPayday):
+    payday_engine = 'set-based'
+    cassette = 'TestPayday'
+
+class TestPayinSetBased(TestPayin):
+    payday_engine = 'set-based'
+    cassette = 'TestPayin'
+
+class TestTakesSetBased(TestTakes):
+    payday_engine = 'set-based'
+    cassette = 'TestTakes'
+
+
+class TestEngines(Harness, PaydayMixin):
+
+    use_VCR = False
+
+    def populate(self):
+        fake_data_cli(self.db, 40, 300, 8, 0)
+        self.db.run("""
+
+            UPDATE exchange_routes SET error='';
+            UPDATE exchange_routes SET network='braintree-cc' WHERE network='balanced-cc';
+            UPDATE teams SET is_approved=true, available=(id % 4) * 25;
+            UPDATE participants SET balance=(id % 5) * 7;
+
+            INSERT INTO takes (ctime, participant_id, team_id, amount, recorder_id)
+                 SELECT now() - '1 day'::interval, p.id, t.id, (p.id % 6) * 5, p.id
+                   FROM participants p
+                   JOIN teams t ON t.id % 3 = p.id % 3;
+
+        """)
+
+    def simulate(self, engine):
+        self.payday_engine = engine
+        payday = self.start_payday()
+        with self.db.get_connection() as conn:  # rolled back on exit
+            cursor = conn.cursor()
+            payday.prepare(cursor)
+            cursor.run("""
+                UPDATE payday_participants SET card_hold_ok=true WHERE has_credit_card AND id % 2 = 0
+            """)
+            payday.process_payment_instructions(cursor)
+            payday.process_takes(cursor, payday.ts_start)
+            payday.process_remainder(cursor)
+            return dict(
+                payments=cursor.all("""
+                    SELECT participant, team, amount, direction
+                      FROM payday_payments
+                  ORDER BY direction, participant, team
+                """),
+                events=cursor.all("""
+                    SELECT payload::text
+                      FROM events
+                     WHERE type='payday'
+                  ORDER BY id
+                """),
+                participants=cursor.all("""
+                    SELECT id, new_balance FROM payday_participants ORDER BY id
+                """),
+                teams=cursor.all("""
+                    SELECT id, balance, available_today FROM payday_teams ORDER BY id
+                """),
+                dues=cursor.all("""
+                    SELECT participant_id, team_id, due
+                      FROM current_payment_instructions
+                  ORDER BY participant_id, team_id
+                """),
+            )
+
+    def test_engines_agree_on_fake_data(self):
+        self.populate()
+        trigger = self.simulate('trigger')
+        set_based = self.simulate('set-based')
+        assert trigger['payments']  # make sure we're testing something
+        assert trigger['events']
+        for key in trigger:
+            assert trigger[key] == set_based[key], key
+
+    def test_set_based_working_tables_dont_outlast_their_step(self):
+        self.populate()
+        self.payday_engine = 'set-based'
+        payday = self.start_payday()
+        tables = ('payday_funding', 'payday_take_payments', 'payday_draws')
+        with self.db.get_connection() as conn:  # temp tables are per-connection
+            cursor = conn.cursor()
+            payday.prepare(cursor)
+            payday.process_payment_instructions(cursor)
+            payday.process_takes(cursor, payday.ts_start)
+            payday.process_remainder(cursor)
+            for table in tables:
+                assert cursor.one("SELECT to_regclass(%s)", (table,)) is not None, table
+            conn.commit()
+            for table in tables:
+                assert cursor.one("SELECT to_regclass(%s)", (table,)) is None, table
+
+    def test_unknown_engine_is_refused(self):
+        self.payday_engine = 'turbo'
+        with self.assertRaises(ValueError):
+            self.start_payday()
+
+
+class TestSimulation(BillingHarness):
+
+    def test_simulation_predicts_payments_without_writing_anything(self):
+        alice = self.make_participant('alice', claimed_time='now', balance=100)
+        picard = self.make_participant('picard', claimed_time='now', last_paypal_result='',
+                                       verified_in='TT', email_address='picard@x.y')
+        crusher = self.make_participant('crusher', claimed_time='now', verified_in='TT',
+                                        email_address='crusher@x.y')
+        Enterprise = self.make_team('The Enterprise', picard, is_approved=True, available=100)
+        Enterprise.add_member(crusher, picard)
+        Enterprise.set_take_for(crusher, 10, crusher)
+        alice.set_payment_instruction(Enterprise, D('80'))
+
+        report = self.app.payday_runner.simulate_payday()
+
+        assert self.db.all("SELECT * FROM paydays") == []
+        assert self.db.all("SELECT * FROM payments") == []
+        assert P('alice').balance == D('100')
+        assert sorted(report['payments']) == [ ('alice', 'TheEnterprise', D('80'), 'to-team')
+                                             , ('crusher', 'TheEnterprise', D('10'), 'to-participant')
+                                             , ('picard', 'TheEnterprise', D('70'), 'to-participant')
+                                              ]
+        assert report['volume'] == D('80')
+        assert report['deltas'] == {alice.id: D('-80'), crusher.id: D('10'), picard.id: D('70')}
+
+    def test_simulation_agrees_with_payday(self):
+        alice = self.make_participant('alice', claimed_time='now', balance=100)
+        picard = self.make_participant('picard', claimed_time='now', last_paypal_result='',
+                                       verified_in='TT', email_address='picard@x.y')
+        Enterprise = self.make_team('The Enterprise', picard, is_approved=True, available=100)
+        alice.set_payment_instruction(Enterprise, D('80'))
+
+        report = self.app.payday_runner.simulate_payday()
+        self.run_payday()
+
+        payments = self.db.all("SELECT participant, team, amount, direction FROM payments")
+        assert sorted(report['payments']) == sorted(payments)
+
+    def test_simulation_skips_takes_a_resumed_payday_already_paid(self):
+        alice = self.make_participant('alice', claimed_time='now', balance=100)
+        bob = self.make_participant('bob', claimed_time='now', balance=10)
+        picard = self.make_participant('picard', claimed_time='now', last_paypal_result='',
+                                       verified_in='TT', email_address='picard@x.y')
+        crusher = self.make_participant('crusher', claimed_time='now', verified_in='TT',
+                                        email_address='crusher@x.y')
+        Enterprise = self.make_team('The Enterprise', picard, is_approved=True, available=100)
+        Enterprise.add_member(crusher, picard)
+        Enterprise.set_take_for(crusher, 10, crusher)
+        alice.set_payment_instruction(Enterprise, D('80'))
+
+        # A payday that crashed after paying bob's gift and crusher's take.
+        payday = self.start_payday()
+        after_start = payday.ts_start + timedelta(seconds=1)
+        paid = [ self.make_payment(bob, Enterprise, D('10'), 'to-team', payday.id, after_start)
+               , self.make_payment(crusher, Enterprise, D('10'), 'to-participant', payday.id,
+                                   after_start)
+                ]
+        self.db.run("UPDATE participants SET balance = balance - 10 WHERE username='bob'")
+        self.db.run("UPDATE participants SET balance = balance + 10 WHERE username='crusher'")
+
+        report = self.app.payday_runner.simulate_payday()
+        assert sorted(report['payments']) == [ ('alice', 'TheEnterprise', D('80'), 'to-team')
+                                             , ('picard', 'TheEnterprise', D('80'), 'to-participant')
+                                              ]
+
+        self.run_payday()
+        payments = self.db.all("""
+            SELECT participant, team, amount, direction FROM payments WHERE id <> ALL(%s)
+        """, (paid,))
+        assert sorted(report['payments']) == sorted(payments)
+
+    def test_simulation_predicts_holds_and_dues(self):
+        Enterprise = self.make_team(is_approved=True)
+        Trident = self.make_team('The Trident', is_approved=True)
+        self.obama.set_payment_instruction(Enterprise, '6.00')     # below MINIMUM_CHARGE
+        self.roman.set_payment_instruction(Trident, '3.00')        # no credit card
+        report = self.app.payday_runner.simulate_payday()
+        assert report['dues'] == {(self.obama.id, Enterprise.id): D('6.00')}
+        assert report['nholds'] == 0
+
+        self.obama.set_payment_instruction(Enterprise, '20.00')
+        report = self.app.payday_runner.simulate_payday()
+        assert report['dues'] == {}
+        assert report['nholds'] == report['ncaptures'] == 1
+        assert report['hold_total'] == report['capture_total'] == D('20.91')
+
+
+class TestFetchCardHolds(Harness):
+
+    use_VCR = False
+
+    def test_fch_reuses_holds_and_cancels_the_rest(self):
+        with FakeBraintree() as bt:
+            reused = bt.authorize(1, '10.00')
+            bt.authorize(2, '20.00')
+            holds = Payday.fetch_card_holds({1, 3})
+            assert holds == {1: reused}
+            assert bt.holds() == [reused]
+
+    def test_fch_keeps_the_biggest_of_duplicate_holds(self):
+        with FakeBraintree() as bt:
+            bt.authorize(1, '10.00')
+            biggest = bt.authorize(1, '30.00')
+            bt.authorize(1, '20.00')
+            holds = Payday.fetch_card_holds({1})
+            assert holds == {1: biggest}
+            assert bt.holds() == [biggest]
+
+    def test_fch_streams_pages_of_holds(self):
+        with FakeBraintree(page_size=2) as bt:
+            for i in range(1, 8):
+                bt.authorize(i, '10.00')
+            holds = Payday.fetch_card_holds({2, 7})
+            assert sorted(holds) == [2, 7]
+            assert bt.npages == 4
+            assert len(bt.holds()) == 2
+
+    def test_fch_raises_cancellation_errors_after_the_scan(self):
+        with FakeBraintree(page_size=1) as bt:
+            bt.authorize(1, '10.00')
+            bt.authorize(2, '10.00')
+            with mock.patch('braintree.Transaction.void', side_effect=Foobar):
+                with self.assertRaises(Foobar):
+                    Payday.fetch_card_holds(set())
+            assert bt.npages == 2
+
+    def test_fch_fetches_each_page_through_the_executor(self):
+        with FakeBraintree() as bt:
+            for i in range(1, 8):
+                bt.authorize(i, '10.00')
+            ncalls = braintree_executor.ncalls
+            with mock.patch('gratipay.billing.payday.CARD_HOLDS_PAGE_SIZE', 2):
+                Payday.fetch_card_holds({2, 7})
+            # one search for ids, four pages, five cancellations
+            assert braintree_executor.ncalls - ncalls == 10
+
+    def test_fch_logs_the_holds_it_actually_canceled(self):
+        with FakeBraintree() as bt:
+            bt.authorize(1, '10.00')
+            with mock.patch('braintree.Transaction.void', side_effect=Foobar):
+                with mock.patch('gratipay.billing.payday.log') as log:
+                    with self.assertRaises(Foobar):
+                        Payday.fetch_card_holds(set())
+        log.assert_any_call('Found 0 card holds to reuse, canceled 0 of 1.')
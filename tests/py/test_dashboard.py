@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
+
+from gratipay.billing.payday import MEASURED_STAGES
 from gratipay.testing.billing import BillingHarness
 
 
@@ -46,3 +49,26 @@ class TestNMassPays(BillingHarness):
         self.run_payday(); self.post_masspays(3)
         self.run_payday(); self.post_masspays(8)
         assert self.client.GET('/dashboard/nmasspays').body == '3'
+
+
+class TestPaydayMetrics(BillingHarness):
+
+    def setUp(self):
+        BillingHarness.setUp(self)
+        self.make_participant('admin', claimed_time='now', is_admin=True)
+
+    def test_payday_metrics_are_admin_only(self):
+        assert self.client.GxT('/dashboard/payday.json').code == 401
+        assert self.client.GxT('/dashboard/payday.json', auth_as='obama').code == 403
+
+    def test_payday_metrics_chart_each_payday(self):
+        self.run_payday()
+        self.run_payday()
+        series = json.loads(self.client.GET('/dashboard/payday.json', auth_as='admin').body)
+        assert len(series) == 2
+        assert series[0]['xText'] > series[1]['xText']
+        assert abs(series[0]['total'] - sum(series[0][s] for s in MEASURED_STAGES)) < 0.01
+
+    def test_payday_metrics_page_barely_works(self):
+        self.run_payday()
+        assert 'take_over_balances' in self.client.GET('/dashboard/payday', auth_as='admin').body
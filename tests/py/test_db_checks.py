@@ -26,3 +26,21 @@ class Tests(Harness):
 
         with self.db.get_cursor() as cursor:
             models._check_balances(cursor)
+
+
+class TestQueryCounting(Harness):
+
+    def test_every_kind_of_record_counts(self):
+        nqueries = self.db.nqueries
+        self.db.run("SELECT 1")
+        self.db.one("SELECT 1")
+        for back_as in (tuple, 'namedtuple', dict):
+            self.db.all("SELECT 1", back_as=back_as)
+            with self.db.get_cursor(back_as=back_as) as cursor:
+                cursor.one("SELECT 1")
+        assert self.db.nqueries == nqueries + 8
+
+    def test_back_as_still_works(self):
+        assert self.db.one("SELECT 1 AS n, 2 AS m", back_as=dict) == {'n': 1, 'm': 2}
+        assert self.db.one("SELECT 1 AS n, 2 AS m", back_as=tuple) == (1, 2)
+        assert self.db.one("SELECT 1 AS n, 2 AS m", back_as='namedtuple').m == 2
@@ -1,11 +1,19 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import os
+import pickle
 import time
+from collections import namedtuple
 
+import mock
+from markupsafe import escape as htmlescape
 from pytest import raises
 
+from gratipay.email import CHANNEL, Worker, compile_email_spt
 from gratipay.exceptions import NoEmailAddress, Throttled
-from gratipay.testing import Harness
+from gratipay.models.participant import Participant
+from gratipay.testing import D, Foobar, Harness, P
+from gratipay.utils import i18n, serializers
 from gratipay.testing.email import SentEmailHarness, QueuedEmailHarness
 
 
@@ -78,6 +86,27 @@ class TestPut(QueuedEmailHarness):
         assert self.app.email_queue.flush() == 3
         self.app.email_queue.put(self.alice, "base")
 
+    def test_put_many_queues_system_initiated_messages(self):
+        bob = self.make_participant('bob', claimed_time='now', email_address='bob@example.com')
+        nqueued = self.app.email_queue.put_many([ (self.alice, 'base', {'foo': 1})
+                                                , (bob, 'branch', {})
+                                                 ])
+        assert nqueued == 2
+        rows = self.db.all("""
+            SELECT participant, spt_name, user_initiated FROM email_messages ORDER BY id
+        """)
+        assert rows == [(self.alice.id, 'base', False), (bob.id, 'branch', False)]
+
+    def test_put_many_inserts_in_batches(self):
+        nqueued = self.app.email_queue.put_many([(self.alice, 'base', {})] * 5, batch_size=2)
+        assert nqueued == 5
+        assert self.db.one("SELECT count(*) FROM email_messages") == 5
+        self.app.email_queue.put(self.alice, "base")  # not throttled
+        assert self.get_last_email()['to'] == 'alice <alice@example.com>'
+
+    def test_put_many_with_nothing_to_put(self):
+        assert self.app.email_queue.put_many([]) == 0
+
 
 class TestFlush(SentEmailHarness):
 
@@ -124,12 +153,251 @@ class TestFlush(SentEmailHarness):
         assert self.count_email_messages() == 0  # nothing sent
         assert self.db.one("SELECT result FROM email_messages") == 'SomeProblem()'
 
+    def test_flush_works_in_batches(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        self.app.email_queue.put_many([(larry, 'base', {})] * 5)
+        with mock.patch.object(self.app.email_queue, 'batch_size', 2):
+            with mock.patch.object( self.app.email_queue
+                                  , '_store_results'
+                                  , wraps=self.app.email_queue._store_results
+                                   ) as store_results:
+                assert self.app.email_queue.flush() == 5
+        assert [len(c[0][1]) for c in store_results.call_args_list] == [2, 2, 1]
+        assert self.db.all("SELECT DISTINCT result FROM email_messages") == ['']
+        assert self.db.all("SELECT DISTINCT remote_message_id FROM email_messages") == ['deadbeef']
+
+    def test_flush_loads_participants_once_per_batch(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        moe = self.make_participant('moe', email_address='moe@example.com')
+        self.app.email_queue.put_many([(larry, 'base', {}), (moe, 'base', {})] * 3)
+        queue = self.app.email_queue
+        queue.nflushed = queue.nflush_queries = 0
+        with mock.patch.object(Participant, 'from_id') as from_id:
+            assert queue.flush() == 6
+        assert not from_id.called
+        assert self.count_email_messages() == 6
+        assert self.db.all("SELECT DISTINCT result FROM email_messages") == ['']
+        # claim, load participants, store results
+        assert (queue.nflushed, queue.nflush_queries) == (6, 3)
+
+    def test_flush_sends_through_the_executor(self):
+        self.put_message()
+        ncalls = self.app.email_queue.executor.ncalls
+        self.app.email_queue.flush()
+        assert self.app.email_queue.executor.ncalls == ncalls + 1
+
+    def test_flush_skips_messages_claimed_by_another_flusher(self):
+        self.put_message()
+        self.make_participant('moe', email_address='moe@example.com')
+        self.app.email_queue.put(P('moe'), "base")
+        larrys = self.db.one("SELECT id FROM email_messages ORDER BY id LIMIT 1")
+        with self.db.get_connection() as connection:
+            cursor = connection.cursor()
+            cursor.run("SELECT * FROM email_messages WHERE id=%s FOR UPDATE", (larrys,))
+            assert self.app.email_queue.flush() == 1
+        assert self.get_last_email()['to'] == 'moe <moe@example.com>'
+        assert self.db.one("SELECT result FROM email_messages WHERE id=%s", (larrys,)) is None
+
+    def test_flush_doesnt_resend_a_batch_whose_results_it_lost(self):
+        self.put_message()
+        queue = self.app.email_queue
+        with mock.patch.object(queue, '_store_results', side_effect=Foobar):
+            raises(Foobar, queue.flush)
+        assert self.db.one("SELECT claimed IS NOT NULL FROM email_messages") is True
+        with mock.patch.object(queue._mailer, 'send_email') as send_email:
+            assert queue.flush() == 0
+        assert not send_email.called
+
+    def test_flush_gives_up_on_stale_claims(self):
+        self.put_message()
+        queue = self.app.email_queue
+        with mock.patch.object(queue, '_store_results', side_effect=Foobar):
+            raises(Foobar, queue.flush)
+        assert queue.reap_lost_claims() == 0  # not stale yet
+        self.db.run("UPDATE email_messages SET claimed = claimed - interval '11 minutes'")
+        with mock.patch.object(queue._mailer, 'send_email') as send_email:
+            assert queue.flush() == 0
+        assert not send_email.called
+        assert self.db.one("SELECT result FROM email_messages").startswith('lost: claimed at ')
+        larry = P('larry')
+        with self.db.get_cursor() as cursor:
+            assert queue._get_nqueued(cursor, larry, None) == 0
+
+    def test_flush_finishes_the_batch_before_raising(self):
+        self.put_message(email_address=None)
+        self.make_participant('moe', email_address='moe@example.com')
+        self.app.email_queue.put(P('moe'), "base")
+        raises(NoEmailAddress, self.app.email_queue.flush)
+        assert self.count_email_messages() == 1
+        assert self.db.all("SELECT result FROM email_messages ORDER BY id") == \
+                                                                        ['NoEmailAddress()', '']
+
+
+class TestReencodePending(QueuedEmailHarness):
+
+    def put_pickled(self, participant, context):
+        self.app.email_queue.put(participant, 'base')
+        self.db.run("UPDATE email_messages SET context=%s WHERE id=(SELECT max(id) FROM email_messages)"
+                   , (pickle.dumps(context),))
+
+    def test_put_uses_the_configured_serializer(self):
+        alice = self.make_participant('alice', email_address='alice@example.com')
+        self.app.email_queue.put(alice, 'base', amount=D('1.00'))
+        context = bytes(self.db.one("SELECT context FROM email_messages"))
+        assert context[:1] == self.app.email_queue.serializer.version
+        assert serializers.loads(context)['amount'] == D('1.00')
+
+    def test_put_stores_contexts_with_backslashes_and_non_ascii(self):
+        alice = self.make_participant('alice', email_address='alice@example.com')
+        self.app.email_queue.put(alice, 'base', name='Ren\xe9e \\o/')
+        context = serializers.loads(self.db.one("SELECT context FROM email_messages"))
+        assert context['name'] == 'Ren\xe9e \\o/'
+
+    def test_old_pickles_still_get_sent(self):
+        alice = self.make_participant('alice', email_address='alice@example.com')
+        self.put_pickled(alice, {'include_unsubscribe': False})
+        assert 'To stop receiving emails' not in self.get_last_email()['body_text']
+
+    def test_reencodes_pending_pickles(self):
+        alice = self.make_participant('alice', email_address='alice@example.com')
+        self.put_pickled(alice, {'amount': D('1.00')})
+        self.put_pickled(alice, {'amount': D('2.00')})
+        self.db.run("UPDATE email_messages SET result='' WHERE id=(SELECT min(id) FROM email_messages)")
+        assert self.app.email_queue.reencode_pending() == (1, 0)
+        contexts = [bytes(c) for c in self.db.all("SELECT context FROM email_messages ORDER BY id")]
+        assert contexts[0][:1] == b'('  # already sent, so left alone
+        assert contexts[1][:1] == self.app.email_queue.serializer.version
+        assert serializers.loads(contexts[1]) == {'amount': D('2.00')}
+        assert self.app.email_queue.reencode_pending() == (0, 0)
+
+    def test_reencode_pending_skips_what_it_cant_encode(self):
+        alice = self.make_participant('alice', email_address='alice@example.com')
+        self.put_pickled(alice, {'ids': {1, 2}})
+        assert self.app.email_queue.reencode_pending() == (0, 1)
+        assert bytes(self.db.one("SELECT context FROM email_messages"))[:1] != \
+                                                            self.app.email_queue.serializer.version
+
+
+class TestWorker(SentEmailHarness):
+
+    def make_worker(self, nwaits=1, **kw):
+        def select(*a):
+            waits.append(a)
+            if len(waits) >= nwaits:
+                worker.stop()
+        waits = []
+        worker = Worker(self.app.email_queue, _select=select, **kw)
+        return worker
+
+    def test_put_notifies_the_channel(self):
+        alice = self.make_participant('alice', email_address='alice@example.com')
+        with self.db.get_connection() as connection:
+            connection.autocommit = True
+            connection.cursor().execute('LISTEN ' + CHANNEL)
+            self.app.email_queue.put(alice, 'base')
+            connection.poll()
+            assert [n.channel for n in connection.notifies] == [CHANNEL]
+            connection.cursor().execute('UNLISTEN ' + CHANNEL)
+            connection.autocommit = False
+
+    def test_worker_flushes_until_stopped(self):
+        alice = self.make_participant('alice', email_address='alice@example.com')
+        self.app.email_queue.put(alice, 'base')
+        worker = self.make_worker(nwaits=3)
+        worker.run()
+        assert self.count_email_messages() == 1
+        assert worker.nsent == 1
+
+    def test_worker_stops_between_batches(self):
+        alice = self.make_participant('alice', email_address='alice@example.com')
+        self.app.email_queue.put_many([(alice, 'base', {})] * 3)
+        worker = self.make_worker()
+        with mock.patch.object(self.app.email_queue, 'batch_size', 1):
+            with mock.patch.object(self.app.email_queue, '_mailer') as mailer:
+                def send_email(**message):
+                    worker.stop()
+                    return {'MessageId': 'deadbeef'}
+                mailer.send_email = send_email
+                worker.run()
+        assert worker.nsent == 1
+        assert self.db.one("SELECT count(*) FROM email_messages WHERE result IS NULL") == 2
+
+    def test_worker_keeps_going_after_a_failure(self):
+        larry = self.make_participant('larry', email_address=None)
+        self.app.email_queue.put(larry, 'base')
+        worker = self.make_worker(nwaits=2)
+        with mock.patch.object(self.app.email_queue, 'tell_sentry') as tell_sentry:
+            worker.run()
+        assert tell_sentry.call_count == 1
+        assert isinstance(tell_sentry.call_args[0][0], NoEmailAddress)
+
+    def test_worker_prints_a_heartbeat(self):
+        printed = []
+        times = iter([0, 30, 61, 62])
+        worker = self.make_worker( nwaits=2
+                                 , heartbeat_every=60
+                                 , _print=printed.append
+                                 , _time=lambda: next(times)
+                                  )
+        worker.nsent, worker.nwakeups = 4, 2
+        worker.run()
+        assert printed == ['count#email_worker_heartbeat=1 count#email_worker_sent=4 '
+                           'count#email_worker_wakeups=2']
+        assert (worker.nsent, worker.nwakeups) == (0, 0)
+
+
+Exchange = namedtuple('Exchange', 'amount fee note')
+
+
+class TestRender(Harness):
+
+    use_VCR = False
+
+    def test_render_puts_the_body_in_the_layout(self):
+        queue = self.app.email_queue
+        locale = i18n.match_lang(i18n.parse_accept_lang('en'))
+        context = dict( include_unsubscribe=True
+                      , participant=self.make_participant('alice')
+                      , exchange=Exchange(D('10.00'), D('0.61'), 'Declined & stuff')
+                      , top_team='<Enterprise>'
+                      , nteams=1
+                       )
+        subject, text, html = queue.render('charge_failed', context, locale)
+
+        # Render the layout and the body separately, as we used to.
+        emails = os.path.join(self.app.website.project_root, 'emails')
+        base = compile_email_spt(os.path.join(emails, 'base.spt'))
+        spt = compile_email_spt(os.path.join(emails, 'charge_failed.spt'))
+        def render(t, escape):
+            context_ = dict(context)
+            i18n.add_helpers_to_context(queue.tell_sentry, context_, locale)
+            context_['escape'] = escape
+            b = base[t].render(context_).strip()
+            return b.replace('$body', spt[t].render(context_).strip())
+
+        assert text == render('text/plain', lambda s: s)
+        assert html == render('text/html', htmlescape)
+        assert '&lt;Enterprise&gt;' in html
+        assert 'Declined &amp; stuff' in html
+        assert '<Enterprise>' in subject
+
+    def test_render_reuses_helpers(self):
+        queue = self.app.email_queue
+        locale = i18n.match_lang(i18n.parse_accept_lang('en'))
+        helpers = queue._get_helpers(locale, 'text/html')
+        queue.render('base', {}, locale)
+        assert queue._get_helpers(locale, 'text/html') is helpers
+        assert helpers['escape'] is htmlescape
+        assert queue._get_helpers(locale, 'text/plain')['escape'] is not htmlescape
+
+
 class TestLogMetrics(Harness):
 
     def setUp(self):
         Harness.setUp(self)
         self._log_every = self.app.email_queue.log_every
         self.app.email_queue.log_every = 1
+        self.app.email_queue.nflushed = self.app.email_queue.nflush_queries = 0
 
     def tearDown(self):
         self.app.email_queue.log_every = self._log_every
@@ -153,3 +421,12 @@ class TestLogMetrics(Harness):
         self.app.email_queue.log_metrics(_print=p)
         assert captured['message'] == \
                   'count#email_queue_sent=0 count#email_queue_failed=1 count#email_queue_pending=2'
+
+    def test_log_metrics_reports_queries_per_flushed_message(self):
+        self.app.email_queue._count_flushed(4, 6)
+        captured = {}
+        def p(message): captured['message'] = message
+        self.app.email_queue.log_metrics(_print=p)
+        assert captured['message'].endswith(' measure#email_queue_queries_per_message=1.50')
+        self.app.email_queue.log_metrics(_print=p)
+        assert 'measure#' not in captured['message']
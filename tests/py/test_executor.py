@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+
+import mock
+from gratipay.testing import Foobar, Harness
+from gratipay.utils.executor import CallTimedOut, Executor, TokenBucket
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(Harness):
+
+    def test_allows_a_burst_up_to_capacity(self):
+        clock = Clock()
+        bucket = TokenBucket(2, _time=clock.time, _sleep=clock.sleep)
+        bucket.take()
+        bucket.take()
+        assert clock.sleeps == []
+
+    def test_blocks_when_empty(self):
+        clock = Clock()
+        bucket = TokenBucket(2, _time=clock.time, _sleep=clock.sleep)
+        for i in range(4):
+            bucket.take()
+        assert clock.sleeps == [0.5, 0.5]
+
+
+class TestExecutor(Harness):
+
+    def make_executor(self, **kw):
+        self.clock = Clock()
+        kw.setdefault('transient', (Foobar,))
+        return Executor('test', _time=self.clock.time, _sleep=self.clock.sleep, **kw)
+
+    def test_call_returns_the_result(self):
+        executor = self.make_executor()
+        assert executor.call(lambda a, b=0: a + b, 1, b=2) == 3
+        assert executor.ncalls == 1
+
+    def test_call_retries_transient_errors_with_backoff(self):
+        executor = self.make_executor(retries=3, backoff=1)
+        func = mock.Mock(side_effect=[Foobar, Foobar, 'result'])
+        assert executor.call(func) == 'result'
+        assert func.call_count == 3
+        assert self.clock.sleeps == [1, 2]
+        assert executor.nretries == 2
+        assert executor.nerrors == 2
+
+    def test_call_gives_up_after_retries(self):
+        executor = self.make_executor(retries=1, backoff=1)
+        func = mock.Mock(side_effect=Foobar)
+        with self.assertRaises(Foobar):
+            executor.call(func)
+        assert func.call_count == 2
+
+    def test_call_once_doesnt_retry_transient_errors(self):
+        executor = self.make_executor(retries=3)
+        func = mock.Mock(side_effect=Foobar)
+        with self.assertRaises(Foobar):
+            executor.call_once(func)
+        assert func.call_count == 1
+        assert executor.nretries == 0
+
+    def test_call_doesnt_retry_other_errors(self):
+        executor = self.make_executor(retries=3)
+        func = mock.Mock(side_effect=KeyError)
+        with self.assertRaises(KeyError):
+            executor.call(func)
+        assert func.call_count == 1
+
+    def test_call_is_rate_limited(self):
+        executor = self.make_executor(rate=1)
+        for i in range(3):
+            executor.call(lambda: None)
+        assert self.clock.sleeps == [1, 1]
+
+    def test_call_times_out(self):
+        executor = Executor('test', timeout=0.01)
+        event = threading.Event()
+        with self.assertRaises(CallTimedOut):
+            executor.call(event.wait, 5)
+        event.set()
+        assert executor.ntimeouts == 1
+
+    def test_a_timed_out_call_keeps_its_slot_till_it_finishes(self):
+        executor = Executor('test', concurrency=1, timeout=0.01)
+        event = threading.Event()
+        with self.assertRaises(CallTimedOut):
+            executor.call(event.wait, 5)
+        assert not executor._semaphore.acquire(False)
+        event.set()
+        assert executor.call(lambda: 'done') == 'done'
+
+    def test_call_once_doesnt_time_out(self):
+        executor = Executor('test', timeout=0.01)
+        assert executor.call_once(time.sleep, 0.05) is None
+        assert executor.ntimeouts == 0
+
+    def test_call_with_timeout_reraises_errors(self):
+        executor = Executor('test', timeout=5)
+        with self.assertRaises(Foobar):
+            executor.call(mock.Mock(side_effect=Foobar))
+
+    def test_concurrency_is_bounded(self):
+        executor = Executor('test', concurrency=2)
+        lock = threading.Lock()
+        state = dict(running=0, most=0)
+        def f(i):
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            return i
+        assert Executor('test', concurrency=8).map(lambda i: executor.call(f, i), range(8)) \
+                                                                                    == range(8)
+        assert state['most'] <= 2
+
+    @mock.patch('gratipay.utils.executor.log')
+    def test_logs_stats_periodically(self, log):
+        executor = self.make_executor(log_every=10)
+        executor.call(lambda: None)
+        assert not log.called
+        self.clock.now += 10
+        executor.call(lambda: None)
+        assert log.call_args[0][0].startswith('test: 2 calls in 10s (0.2/s), 0 retries')
+
+
+class TestBatch(Harness):
+
+    def test_batch_applies_func_to_everything_put(self):
+        results = []
+        with Executor('test', concurrency=3).batch(results.append) as batch:
+            for i in range(10):
+                batch.put(i)
+        assert sorted(results) == range(10)
+        assert batch.nput == 10
+
+    def test_batch_reraises_the_first_error_on_exit(self):
+        func = mock.Mock(side_effect=[None, Foobar, None])
+        with self.assertRaises(Foobar):
+            with Executor('test', concurrency=1).batch(func) as batch:
+                for i in range(3):
+                    batch.put(i)
+        assert func.call_count == 3
+
+    def test_batch_doesnt_mask_errors_from_the_producer(self):
+        with self.assertRaises(KeyError):
+            with Executor('test').batch(mock.Mock(side_effect=Foobar)) as batch:
+                batch.put(1)
+                raise KeyError
@@ -61,6 +61,57 @@ class Basics(Harness):
             assert Foo() == package
         assert Foo() is None
 
+    def test_many_can_be_upserted_at_once(self):
+        self.make_package()
+        n = Package.upsert_many(NPM, [ dict(name='foo', description='Bar!', emails=['a@b.c'])
+                                     , dict(name='bar', description='Baz!', emails=[])
+                                      ])
+        assert n == 2
+        assert (Foo().description, Foo().emails) == ('Bar!', ['a@b.c'])
+        assert Package.from_names(NPM, 'bar').description == 'Baz!'
+
+    def test_upserts_store_a_fingerprint(self):
+        Package.upsert(NPM, name='foo', description='Foo!', emails=['a@b.c'])
+        Package.upsert_many(NPM, [dict(name='bar', description='Foo!', emails=['a@b.c'])])
+        assert self.db.all('SELECT DISTINCT fingerprint FROM packages') == \
+                                                        [Package.fingerprint('Foo!', ['a@b.c'])]
+
+    def test_fingerprint_depends_on_description_and_emails(self):
+        fingerprint = Package.fingerprint('Foo!', ['a@b.c'])
+        assert Package.fingerprint('Foo!', []) != fingerprint
+        assert Package.fingerprint('Foo?', ['a@b.c']) != fingerprint
+        assert Package.fingerprint('Foo!\na@b.c', []) != Package.fingerprint('Foo!', ['a@b.c'])
+
+    def test_fingerprint_handles_a_missing_description(self):
+        assert Package.fingerprint(None, ['a@b.c']) == Package.fingerprint('', ['a@b.c'])
+
+    def test_upsert_many_doesnt_rewrite_unchanged_packages(self):
+        foo = dict(name='foo', description='Foo!', emails=[])
+        assert Package.upsert_many(NPM, [foo]) == 1
+        xmin = self.db.one("SELECT xmin::text FROM packages")
+        assert Package.upsert_many(NPM, [foo]) == 0
+        assert self.db.one("SELECT xmin::text FROM packages") == xmin
+        assert Package.upsert_many(NPM, [dict(foo, description='Foo?')]) == 1
+
+    def test_many_can_be_deleted_at_once(self):
+        self.make_package()
+        self.make_package(name='bar')
+        self.make_package(name='baz')
+        assert Package.delete_many(NPM, {'foo', 'bar', 'buz'}) == 2
+        assert self.db.all('SELECT name FROM packages') == ['baz']
+
+    def test_delete_many_unlinks_teams(self):
+        alice = self.make_participant('alice')
+        package = self.make_package()
+        with self.db.get_cursor() as c:
+            team = package.get_or_create_linked_team(c, alice)
+        Package.delete_many(NPM, ['foo'])
+        assert Foo() is None
+        assert team.package is None
+        event = self.db.one("SELECT payload FROM events WHERE type='package' ORDER BY id DESC "
+                            "LIMIT 1")
+        assert event == dict(id=package.id, action='unlink', values=dict(team_id=team.id))
+
 
 class Linking(Harness):
 
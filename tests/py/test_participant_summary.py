@@ -0,0 +1,61 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import pytest
+
+from gratipay.models.participant.summary import ParticipantSummary
+from gratipay.testing import Harness
+
+
+class TestParticipantSummary(Harness):
+
+    use_VCR = False
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now', email_address='a@example.com')
+        self.bob = self.make_participant('bob', claimed_time='now')
+
+    def test_load_keeps_the_order_of_ids_and_skips_unknown_ones(self):
+        summaries = ParticipantSummary.load(self.db, [self.bob.id, 1786541, self.alice.id])
+        assert [s.username for s in summaries] == ['bob', 'alice']
+
+    def test_load_with_no_ids_doesnt_hit_the_database(self):
+        nqueries = self.db.nqueries
+        assert ParticipantSummary.load(self.db, []) == []
+        assert self.db.nqueries == nqueries
+
+    def test_load_takes_a_tuple_of_columns(self):
+        alice, = ParticipantSummary.load(self.db, [self.alice.id], ('id', 'email_address'))
+        assert alice.email_address == 'a@example.com'
+        assert alice._participant is None
+
+    def test_load_rejects_columns_we_have_no_slot_for(self):
+        with pytest.raises(ValueError):
+            ParticipantSummary.load(self.db, [self.alice.id], ('id', 'session_token'))
+        with pytest.raises(ValueError):
+            ParticipantSummary.load(self.db, [self.alice.id], ('username',))
+
+    def test_other_attributes_load_the_whole_participant_once(self):
+        alice, = ParticipantSummary.load(self.db, [self.alice.id])
+        nqueries = self.db.nqueries
+        assert alice.email_address == 'a@example.com'   # a slot we didn't load
+        assert alice.is_admin is False                  # not a slot at all
+        assert alice.is_claimed                         # a Participant property
+        assert self.db.nqueries == nqueries + 1
+
+    def test_url_path_and_statements_dont_load_the_whole_participant(self):
+        self.alice.upsert_statement('en', 'Hi!')
+        alice, = ParticipantSummary.load(self.db, [self.alice.id])
+        assert alice.url_path == '/~alice/'
+        assert alice.get_statement(['en']) == ('Hi!', 'en')
+        assert alice._participant is None
+
+    def test_list_identity_metadata_doesnt_load_the_whole_participant(self):
+        alice, = ParticipantSummary.load(self.db, [self.alice.id])
+        assert alice.list_identity_metadata() == []
+        assert alice._participant is None
+
+    def test_summaries_equal_participants_with_the_same_id(self):
+        alice, bob = ParticipantSummary.load(self.db, [self.alice.id, self.bob.id])
+        assert alice == self.alice
+        assert alice != bob
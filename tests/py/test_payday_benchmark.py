@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.billing.payday import PAYIN_STEPS
+from gratipay.testing import Harness
+from gratipay.testing.payday_benchmark import compare, populate, run
+
+
+class TestPaydayBenchmark(Harness):
+
+    use_VCR = False
+
+    def test_populate_loads_the_population(self):
+        population = populate(self.db, 103, per_giver=5, team_size=2)
+        assert population == dict(participants=5 + 10 + 21, teams=5)
+        assert self.db.one("SELECT count(*) FROM payment_instructions") == 103
+        assert self.db.one("SELECT count(DISTINCT (participant_id, team_id)) "
+                           "FROM payment_instructions") == 103
+        assert self.db.one("SELECT count(*) FROM takes") == 10
+        assert self.db.one("SELECT count(*) FROM exchange_routes WHERE network='paypal'") == 5
+
+    def test_populate_leaves_sequences_in_order(self):
+        populate(self.db, 10)
+        alice = self.make_participant('alice')
+        assert alice.id == self.db.one("SELECT max(id) FROM participants")
+
+    def test_run_reports_each_stage(self):
+        report = run(self.app, 50, engine='set-based')
+        assert report['ninstructions'] == 50
+        assert report['engine'] == 'set-based'
+        assert set(PAYIN_STEPS) <= set(report['stages'])
+        holds = report['stages']['holds_created']
+        assert holds['nrows'] > 0
+        assert holds['nbraintree_calls'] == holds['nrows'] + 1  # the search for existing holds
+        assert self.db.one("SELECT count(*) FROM payments") > 0
+
+    def test_compare_lists_stages_of_matching_runs(self):
+        def report(commit, seconds):
+            return dict( commit=commit
+                       , runs=[dict( ninstructions=10
+                                   , engine='trigger'
+                                   , payin_seconds=seconds * 2
+                                   , stages={'prepared': {'seconds': seconds}}
+                                    )]
+                        )
+        lines = compare(report('abc', 1.0), report('def', 0.5))
+        assert lines[0] == 'abc -> def'
+        assert lines[1] == '10 instructions, trigger engine:'
+        assert lines[2].split() == ['prepared', '1.000s', '0.500s', '-50%']
+        assert lines[3].split() == ['payin', '2.000s', '1.000s', '-50%']
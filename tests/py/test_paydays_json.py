@@ -15,3 +15,10 @@ class Tests(Harness, PaydayMixin):
         response = self.client.GET("/about/paydays.json")
         paydays = json.loads(response.body)
         assert paydays[0]['nusers'] == 0
+
+    def test_paydays_json_is_cached(self):
+        assert json.loads(self.client.GET("/about/paydays.json").body) == []
+        self.start_payday()
+        assert json.loads(self.client.GET("/about/paydays.json").body) == []
+        self.app.query_cache.clear()
+        assert len(json.loads(self.client.GET("/about/paydays.json").body)) == 1
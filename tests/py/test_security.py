@@ -2,6 +2,9 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import struct
 import datetime
+import select
+import time
+from Cookie import SimpleCookie
 
 from aspen import Response
 from aspen.http.request import Request
@@ -9,8 +12,11 @@ from base64 import urlsafe_b64decode
 from cryptography.fernet import Fernet, InvalidToken
 from gratipay import security
 from gratipay.models.participant import Identity
+from gratipay.security.authentication import CHANNEL, SessionCache, session_cache
 from gratipay.security.crypto import EncryptingPacker
+from gratipay.security.user import SESSION_REFRESH, User
 from gratipay.testing import Harness
+from gratipay.utils.query_cache import QueryCache
 from pytest import raises
 
 
@@ -94,6 +100,115 @@ class AddHeadersToResponseTests(Harness):
             assert headers['content-security-policy-report-only'] == policy
 
 
+class SessionCacheTests(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.now = 0
+        self.cache = SessionCache(ttl=5, _time=lambda: self.now)
+        self.alice = User(self.make_participant('alice', claimed_time='now'))
+        self.alice.sign_in(SimpleCookie())
+        self.token = self.alice.participant.session_token
+
+    def test_caches_the_participant_for_ttl(self):
+        assert self.cache.get(self.token).username == 'alice'
+        self.db.run("UPDATE participants SET avatar_url='x' WHERE username='alice'")
+        assert self.cache.get(self.token).avatar_url is None
+        self.now = 6
+        assert self.cache.get(self.token).avatar_url == 'x'
+
+    def test_gives_each_caller_its_own_participant(self):
+        assert self.cache.get(self.token) is not self.cache.get(self.token)
+
+    def test_doesnt_cache_unknown_tokens(self):
+        assert self.cache.get('deadbeef') is None
+        assert len(self.cache._rows) == 0
+
+    def test_expired_sessions_are_anonymous(self):
+        self.cache.get(self.token)
+        self.db.run("UPDATE participants SET session_expires=now() WHERE username='alice'")
+        self.now = 6
+        assert self.cache.get(self.token) is None
+
+    def test_invalidate_drops_the_participant(self):
+        self.cache.get(self.token)
+        self.cache.invalidate(self.alice.participant.id)
+        assert len(self.cache._rows) == 0
+        assert self.cache._tokens == {}
+
+    def test_invalidate_leaves_other_participants_cached(self):
+        bob = User(self.make_participant('bob', claimed_time='now'))
+        bob.sign_in(SimpleCookie())
+        self.cache.get(self.token)
+        self.cache.get(bob.participant.session_token)
+        self.cache.invalidate(self.alice.participant.id)
+        assert [token for token, _ in self.cache._rows.items()] == [bob.participant.session_token]
+
+    def test_evicted_sessions_leave_the_index(self):
+        cache = SessionCache(ttl=5, maxsize=1, _time=lambda: self.now)
+        bob = User(self.make_participant('bob', claimed_time='now'))
+        bob.sign_in(SimpleCookie())
+        cache.get(self.token)
+        cache.get(bob.participant.session_token)
+        assert cache._tokens == {bob.participant.id: {bob.participant.session_token}}
+
+    def test_ttl_of_zero_turns_caching_off(self):
+        self.cache.ttl = 0
+        self.cache.get(self.token)
+        assert len(self.cache._rows) == 0
+
+
+    def test_signing_out_drops_the_cached_session(self):
+        assert session_cache.get(self.token).username == 'alice'
+        self.alice.sign_out(SimpleCookie())
+        assert session_cache.get(self.token) is None
+
+    def test_closing_drops_the_cached_session(self):
+        assert session_cache.get(self.token).username == 'alice'
+        self.alice.participant.close()
+        assert session_cache.get(self.token) is None
+
+    def test_unsafe_requests_drop_the_cached_session(self):
+        cookies = {b'session': self.token}
+        self.client.GET('/', cookies=cookies)
+        assert len(session_cache._rows) == 1
+        self.client.PxST('/', cookies=cookies)
+        assert len(session_cache._rows) == 0
+
+    def test_the_db_tells_other_processes_when_a_session_changes(self):
+        with self.db.get_connection() as connection:
+            connection.autocommit = True
+            connection.cursor().execute("LISTEN " + CHANNEL)
+            self.db.run("UPDATE participants SET avatar_url='x' WHERE username='alice'")
+            self.db.run("UPDATE participants SET is_suspicious=true WHERE username='alice'")
+            select.select([connection], [], [], 1)
+            connection.poll()
+            payloads = [n.payload for n in connection.notifies]
+            connection.cursor().execute("UNLISTEN " + CHANNEL)
+            connection.autocommit = False
+        assert payloads == [str(self.alice.participant.id)]
+
+    def test_other_processes_forget_a_session_when_notified(self):
+        self.cache.get(self.token)
+        QueryCache(self.db).listen( self.client.website.env.database_url
+                                  , {CHANNEL: self.cache.handle_notification}
+                                   )
+        for i in range(50):  # until the listener has connected and hears about it
+            self.db.run( "UPDATE participants SET session_expires = session_expires + "
+                         "interval '1 second' WHERE username='alice'"
+                        )
+            time.sleep(0.1)
+            if not len(self.cache._rows):
+                break
+        assert len(self.cache._rows) == 0
+
+    def test_a_session_that_isnt_due_for_extension_stays_cached(self):
+        session_cache.get(self.token)
+        expires = self.alice.participant.session_expires
+        assert self.alice.participant.extend_session(expires, SESSION_REFRESH) is False
+        assert len(session_cache._rows) == 1
+
+
 class EncryptingPackerTests(Harness):
 
     packed = b'gAAAAABXJMbdriJ984uMCMKfQ5p2UUNHB1vG43K_uJyzUffbu2Uwy0d71kAnqOKJ7Ww_FEQz9Dliw87UpM'\
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from gratipay.testing import Harness
+import json
+import time
+
+import mock
+from gratipay.models.package import Package
+from gratipay.testing import Foobar, Harness
+from gratipay.utils.lru import LRU
 
 from gratipay import sync_npm
 
@@ -15,6 +21,10 @@ class ProcessDocTests(Harness):
         actual = sync_npm.process_doc({'name': 'foo'})
         assert actual == {'name': 'foo', 'description': '', 'emails': []}
 
+    def test_smooths_out_null_and_non_string_descriptions(self):
+        assert sync_npm.process_doc({'name': 'foo', 'description': None})['description'] == ''
+        assert sync_npm.process_doc({'name': 'foo', 'description': 42})['description'] == '42'
+
     def test_extracts_maintainer_emails(self):
         doc = {'name': 'foo', 'maintainers': [{'email': 'alice@example.com'}]}
         assert sync_npm.process_doc(doc)['emails'] == ['alice@example.com']
@@ -102,6 +112,99 @@ class ConsumeChangeStreamTests(Harness):
         sync_npm.consume_change_stream(self.change_stream(docs), self.db)
         assert self.db.one('select npm_last_seq from worker_coordination') == 12
 
+    def test_upserts_once_per_package_per_batch(self):
+        docs = [ {'doc': {'name': 'foo', 'description': 'Foo.'}}
+               , {'doc': {'name': 'bar', 'description': 'Bar.'}}
+               , {'doc': {'name': 'foo', 'description': 'Foo!'}}
+                ]
+        with mock.patch.object(Package, 'upsert_many', wraps=Package.upsert_many) as upsert_many:
+            sync_npm.consume_change_stream(self.change_stream(docs), self.db)
+        assert upsert_many.call_count == 1
+        assert sorted(p['name'] for p in upsert_many.call_args[0][1]) == ['bar', 'foo']
+        assert self.db.all('select description from packages order by name') == ['Bar.', 'Foo!']
+
+    def test_delete_after_upsert_in_a_batch_wins(self):
+        self.make_package()
+        docs = [ {'doc': {'name': 'foo', 'description': 'Foo?'}}
+               , {'deleted': True, 'id': 'foo'}
+                ]
+        sync_npm.consume_change_stream(self.change_stream(docs), self.db)
+        assert self.db.one('select * from packages') is None
+
+    def test_upsert_after_delete_in_a_batch_wins(self):
+        self.make_package()
+        docs = [ {'deleted': True, 'id': 'foo'}
+               , {'doc': {'name': 'foo', 'description': 'Foo?'}}
+                ]
+        sync_npm.consume_change_stream(self.change_stream(docs), self.db)
+        assert self.db.one('select description from packages') == 'Foo?'
+
+    def test_skips_packages_that_havent_changed_since_we_wrote_them(self):
+        fingerprints = LRU(10)
+        docs = [ {'doc': {'name': 'foo', 'description': 'Foo.'}}
+               , {'doc': {'name': 'bar', 'description': 'Bar.'}}
+                ]
+        nskipped = []
+        def consume(docs):
+            sync_npm.consume_change_stream( self.change_stream(docs), self.db
+                                          , fingerprints=fingerprints
+                                          , on_commit=lambda batch: nskipped.append(batch.nskipped)
+                                           )
+        consume(docs)
+        assert fingerprints.get('foo') == Package.fingerprint('Foo.', [])
+
+        docs[1]['doc']['description'] = 'Bar!'
+        with mock.patch.object(Package, 'upsert_many', wraps=Package.upsert_many) as upsert_many:
+            consume(docs)
+        assert [p['name'] for p in upsert_many.call_args[0][1]] == ['bar']
+        assert nskipped == [0, 1]
+        assert self.db.one("select description from packages where name='bar'") == 'Bar!'
+
+    def test_deletes_are_forgotten(self):
+        fingerprints = LRU(10)
+        docs = [{'doc': {'name': 'foo'}}, {'deleted': True, 'id': 'foo'}]
+        for doc in docs:
+            sync_npm.consume_change_stream(self.change_stream([doc]), self.db,
+                                           fingerprints=fingerprints)
+        assert 'foo' not in fingerprints
+        sync_npm.consume_change_stream(self.change_stream(docs[:1]), self.db,
+                                       fingerprints=fingerprints)
+        assert self.db.one('select name from packages') == 'foo'
+
+    def test_counts_skips_by_the_db_too(self):
+        docs = [{'doc': {'name': 'foo', 'description': 'Foo.'}}]
+        nskipped = []
+        for i in range(2):
+            sync_npm.consume_change_stream(self.change_stream(docs), self.db,
+                                           on_commit=lambda b: nskipped.append(b.nskipped))
+        assert nskipped == [0, 1]
+
+    def test_sets_last_seq_once_per_batch(self):
+        docs = [{'doc': {'name': 'foo', 'description': 'Foo.'}}] * 13
+        seqs = []
+        real_apply = sync_npm.ChangeBatch.apply
+        def spy(batch, cursor, fingerprints=None):
+            seqs.append(batch.seq)
+            real_apply(batch, cursor, fingerprints)
+        with mock.patch.object(sync_npm.ChangeBatch, 'apply', spy):
+            sync_npm.consume_change_stream(self.change_stream(docs), self.db, batch_size=5)
+        assert seqs == [4, 9, 12]
+        assert self.db.one('select npm_last_seq from worker_coordination') == 12
+
+    def test_flushes_a_partial_batch_after_the_interval(self):
+        docs = [{'doc': {'name': 'foo', 'description': 'Foo.'}}] * 4
+        clock = iter([0, 0.1, 0.5, 0.6, 0.7, 0.8])
+        seqs = []
+        def stream():
+            for change in self.change_stream(docs):
+                yield change
+                seqs.append(self.db.one('select npm_last_seq from worker_coordination'))
+        sync_npm.consume_change_stream( stream(), self.db, batch_size=100, flush_every=500
+                                      , _time=lambda: next(clock)
+                                       )
+        assert seqs == [-1, 1, 1, 1]
+        assert self.db.one('select npm_last_seq from worker_coordination') == 3
+
 
     def test_logs_lag(self):
         captured = {}
@@ -111,3 +214,100 @@ class ConsumeChangeStreamTests(Harness):
         sync_npm.check(self.db, capture)
         assert captured['message'].startswith('count#npm-sync-lag=')
         assert captured['message'].split('=')[1].isdigit()
+
+
+class PipelineTests(Harness):
+
+    def change_stream(self, changes):
+        for i, change in enumerate(changes):
+            change['seq'] = i
+            yield change
+
+    def last_seq(self):
+        return self.db.one('select npm_last_seq from worker_coordination')
+
+    def test_pipeline_syncs_the_stream(self):
+        docs = [{'doc': {'name': 'foo{}'.format(i), 'description': 'Foo.'}} for i in range(25)]
+        pipeline = sync_npm.Pipeline(self.change_stream(docs), self.db, queue_size=3, log_every=0,
+                                     batch_size=10)
+        pipeline.run()
+        assert self.db.one('select count(*) from packages') == 25
+        assert self.last_seq() == 24
+        assert pipeline.nread == pipeline.nwritten == 25
+
+    def test_pipeline_writes_what_it_read_and_reraises_reader_errors(self):
+        def stream():
+            for change in self.change_stream([{'doc': {'name': 'foo'}}] * 2):
+                yield change
+            raise Foobar
+        with self.assertRaises(Foobar):
+            sync_npm.Pipeline(stream(), self.db, log_every=0).run()
+        assert self.last_seq() == 1
+
+    def test_pipeline_reraises_writer_errors(self):
+        docs = [{'doc': {'name': 'foo'}}] * 100
+        with mock.patch.object(sync_npm.ChangeBatch, 'apply', side_effect=Foobar):
+            with self.assertRaises(Foobar):
+                sync_npm.Pipeline(self.change_stream(docs), self.db, queue_size=2,
+                                  log_every=0, batch_size=10).run()
+        assert self.last_seq() == -1
+
+    def test_pipeline_flushes_while_the_stream_is_quiet(self):
+        committed = []
+        def stream():
+            yield {'doc': {'name': 'foo'}, 'seq': 0}
+            for i in range(500):
+                if self.last_seq() == 0:
+                    committed.append(True)
+                    break
+                time.sleep(0.01)
+        sync_npm.Pipeline(stream(), self.db, log_every=0, flush_every=10).run()
+        assert committed == [True]
+
+    def test_pipeline_logs_metrics(self):
+        clock = mock.Mock(return_value=0)
+        captured = []
+        pipeline = sync_npm.Pipeline([], self.db, _print=captured.append, _time=clock)
+        pipeline.nread, pipeline.read_seq = 120, 150
+        pipeline.nwritten, pipeline.written_seq = 100, 130
+        pipeline.queue.put({})
+        clock.return_value = 10
+        pipeline.log_metrics()
+        assert captured == ['count#npm-sync-changes-per-sec=10.0 count#npm-sync-queue-depth=1 '
+                            'count#npm-sync-seq-lag=20 count#npm-sync-skipped=0']
+
+
+class ImportDumpTests(Harness):
+
+    def dump(self, *docs):
+        return [json.dumps(doc) + '\n' for doc in docs]
+
+    def test_imports_packages_and_sets_last_seq(self):
+        lines = self.dump( {'update_seq': 1234}
+                         , {'name': 'foo', 'description': 'Foo.', 'maintainers': [{'email': 'a@b'}]}
+                         , {'_id': '_design/app'}
+                         , {'name': 'bar'}
+                          )
+        assert sync_npm.import_dump(lines, self.db) == 2
+        assert self.db.all('select name, description, emails from packages order by name') == \
+                                            [('bar', '', []), ('foo', 'Foo.', ['a@b'])]
+        assert self.db.one('select npm_last_seq from worker_coordination') == 1234
+
+    def test_later_docs_win_and_existing_packages_are_updated(self):
+        self.make_package()
+        lines = self.dump({'name': 'foo', 'description': '1'}, {'name': 'foo', 'description': '2'},
+                          {'update_seq': '7'})
+        assert sync_npm.import_dump(lines, self.db, chunk_size=1) == 1
+        assert self.db.one('select description from packages') == '2'
+
+    def test_escapes_awkward_characters(self):
+        description = 'Tab\there,\nnewline, \\backslash, and ☃'
+        lines = self.dump({'name': 'foo', 'description': description}, {'update_seq': 1})
+        sync_npm.import_dump(lines, self.db)
+        assert self.db.one('select description from packages') == description
+
+    def test_requires_an_update_seq(self):
+        with self.assertRaises(ValueError):
+            sync_npm.import_dump(self.dump({'name': 'foo'}), self.db)
+        assert self.db.one('select count(*) from packages') == 0
+        assert self.db.one('select npm_last_seq from worker_coordination') == -1
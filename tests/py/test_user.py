@@ -111,6 +111,19 @@ class TestUser(Harness):
         user.keep_signed_in(cookies)
         assert SESSION in cookies
 
+    def test_session_is_refreshed_once_across_requests(self):
+        self.make_participant('alice')
+        user = User.from_username('alice')
+        user.sign_in(SimpleCookie())
+        expires = user.participant.session_expires
+        user.participant.set_session_expires(expires - SESSION_REFRESH)
+        users = [User.from_session_token(user.participant.session_token) for i in range(2)]
+        cookies = [SimpleCookie(), SimpleCookie()]
+        users[0].keep_signed_in(cookies[0])
+        users[1].keep_signed_in(cookies[1])
+        assert SESSION in cookies[0]
+        assert SESSION not in cookies[1]
+
 
     # from_id
 
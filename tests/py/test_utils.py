@@ -1,17 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import pickle
 from datetime import datetime, timedelta
 
+import mock
 import pytest
 from aspen.http.response import Response
 from gratipay import utils
 from gratipay.testing import Harness, D
 from gratipay.utils import i18n, pricing, encode_for_querystring, decode_from_querystring, \
                                                             sentry, truncate, get_featured_projects
+from gratipay.utils.lru import LRU
+from gratipay.utils.query_cache import LRUQueryCache, PostgresBackend, QueryCache
+from gratipay.utils import serializers
 from gratipay.utils.username import safely_reserve_a_username, FailedToReserveUsername, \
                                                                            RanOutOfUsernameAttempts
-from psycopg2 import IntegrityError
+from psycopg2 import Binary, IntegrityError
 
 class TestGetParticipant(Harness):
 
@@ -310,3 +315,284 @@ class SentryTellerTests(Harness):
         with sentry.teller(env, noop):
             raise Heck
         assert noop.fails == [Heck]
+
+
+class TestLRU(Harness):
+
+    def test_drops_the_least_recently_used_item(self):
+        lru = LRU(2)
+        lru['a'] = 1
+        lru['b'] = 2
+        assert lru.get('a') == 1
+        lru['c'] = 3
+        assert 'b' not in lru
+        assert (lru.get('a'), lru.get('c')) == (1, 3)
+        assert lru.nevicted == 1
+
+    def test_setting_counts_as_a_use(self):
+        lru = LRU(2)
+        lru['a'] = 1
+        lru['b'] = 2
+        lru['a'] = 3
+        lru['c'] = 4
+        assert 'b' not in lru
+        assert len(lru) == 2
+
+    def test_get_and_pop_take_defaults(self):
+        lru = LRU(2)
+        assert lru.get('a', 0) == 0
+        assert lru.pop('a') is None
+
+    def test_drops_items_to_stay_within_a_byte_budget(self):
+        lru = LRU(10, maxbytes=10, sizeof=len)
+        lru['a'] = 'xxxx'
+        lru['b'] = 'xxxx'
+        lru['c'] = 'xxxx'
+        assert 'a' not in lru
+        assert lru.nbytes == 8
+        lru['d'] = 'x' * 20
+        assert len(lru) == 1  # we keep the newest, even over budget
+        lru.pop('d')
+        assert lru.nbytes == 0
+
+    def test_tells_on_evict_what_it_dropped(self):
+        evicted = []
+        lru = LRU(1, on_evict=lambda k, v: evicted.append((k, v)))
+        lru['a'] = 1
+        lru['b'] = 2
+        lru.pop('b')
+        assert evicted == [('a', 1)]
+
+
+class TestSerializers(Harness):
+
+    context = dict( amount=D('1.50')
+                  , when=datetime(2017, 1, 2, 3, 4, 5)
+                  , names=['alice', 'bob']
+                  , nested={'fee': D('0.31')}
+                  , flag=True
+                  , nothing=None
+                   )
+
+    def test_json_round_trips_decimals_and_datetimes(self):
+        json = serializers.get_serializer('json')
+        data = serializers.dumps(self.context, json)
+        assert data[:1] == json.version
+        assert serializers.loads(data) == self.context
+
+    def test_loads_reads_pickles(self):
+        assert serializers.loads(pickle.dumps(self.context)) == self.context
+        assert serializers.loads(pickle.dumps(self.context, 2)) == self.context
+
+    def test_loads_reads_buffers(self):
+        data = serializers.dumps(self.context, serializers.get_serializer('json'))
+        assert serializers.loads(buffer(data)) == self.context
+
+    def test_dumps_refuses_what_it_cant_load(self):
+        with pytest.raises(TypeError):
+            serializers.dumps({'foo': object()}, serializers.get_serializer('json'))
+
+    def test_get_serializer_refuses_unknown_names(self):
+        with pytest.raises(ValueError):
+            serializers.get_serializer('yaml')
+
+
+class TestQueryCache(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.cache = QueryCache(self.db, threshold=5)
+
+    def test_caches_results(self):
+        self.make_participant('alice')
+        assert self.cache.one("SELECT count(*) FROM participants") == 1
+        self.make_participant('bob')
+        assert self.cache.one("SELECT count(*) FROM participants") == 1
+        assert (self.cache.nhits, self.cache.nmisses, self.cache.nstale) == (1, 1, 0)
+
+    def test_threshold_can_be_set_per_call(self):
+        self.make_participant('alice')
+        assert self.cache.one("SELECT count(*) FROM participants", threshold=0) == 1
+        self.make_participant('bob')
+        assert self.cache.one("SELECT count(*) FROM participants", threshold=0) == 2
+        assert (self.cache.nhits, self.cache.nmisses, self.cache.nstale) == (0, 1, 1)
+
+    def test_keyword_arguments_are_passed_through_and_part_of_the_key(self):
+        sql = "SELECT username FROM participants"
+        assert self.cache.one(sql, default='nobody') == 'nobody'
+        assert self.cache.one(sql, default='no one') == 'no one'
+        assert self.cache.all(sql, back_as=dict) == []
+
+    def test_process_runs_once_per_refresh(self):
+        process = mock.Mock(return_value='processed')
+        for i in range(3):
+            assert self.cache.all("SELECT 1", process=process) == 'processed'
+        assert process.call_count == 1
+
+    def test_clear_drops_everything(self):
+        self.cache.one("SELECT 1")
+        self.cache.clear()
+        self.cache.one("SELECT 1")
+        assert self.cache.nmisses == 2
+
+    def test_log_metrics_reports_and_resets_counts(self):
+        self.cache.one("SELECT 1")
+        self.cache.one("SELECT 1")
+        printed = []
+        self.cache.log_metrics(_print=printed.append)
+        self.cache.log_metrics(_print=printed.append)
+        assert printed == [ 'count#query_cache_hits=1 count#query_cache_misses=1 '
+                            'count#query_cache_stale=0 count#query_cache_shared=0'
+                          , 'count#query_cache_hits=0 count#query_cache_misses=0 '
+                            'count#query_cache_stale=0 count#query_cache_shared=0'
+                           ]
+
+    def test_dict_params_are_part_of_the_key(self):
+        assert self.cache.one("SELECT %(n)s", dict(n=1)) == 1
+        assert self.cache.one("SELECT %(n)s", dict(n=2)) == 2
+
+    def test_invalidate_drops_entries_that_depend_on_the_table(self):
+        self.cache.one("SELECT count(*) FROM teams", depends_on=('teams',))
+        self.cache.one("SELECT count(*) FROM paydays", depends_on=('paydays',))
+        self.cache.invalidate('teams')
+        self.cache.one("SELECT count(*) FROM teams", depends_on=('teams',))
+        self.cache.one("SELECT count(*) FROM paydays", depends_on=('paydays',))
+        assert (self.cache.nhits, self.cache.nmisses) == (1, 3)
+
+
+class TestPostgresBackend(Harness):
+
+    use_VCR = False
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.caches = [QueryCache(self.db, backend=PostgresBackend(self.db)) for i in range(2)]
+
+    def test_shares_results_between_caches(self):
+        a, b = self.caches
+        self.make_participant('alice')
+        assert a.one("SELECT count(*) FROM participants") == 1
+        self.make_participant('bob')
+        assert b.one("SELECT count(*) FROM participants") == 1
+        assert (b.nmisses, b.nshared) == (1, 1)
+
+    def test_honors_the_threshold_of_the_reader(self):
+        a, b = self.caches
+        a.one("SELECT 1")
+        b.one("SELECT 1", threshold=0)
+        assert b.nshared == 0
+
+    def test_shares_records_and_tuples(self):
+        a, b = self.caches
+        self.db.run("INSERT INTO paydays DEFAULT VALUES")
+        sql = "SELECT ts_start, volume FROM paydays"
+        expected = a.all(sql)
+        shared = b.all(sql)
+        assert b.nshared == 1
+        assert shared == expected
+        assert shared[0].volume == expected[0].volume
+        assert b.one("SELECT 1, 2", back_as=tuple) == (1, 2)
+
+    def test_keeps_unserializable_results_to_itself(self):
+        a, b = self.caches
+        alice = self.make_participant('alice')
+        sql = "SELECT p.*::participants FROM participants p"
+        assert a.one(sql) == alice
+        assert self.db.one("SELECT count(*) FROM query_cache") == 0
+        nqueries = self.db.nqueries
+        a.clear()
+        assert a.one(sql) == alice
+        assert self.db.nqueries == nqueries + 1  # we didn't look for it in the table
+
+    def test_doesnt_unpickle_what_it_finds(self):
+        a, b = self.caches
+        a.one("SELECT 1")
+        self.db.run("UPDATE query_cache SET value=%s", (Binary(pickle.dumps(2)),))
+        assert b.one("SELECT 1") == 1
+        assert b.nshared == 0
+
+    def test_changes_to_a_table_drop_shared_results_that_depend_on_it(self):
+        a, b = self.caches
+        assert a.one("SELECT count(*) FROM teams", depends_on=('teams',)) == 0
+        assert a.one("SELECT count(*) FROM paydays", depends_on=('paydays',)) == 0
+        self.make_team()
+        assert b.one("SELECT count(*) FROM teams", depends_on=('teams',)) == 1
+        assert b.one("SELECT count(*) FROM paydays", depends_on=('paydays',)) == 0
+        assert b.nshared == 1
+
+    def test_payday_bookkeeping_doesnt_drop_shared_results(self):
+        a, b = self.caches
+        self.db.run("INSERT INTO paydays DEFAULT VALUES")
+        assert a.one("SELECT count(*) FROM paydays", depends_on=('paydays',)) == 1
+        self.db.run("UPDATE paydays SET stage = 2, checkpoints = '{\"x\": 1}'")
+        assert b.one("SELECT count(*) FROM paydays", depends_on=('paydays',)) == 1
+        assert b.nshared == 1
+        self.db.run("UPDATE paydays SET ts_end = now()")
+        b.clear()
+        b.one("SELECT count(*) FROM paydays", depends_on=('paydays',))
+        assert b.nshared == 1
+
+
+class TestLRUQueryCache(Harness):
+
+    def wait_for_refresh(self, cache):
+        for entry in cache.cache._data.values():
+            entry.lock.acquire()
+            entry.lock.release()
+
+    def test_serves_stale_results_while_refreshing(self):
+        cache = LRUQueryCache(self.db, threshold=0, grace=60)
+        self.make_participant('alice')
+        assert cache.one("SELECT count(*) FROM participants") == 1
+        self.make_participant('bob')
+        assert cache.one("SELECT count(*) FROM participants") == 1
+        assert cache.nstale == 1
+        self.wait_for_refresh(cache)
+        cache.threshold = 60
+        assert cache.one("SELECT count(*) FROM participants") == 2
+
+    def test_runs_the_query_when_past_grace(self):
+        cache = LRUQueryCache(self.db, threshold=0, grace=0)
+        self.make_participant('alice')
+        assert cache.one("SELECT count(*) FROM participants") == 1
+        self.make_participant('bob')
+        assert cache.one("SELECT count(*) FROM participants") == 2
+        assert (cache.nmisses, cache.nstale) == (1, 1)
+
+    def test_caches_negative_results_for_their_own_threshold(self):
+        cache = LRUQueryCache(self.db, threshold=60, negative_threshold=0, grace=0)
+        sql = "SELECT username FROM participants"
+        assert cache.one(sql) is None
+        self.make_participant('alice')
+        assert cache.one(sql) == 'alice'
+        self.make_participant('bob')
+        assert cache.one(sql) == 'alice'
+
+    def test_caches_exceptions_for_the_negative_threshold(self):
+        cache = LRUQueryCache(self.db, negative_threshold=60)
+        with pytest.raises(Exception):
+            cache.one("SELECT * FROM nonexistent")
+        with mock.patch.object(self.db, 'one') as one:
+            with pytest.raises(Exception):
+                cache.one("SELECT * FROM nonexistent")
+        assert not one.called
+
+    def test_evicts_least_recently_used_entries(self):
+        cache = LRUQueryCache(self.db, maxsize=2)
+        cache.one("SELECT 1")
+        cache.one("SELECT 2")
+        cache.one("SELECT 1")
+        cache.one("SELECT 3")
+        assert len(cache.cache) == 2
+        cache.one("SELECT 1")
+        assert (cache.nhits, cache.nmisses) == (2, 3)
+
+    def test_log_metrics_reports_evictions(self):
+        cache = LRUQueryCache(self.db, maxsize=1)
+        cache.one("SELECT 1")
+        cache.one("SELECT 2")
+        printed = []
+        cache.log_metrics(_print=printed.append)
+        assert 'count#query_cache_misses=2 ' in printed[0]
+        assert 'count#query_cache_evicted=1 ' in printed[0]
+        assert 'measure#query_cache_entries=1 ' in printed[0]
@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import pickle
 from gratipay.testing import BrowserHarness, P
 from gratipay.models.package import NPM, Package
 from gratipay.models.participant import email
+from gratipay.utils import serializers
 
 
 class Test(BrowserHarness):
@@ -115,7 +115,7 @@ class Test(BrowserHarness):
         self.make_package()
         self.check()
 
-        link = pickle.loads(self.db.all('select context from email_messages')[-1])['link']
+        link = serializers.loads(self.db.all('select context from email_messages')[-1])['link']
         link = link[len(self.base_url):]  # strip because visit will add it back
 
         self.visit(link)